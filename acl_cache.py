@@ -0,0 +1,252 @@
+#! /usr/bin/python3
+
+import re
+import threading
+import time
+
+
+# In-memory copy of the acls, acl_groups and account_aliasses tables. All
+# names are stored lowercase as the tables use a case-insensitive collation.
+# reload() reads the tables without holding the lock; changes made in the
+# mean time may be missing from what it read, so they are recorded and
+# applied again to the new copy (they are all idempotent).
+class acl_cache(threading.Thread):
+    def __init__(self, db, resync_interval, autostart=True):
+        super().__init__(daemon=True)
+
+        self.db              = db
+        self.resync_interval = resync_interval
+
+        self.lock            = threading.Lock()
+
+        self.commands        = dict()  # who (user or group) -> set of commands
+        self.groups          = dict()  # who -> set of groups
+        self.members         = dict()  # group -> set of who
+        self.aliasses        = dict()  # account -> main account
+
+        self.decisions       = dict()  # who -> { (command, plugin group): bool }
+
+        self.loaded          = False
+
+        self.reloading       = 0       # reload() calls that are reading the tables
+        self.replay          = []      # (function, args) of changes made meanwhile
+
+        self.hits            = 0
+        self.misses          = 0
+        self.fallbacks       = 0
+        self.resyncs         = 0
+
+        self.reload()
+
+        # else the owner calls reload() every resync_interval seconds
+        if autostart:
+            self.name = 'GHBot ACL cache'
+            self.start()
+
+    def reload(self):
+        commands = dict()
+        groups   = dict()
+        members  = dict()
+        aliasses = dict()
+
+        with self.lock:
+            self.reloading += 1
+
+        try:
+            for row in self.db.query('SELECT who, command FROM acls'):
+                commands.setdefault(row[0].lower(), set()).add(row[1].lower())
+
+            for row in self.db.query('SELECT who, group_name FROM acl_groups'):
+                groups.setdefault(row[0].lower(), set()).add(row[1].lower())
+                members.setdefault(row[1].lower(), set()).add(row[0].lower())
+
+            for row in self.db.query('SELECT account, main_account FROM account_aliasses'):
+                aliasses[row[0].lower()] = row[1].lower()
+
+        except Exception as e:
+            print(f'acl_cache::reload: failed to load ACLs: {e}')
+
+            with self.lock:
+                self._reloaded()
+
+            return False
+
+        with self.lock:
+            self.commands  = commands
+            self.groups    = groups
+            self.members   = members
+            self.aliasses  = aliasses
+
+            self.decisions = dict()
+
+            for function, args in self.replay:
+                function(*args)
+
+            self._reloaded()
+
+            self.loaded    = True
+
+            self.resyncs  += 1
+
+        return True
+
+    # lock must be held
+    def _reloaded(self):
+        self.reloading -= 1
+
+        if self.reloading == 0:
+            self.replay = []
+
+    # applies a change to the cache; lock must be held
+    def _change(self, function, *args):
+        function(*args)
+
+        if self.reloading > 0:
+            self.replay.append((function, args))
+
+    def run(self):
+        while True:
+            time.sleep(self.resync_interval)
+
+            self.reload()
+
+    def resolve_alias(self, who):
+        who = who.lower()
+
+        with self.lock:
+            return self.aliasses.get(who, who)
+
+    # returns None when the cache is not usable (caller should ask the database)
+    def check(self, who, command, plugin_group):
+        who     = who.lower()
+        command = command.lower()
+        key     = (command, plugin_group.lower() if plugin_group != None else None)
+
+        with self.lock:
+            if not self.loaded:
+                self.fallbacks += 1
+
+                return None
+
+            who = self.aliasses.get(who, who)
+
+            per_who = self.decisions.get(who)
+
+            if per_who != None and key in per_who:
+                self.hits += 1
+
+                return per_who[key]
+
+            self.misses += 1
+
+            user_groups = self.groups.get(who, set())
+
+            # per user ACLs, then per group ACLs, then the group as specified by plugin
+            rc = command in self.commands.get(who, set()) or \
+                    any(command in self.commands.get(group, set()) for group in user_groups) or \
+                    key[1] in user_groups
+
+            self.decisions.setdefault(who, dict())[key] = rc
+
+            return rc
+
+    def _forget_decisions(self, who):
+        self.decisions.pop(who, None)
+
+        # 'who' may be a group: then its members are affected as well
+        for member in self.members.get(who, set()):
+            self.decisions.pop(member, None)
+
+    def add_acl(self, who, command):
+        with self.lock:
+            self._change(self._add_acl, who.lower(), command.lower())
+
+    def _add_acl(self, who, command):
+        self.commands.setdefault(who, set()).add(command)
+
+        self._forget_decisions(who)
+
+    def del_acl(self, who, command):
+        with self.lock:
+            self._change(self._del_acl, who.lower(), command.lower())
+
+    def _del_acl(self, who, command):
+        self.commands.get(who, set()).discard(command)
+
+        self._forget_decisions(who)
+
+    def group_add(self, who, group):
+        with self.lock:
+            self._change(self._group_add, who.lower(), group.lower())
+
+    def _group_add(self, who, group):
+        self.groups.setdefault(who, set()).add(group)
+        self.members.setdefault(group, set()).add(who)
+
+        self._forget_decisions(who)
+
+    def group_del(self, who, group):
+        with self.lock:
+            self._change(self._group_del, who.lower(), group.lower())
+
+    def _group_del(self, who, group):
+        self.groups.get(who, set()).discard(group)
+        self.members.get(group, set()).discard(who)
+
+        self._forget_decisions(who)
+
+    def add_alias(self, account, main_account):
+        with self.lock:
+            self._change(self._add_alias, account.lower(), main_account.lower())
+
+    def _add_alias(self, account, main_account):
+        self.aliasses[account] = main_account
+
+        self.decisions.pop(account, None)
+
+    def _matching(self, pattern):
+        # emulate 'who LIKE pattern' from the queries
+        regex = re.compile(''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern.lower()), re.DOTALL)
+
+        return [who for who in set(self.commands) | set(self.groups) if regex.fullmatch(who)]
+
+    # DELETE ... WHERE who LIKE pattern
+    def forget_like(self, pattern):
+        with self.lock:
+            self._change(self._forget_like, pattern)
+
+    def _forget_like(self, pattern):
+        for who in self._matching(pattern):
+            self.commands.pop(who, None)
+
+            for group in self.groups.pop(who, set()):
+                self.members.get(group, set()).discard(who)
+
+            self._forget_decisions(who)
+
+    # UPDATE ... SET who=new_who WHERE who LIKE pattern
+    def rename_like(self, pattern, new_who):
+        with self.lock:
+            self._change(self._rename_like, pattern, new_who.lower())
+
+    def _rename_like(self, pattern, new_who):
+        for who in self._matching(pattern):
+            if who == new_who:
+                continue
+
+            if who in self.commands:
+                self.commands.setdefault(new_who, set()).update(self.commands.pop(who))
+
+            if who in self.groups:
+                for group in self.groups[who]:
+                    self.members[group].discard(who)
+                    self.members[group].add(new_who)
+
+                self.groups.setdefault(new_who, set()).update(self.groups.pop(who))
+
+            self._forget_decisions(who)
+
+        self._forget_decisions(new_who)
+
+    def get_stats(self):
+        return { 'loaded': self.loaded, 'hits': self.hits, 'misses': self.misses, 'fallbacks': self.fallbacks, 'resyncs': self.resyncs }
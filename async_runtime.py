@@ -0,0 +1,451 @@
+#! /usr/bin/python3
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http_server import chunk_size, content_length, http_error, respond
+import os
+import paho.mqtt.client as mqtt
+import sys
+import threading
+import time
+import traceback
+
+
+# Same interface and statistics as dispatcher, but the workers are tasks
+# on the event loop. The ghbot handlers block (database, WHO) so they are
+# run in a thread pool; each worker awaits its handler before taking the
+# next item so the order per key is kept.
+class async_dispatcher:
+    class worker:
+        def __init__(self, handler, queue_size, executor):
+            self.handler   = handler
+            self.executor  = executor
+
+            self.q         = asyncio.Queue(maxsize=queue_size)
+
+            self.processed = 0
+            self.dropped   = 0
+            self.wait_sum  = 0.
+            self.wait_max  = 0.
+
+            self.task      = asyncio.get_running_loop().create_task(self.run())
+
+        async def run(self):
+            loop = asyncio.get_running_loop()
+
+            while True:
+                ts, args = await self.q.get()
+
+                wait = time.time() - ts
+
+                self.wait_sum += wait
+                self.wait_max  = max(self.wait_max, wait)
+
+                try:
+                    await loop.run_in_executor(self.executor, self.handler, *args)
+
+                except Exception as e:
+                    print(f'async_dispatcher::worker::run: exception "{e}" at line number: {e.__traceback__.tb_lineno}')
+
+                    traceback.print_exc(file=sys.stdout)
+
+                self.processed += 1
+
+        def get_stats(self):
+            return { 'depth': self.q.qsize(), 'processed': self.processed, 'dropped': self.dropped,
+                     'wait_avg': self.wait_sum / self.processed if self.processed > 0 else 0., 'wait_max': self.wait_max }
+
+    def __init__(self, handler, n_workers, queue_size, executor):
+        self.protocol = async_dispatcher.worker(handler, queue_size, executor)
+
+        self.workers  = [async_dispatcher.worker(handler, queue_size, executor) for i in range(n_workers)]
+
+    async def put(self, key, droppable, *args):
+        w = self.protocol if key is None else self.workers[hash(key) % len(self.workers)]
+
+        item = (time.time(), args)
+
+        if not droppable:
+            await w.q.put(item)
+
+            return True
+
+        try:
+            w.q.put_nowait(item)
+
+            return True
+
+        except asyncio.QueueFull:
+            w.dropped += 1
+
+        return False
+
+    def get_stats(self):
+        out = { 'protocol': self.protocol.get_stats() }
+
+        for i, w in enumerate(self.workers):
+            out[f'worker-{i}'] = w.get_stats()
+
+        return out
+
+# Stands in for the socket in ircbot.fd: send_now() is called from the
+# send_queue thread and from the loop itself. Like socket.sendall() it
+# raises when the data can't be written, so that send_now() sees a lost
+# connection: other threads wait for the loop to have written and drained
+# it (at most 'timeout' seconds, e.g. when the server stopped reading).
+class stream_socket:
+    timeout = 30.
+
+    def __init__(self, loop, writer):
+        self.loop        = loop
+        self.loop_thread = threading.get_ident()
+        self.writer      = writer
+
+    def _write(self, data):
+        if self.writer.is_closing():
+            raise ConnectionError('connection is closed')
+
+        self.writer.write(data)
+
+    async def _send(self, data):
+        self._write(data)
+
+        await self.writer.drain()
+
+    def sendall(self, data):
+        if threading.get_ident() == self.loop_thread:
+            self._write(data)
+
+        else:
+            asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result(stream_socket.timeout)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+# Runs the IRC connection, the dispatch of received lines, the MQTT client,
+# the HTTP server and the periodic jobs on one event loop. Selected with
+# "runtime = asyncio" in the [general] section; the objects passed in must
+# have been created with autostart=False. The command handlers are the same
+# as for the threaded runtime.
+class async_runtime:
+    def __init__(self, bot, http_port):
+        self.bot          = bot
+        self.http_port    = http_port
+
+        self.loop         = None
+        self.loop_thread  = None
+        self.executor     = None
+        self.dispatch_executor = None
+
+        self.state_change = None  # set when the bot changes state (see ircbot._set_state)
+        self.receiver     = None
+
+        self.lag_sum      = 0.
+        self.lag_max      = 0.
+        self.lag_n        = 0
+        self.n_tasks      = 0
+
+        bot.runtime = self
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        bot = self.bot
+
+        self.loop        = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+        # periodic jobs and HTTP requests
+        self.executor    = ThreadPoolExecutor(max_workers=10, thread_name_prefix='GHBot async')
+        self.loop.set_default_executor(self.executor)
+
+        # a thread for each dispatch worker and one for the protocol worker:
+        # workers that wait for a WHO reply can't starve the protocol worker
+        # that handles it (nor the jobs above)
+        self.dispatch_executor = ThreadPoolExecutor(max_workers=bot.dispatch_settings[0] + 1, thread_name_prefix='GHBot dispatch')
+
+        bot.dispatcher   = async_dispatcher(bot.handle_irc_command_thread_wrapper, bot.dispatch_settings[0], bot.dispatch_settings[1], self.dispatch_executor)
+
+        self.state_change = asyncio.Event()
+        self.loop.add_reader(bot.wakeup_r, self._woken)
+
+        self._mqtt_attach()
+
+        await asyncio.start_server(self._http_request, port=self.http_port, reuse_address=True)
+
+        print('async_runtime::main: Go!')
+
+        await asyncio.gather(self._irc(), self._mqtt_misc(), self._keepalive(), self._monitor(),
+                             self._every(4.9, bot._clean_plugins),
+                             self._every(0.5, bot.inflight.expire),
+                             self._every(bot.db.probe_interval, bot.db.probe),
+                             self._every(bot.acls.resync_interval, bot.acls.reload),
+                             self._every(bot.defines.check_interval, bot.defines.check),
+                             self._every(bot.local_plugins.watch_interval, bot.local_plugins.check))
+
+    def _woken(self):
+        try:
+            os.read(self.bot.wakeup_r, 4096)
+
+        except BlockingIOError as bioe:
+            pass
+
+        self.state_change.set()
+
+    async def _irc(self):
+        bot = self.bot
+
+        while True:
+            self.state_change.clear()
+
+            if bot.state == bot.session_state.DISCONNECTING:
+                bot.fd.close()
+
+                if self.receiver != None:
+                    self.receiver.cancel()
+
+                    self.receiver = None
+
+                bot._set_state(bot.session_state.DISCONNECTED)
+
+            elif bot.state == bot.session_state.DISCONNECTED:
+                # send_now() goes to DISCONNECTED right away when writing fails
+                if self.receiver != None:
+                    self.receiver.cancel()
+
+                    self.receiver = None
+
+                print(f'async_runtime::irc: connecting to [{bot.host}]:{bot.port}')
+
+                try:
+                    reader, writer = await asyncio.open_connection(bot.host, bot.port)
+
+                except Exception as e:
+                    print(f'async_runtime::irc: failed to connect: {e}')
+
+                    await asyncio.sleep(1)
+
+                    continue
+
+                bot.fd = stream_socket(self.loop, writer)
+
+                bot.reader.reset()
+
+                self.receiver = self.loop.create_task(self._receive(reader))
+
+                bot._set_state(bot.session_state.CONNECTED_PASS)
+
+            else:
+                bot._registration_step()
+
+            if bot.state != bot.session_state.DISCONNECTED and not self.state_change.is_set():
+                timeout = bot._poll_timeout()
+
+                try:
+                    await asyncio.wait_for(self.state_change.wait(), None if timeout == None else timeout / 1000)
+
+                except asyncio.TimeoutError as te:
+                    pass
+
+            bot._check_state_timeout()
+
+    async def _receive(self, reader):
+        bot = self.bot
+
+        while True:
+            try:
+                data = await reader.read(16384)
+
+            except Exception as e:
+                print(f'async_runtime::receive: cannot receive from irc-server: {e}')
+
+                data = b''
+
+            if data == b'':
+                if not bot.state in [ bot.session_state.DISCONNECTED, bot.session_state.DISCONNECTING ]:
+                    print('async_runtime::receive: connection to irc-server lost')
+
+                    bot._set_state(bot.session_state.DISCONNECTING)
+
+                return
+
+            for key, droppable, prefix, command, arguments in bot._parse_received(data):
+                # dropped lines are counted in the dispatcher statistics
+                await bot.dispatcher.put(key, droppable, prefix, command, arguments)
+
+    # paho is driven through its socket callbacks; publish() may be called
+    # from any thread
+    def _in_loop(self, function, *args):
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def _mqtt_attach(self):
+        client = self.bot.mqtt.client
+
+        client.on_socket_open             = lambda client, userdata, sock: self._in_loop(self.loop.add_reader, sock, client.loop_read)
+        client.on_socket_close            = lambda client, userdata, sock: self._in_loop(self.loop.remove_reader, sock)
+        client.on_socket_register_write   = lambda client, userdata, sock: self._in_loop(self.loop.add_writer, sock, client.loop_write)
+        client.on_socket_unregister_write = lambda client, userdata, sock: self._in_loop(self.loop.remove_writer, sock)
+
+        sock = client.socket()
+
+        if sock != None:
+            self.loop.add_reader(sock, client.loop_read)
+
+            if client.want_write():
+                self.loop.add_writer(sock, client.loop_write)
+
+    async def _mqtt_misc(self):
+        client = self.bot.mqtt.client
+
+        while True:
+            await asyncio.sleep(1)
+
+            if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                print('async_runtime::mqtt_misc: reconnecting to the broker')
+
+                try:
+                    client.reconnect()
+
+                except Exception as e:
+                    print(f'async_runtime::mqtt_misc: cannot reconnect: {e}')
+
+    # HTTP/1.1 connections are kept open until the client closes them or is
+    # idle for 'http_idle' seconds
+    http_idle = 30.
+
+    async def _http_request(self, reader, writer):
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), self.http_idle)
+
+                if line == b'':
+                    break
+
+                method, path, version = line.decode('latin-1').split()
+
+                headers = dict()
+
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+
+                    if line == '':
+                        break
+
+                    name, sep, value = line.partition(':')
+
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                try:
+                    body = await self._read_body(reader, headers, self.bot.ingest.max_bytes) if method == 'POST' else b''
+
+                    # the handlers may block (e.g. on locks), keep them off the loop
+                    code, out, body = await self.loop.run_in_executor(self.executor, respond, self.bot, method, path, headers, body)
+
+                except http_error as he:
+                    code, out, body = (he.code, [ ('Content-Type', 'text/html') ], bytes(str(he), 'utf8'))
+
+                    keep_alive = False
+
+            except asyncio.TimeoutError as te:
+                break
+
+            except Exception as e:
+                print(f'async_runtime::http_request: exception "{e}" at line number: {e.__traceback__.tb_lineno}')
+
+                code, out, body = (500, [ ('Content-Type', 'text/html') ], bytes('failed', 'utf8'))
+
+                keep_alive = False
+
+            header  = f'HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n'
+            header += ''.join(f'{name}: {value}\r\n' for name, value in out)
+            header += f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+
+            try:
+                writer.write(bytes(header, 'utf8') + body)
+
+                await writer.drain()
+
+            except Exception as e:
+                print(f'async_runtime::http_request: cannot send reply: {e}')
+
+                break
+
+            if not keep_alive:
+                break
+
+        writer.close()
+
+    # see http_requesthandler._read_body
+    async def _read_body(self, reader, headers, limit):
+        if headers.get('transfer-encoding', '').lower() != 'chunked':
+            return await reader.readexactly(content_length(headers, limit))
+
+        chunks = []
+        size   = 0
+
+        while True:
+            n = chunk_size(await reader.readline())
+
+            if n == 0:
+                # trailers
+                while not await reader.readline() in (b'\r\n', b'\n', b''):
+                    pass
+
+                return b''.join(chunks)
+
+            size += n
+
+            if size > limit:
+                raise http_error(413, 'too large')
+
+            chunks.append(await reader.readexactly(n))
+
+            await reader.readline()
+
+    async def _every(self, interval, function):
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                await self.loop.run_in_executor(self.executor, function)
+
+            except Exception as e:
+                print(f'async_runtime::every: {function.__name__} failed: {e}')
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(1)
+
+            last_ping = time.time() - self.bot.last_ping
+
+            if last_ping >= 600:
+                print(f'async_runtime::keepalive: no PING for {last_ping} seconds')
+
+                # tell systemd to restart the service
+                os._exit(1)
+
+    # measures how late the loop is in running a task that is due
+    async def _monitor(self):
+        while True:
+            start = time.time()
+
+            await asyncio.sleep(0.5)
+
+            lag = max(0., time.time() - start - 0.5)
+
+            self.lag_sum += lag
+            self.lag_max  = max(self.lag_max, lag)
+            self.lag_n   += 1
+
+            self.n_tasks  = len(asyncio.all_tasks())
+
+    def get_stats(self):
+        return { 'loop-lag-avg': self.lag_sum / self.lag_n if self.lag_n > 0 else 0., 'loop-lag-max': self.lag_max, 'tasks': self.n_tasks }
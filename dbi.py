@@ -1,12 +1,27 @@
 #! /usr/bin/python3
 
+from contextlib import contextmanager
+import metrics
 import MySQLdb
 import threading
 import time
 
 
+# Small pool of MySQL connections. Connections are health-checked when
+# they are checked out after having been idle for a while, so callers do
+# not need to probe before each query. When all 'pool_size' connections are
+# in use, checkout() waits for one to come back or for a slot to free up
+# (a broken connection that is discarded), at most 'checkout_timeout'
+# seconds.
 class dbi(threading.Thread):
-    def __init__(self, host, user, password, database):
+    check_after      = 10.  # ping a connection that has been idle for this many seconds
+    probe_interval   = 29.
+    checkout_timeout = 10.
+
+    # CR_SERVER_GONE_ERROR, CR_SERVER_LOST, CR_SERVER_LOST_EXTENDED: the connection is broken
+    connection_lost  = (2006, 2013, 2055)
+
+    def __init__(self, host, user, password, database, pool_size=4, autostart=True):
         super().__init__()
 
         self.host = host
@@ -14,11 +29,17 @@ class dbi(threading.Thread):
         self.password = password
         self.database = database
 
+        self.pool_size = pool_size
+        self.n_connections = 0  # including the ones being set up
+        self.idle = []  # (connection, last used), most recently used last
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)  # a connection was checked in or discarded
+
+        self.reconnects = 0
+
         while True:
             try:
-                self.reconnect()
-
-                self.probe()
+                self.checkin(self._connect_reserved())
 
                 break
 
@@ -27,41 +48,212 @@ class dbi(threading.Thread):
 
                 time.sleep(1)
 
-        self.name = 'GHBot MySQL'
-        self.start()
+        # else the owner calls probe() every probe_interval seconds
+        if autostart:
+            self.name = 'GHBot MySQL'
+            self.start()
 
-    def reconnect(self):
-        try:
-            self.db = MySQLdb.connect(self.host, self.user, self.password, self.database, charset="utf8mb4", use_unicode=True)
+    def _connect(self):
+        db = MySQLdb.connect(self.host, self.user, self.password, self.database, charset="utf8mb4", use_unicode=True)
+
+        cursor = db.cursor()
+
+        cursor.execute('SET NAMES utf8mb4')
+        cursor.execute("SET CHARACTER SET utf8mb4")
+        cursor.execute("SET character_set_connection=utf8mb4")
+
+        cursor.close()
 
-            cursor = self.db.cursor()
+        return db
 
-            cursor.execute('SET NAMES utf8mb4')
-            cursor.execute("SET CHARACTER SET utf8mb4")
-            cursor.execute("SET character_set_connection=utf8mb4")
+    # the slot is taken before connecting so that the pool can't grow past
+    # 'pool_size' while connections are being set up
+    def _connect_reserved(self):
+        with self.lock:
+            self.n_connections += 1
 
-            cursor.close()
+        try:
+            return self._connect()
 
         except Exception as e:
-            print(f'dbi::reconnect: exception "{e}" at line number: {e.__traceback__.tb_lineno}')
+            self._release()
 
-    def probe(self):
+            raise
+
+    def _release(self):
+        with self.cond:
+            self.n_connections -= 1
+
+            self.cond.notify()
+
+    def _discard(self, db):
         try:
-            cursor = self.db.cursor()
+            db.close()
+
+        except Exception as e:
+            pass
+
+        self._release()
+
+    @staticmethod
+    def _is_connection_lost(e):
+        return isinstance(e, MySQLdb.OperationalError) and len(e.args) > 0 and e.args[0] in dbi.connection_lost
+
+    def checkout(self):
+        deadline = time.time() + dbi.checkout_timeout
+
+        while True:
+            with self.cond:
+                while len(self.idle) == 0 and self.n_connections >= self.pool_size:
+                    left = deadline - time.time()
+
+                    if left <= 0:
+                        raise TimeoutError(f'dbi::checkout: no connection available within {dbi.checkout_timeout} seconds')
+
+                    self.cond.wait(left)
+
+                if len(self.idle) > 0:
+                    db, last_used = self.idle.pop()
+
+                else:
+                    db = None
+
+                    self.n_connections += 1
+
+            if db == None:
+                try:
+                    return self._connect()
+
+                except Exception as e:
+                    self._release()
+
+                    raise
+
+            if time.time() - last_used < dbi.check_after:
+                return db
+
+            try:
+                db.ping()
+
+                return db
+
+            except Exception as e:
+                print(f'dbi::checkout: MySQL indicated error: {e}')
+
+                self._discard(db)
 
-            cursor.execute('SELECT NOW(), VERSION()')
+                self.reconnects += 1
 
-            cursor.fetchone()
+    def checkin(self, db):
+        with self.cond:
+            self.idle.append((db, time.time()))
 
-            cursor.close()
+            self.cond.notify()
+
+    # yields a cursor, commits when the block finishes without exception
+    @contextmanager
+    def transaction(self):
+        db = self.checkout()
+
+        try:
+            with db.cursor() as cursor:
+                yield cursor
+
+            db.commit()
 
         except Exception as e:
-            print(f'dbi::probe: MySQL indicated error: {e}')
+            if self._is_connection_lost(e):
+                self._discard(db)
+
+                raise
+
+            # e.g. a deadlock: the connection itself is fine
+            try:
+                db.rollback()
+
+                self.checkin(db)
+
+            except Exception as re:
+                self._discard(db)
+
+            raise
+
+        else:
+            self.checkin(db)
+
+    # runs 'function' with a cursor, retries once on a fresh connection
+    # when the connection turned out to be broken; statements that change
+    # something ('idempotent' False) only when they were not handed to the
+    # server yet, else they could be applied twice
+    def _with_retry(self, function, idempotent):
+        for attempt in range(2):
+            started = False
+
+            try:
+                with self.transaction() as cursor:
+                    started = True
+
+                    return function(cursor)
+
+            except MySQLdb.OperationalError as e:
+                if attempt == 1 or not self._is_connection_lost(e) or (started and not idempotent):
+                    raise
+
+                print(f'dbi::_with_retry: retrying after "{e}"')
+
+                self.reconnects += 1
+
+    @metrics.timed('ghbot_db_query_seconds', (('kind', 'query'),))
+    def query(self, sql, args=None):
+        def function(cursor):
+            cursor.execute(sql, args)
+
+            return cursor.fetchall()
+
+        return self._with_retry(function, True)
+
+    # returns (affected rows, last insert id)
+    @metrics.timed('ghbot_db_query_seconds', (('kind', 'execute'),))
+    def execute(self, sql, args=None):
+        def function(cursor):
+            cursor.execute(sql, args)
+
+            return (cursor.rowcount, cursor.lastrowid)
+
+        return self._with_retry(function, False)
+
+    @metrics.timed('ghbot_db_query_seconds', (('kind', 'executemany'),))
+    def executemany(self, sql, args):
+        def function(cursor):
+            cursor.executemany(sql, args)
+
+            return cursor.rowcount
+
+        return self._with_retry(function, False)
+
+    def probe(self):
+        # keep idle connections alive; checkout() pings them when needed
+        with self.lock:
+            connections = [ db for db, last_used in self.idle ]
+
+            self.idle.clear()
+
+        for db in connections:
+            try:
+                db.ping()
+
+                self.checkin(db)
+
+            except Exception as e:
+                print(f'dbi::probe: MySQL indicated error: {e}')
+
+                self._discard(db)
 
-            self.reconnect()
+    def get_stats(self):
+        return { 'connections': self.n_connections, 'idle': len(self.idle), 'pool_size': self.pool_size, 'reconnects': self.reconnects }
 
     def run(self):
         while True:
             self.probe()
 
-            time.sleep(29)
+            time.sleep(dbi.probe_interval)
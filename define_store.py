@@ -0,0 +1,148 @@
+#! /usr/bin/python3
+
+from define_template import define_template
+import random
+import threading
+import time
+
+
+# In-process copy of the aliasses table, keyed by (command, is_command).
+# Defines are compiled into templates when they're loaded or added.
+# Other bot instances may change the table as well: (COUNT(*), MAX(nr)) is
+# used as a change-version and the table is reloaded when it differs.
+class define_store(threading.Thread):
+    def __init__(self, db, check_interval, autostart=True):
+        super().__init__(daemon=True)
+
+        self.db             = db
+        self.check_interval = check_interval
+
+        self.lock           = threading.Lock()
+
+        self.by_key         = dict()  # (command, is_command) -> { nr: (replacement_text, template) }
+        self.by_nr          = dict()  # nr -> (command, is_command)
+
+        self.version        = None
+
+        self.listeners      = []  # told about defines that are added or deleted
+
+        self.reloads        = 0
+
+        while not self.reload():
+            time.sleep(1)
+
+        # else the owner calls check() every check_interval seconds
+        if autostart:
+            self.name = 'GHBot defines'
+            self.start()
+
+    def _get_version(self):
+        rows = self.db.query('SELECT COUNT(*), MAX(nr) FROM aliasses')
+
+        return (rows[0][0], rows[0][1])
+
+    def _local_version(self):
+        return (len(self.by_nr), max(self.by_nr) if len(self.by_nr) > 0 else None)
+
+    def reload(self):
+        by_key = dict()
+        by_nr  = dict()
+
+        try:
+            version = self._get_version()
+
+            for row in self.db.query('SELECT nr, command, is_command, replacement_text FROM aliasses'):
+                key = (row[1].lower(), bool(row[2]))
+
+                by_key.setdefault(key, dict())[row[0]] = (row[3], None if key[1] else define_template.compile(row[3]))
+                by_nr[row[0]] = key
+
+        except Exception as e:
+            print(f'define_store::reload: failed to load defines: {e}')
+
+            return False
+
+        with self.lock:
+            for listener in self.listeners:
+                for nr in by_nr.keys() - self.by_nr.keys():
+                    listener.define_added(nr, by_nr[nr][0], by_nr[nr][1], by_key[by_nr[nr]][nr][0])
+
+                for nr in self.by_nr.keys() - by_nr.keys():
+                    listener.define_deleted(nr, self.by_nr[nr][0], self.by_nr[nr][1])
+
+            self.by_key   = by_key
+            self.by_nr    = by_nr
+
+            self.version  = version
+
+            self.reloads += 1
+
+        return True
+
+    def check(self):
+        try:
+            if self._get_version() != self.version:
+                print('define_store::check: aliasses table changed, reloading')
+
+                self.reload()
+
+        except Exception as e:
+            print(f'define_store::check: cannot check version: {e}')
+
+    def run(self):
+        while True:
+            time.sleep(self.check_interval)
+
+            self.check()
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+            for nr, key in self.by_nr.items():
+                listener.define_added(nr, key[0], key[1], self.by_key[key][nr][0])
+
+    # returns up to 'limit' randomly ordered (is_command, replacement_text, template) tuples
+    # template is None for aliasses and for defines that could not be compiled
+    def lookup(self, command, is_command, limit=100):
+        with self.lock:
+            entries = self.by_key.get((command.lower(), bool(is_command)))
+
+            if entries == None:
+                return []
+
+            texts = list(entries.values())
+
+        return [(is_command, text, template) for text, template in random.sample(texts, min(limit, len(texts)))]
+
+    def add(self, nr, command, is_command, text):
+        key      = (command.lower(), bool(is_command))
+
+        template = None if key[1] else define_template.compile(text)
+
+        with self.lock:
+            self.by_key.setdefault(key, dict())[nr] = (text, template)
+            self.by_nr[nr] = key
+
+            for listener in self.listeners:
+                listener.define_added(nr, key[0], key[1], text)
+
+            self.version = self._local_version()
+
+    def delete(self, nr):
+        with self.lock:
+            key = self.by_nr.pop(nr, None)
+
+            if key != None:
+                del self.by_key[key][nr]
+
+                if len(self.by_key[key]) == 0:
+                    del self.by_key[key]
+
+                for listener in self.listeners:
+                    listener.define_deleted(nr, key[0], key[1])
+
+            self.version = self._local_version()
+
+    def get_stats(self):
+        return { 'defines': len(self.by_nr), 'commands': len(self.by_key), 'reloads': self.reloads }
@@ -0,0 +1,208 @@
+#! /usr/bin/python3
+
+import random
+import re
+import time
+
+
+# in the order in which they're applied
+colours = (('%h:none', '\003'), ('%h:white', '\0030'), ('%h:black', '\0031'), ('%h:blue', '\0032'),
+           ('%h:green', '\0033'), ('%h:red', '\0034'), ('%h:brown', '\0035'), ('%h:purple', '\0036'),
+           ('%h:orange', '\0037'), ('%h:yellow', '\0038'), ('%h:light-green', '\0039'), ('%h:cyan', '\00310'),
+           ('%h:light-cyan', '\00311'), ('%h:light-blue', '\00312'), ('%h:pink', '\00313'), ('%h:grey', '\00314'),
+           ('%h:light-grey', '\00315'))
+
+longest_escape = max(len(c[0]) for c in colours)
+
+# per-invocation escapes, in the order in which they're applied
+fields = 'uUqQdDeEcCr'
+
+placeholders = { name: chr(0xe000 + i) for i, name in enumerate('R' + fields) }
+
+placeholder_re = re.compile('([\ue000-\ue0ff])')
+
+
+def escapes(text):
+    if '%R' in text:
+        text = text.replace('%R', f'{random.randint(0, 100)}')
+
+    if '%m' in text:
+        text = text.strip('%m')
+
+        text = '\001ACTION ' + text.strip() + '\001'
+
+    return text
+
+# the original sequence of replacements; 'nick' is the nick of the invoker
+# returns (text, is_notice)
+def expand_legacy(is_command, repl_text, query_text, nick, channel):
+    if is_command:  # initially only replaces command
+        text = repl_text + ' ' + query_text
+
+    else:
+        text = repl_text
+
+    text = escapes(text)
+
+    if nick != None:
+        text = text.replace('%u', nick)
+        text = text.replace('%U', nick.upper())
+
+    if len(query_text) > 0:
+        text = text.replace('%q', query_text)
+        text = text.replace('%Q', query_text.upper())
+
+        text = text.replace('%d', query_text.split()[0])
+        text = text.replace('%D', query_text.split()[0].upper())
+
+        qt_space = query_text.find(' ')
+        if qt_space != -1:
+            temp = query_text[qt_space+1:].strip()
+            text = text.replace('%e', temp)
+            text = text.replace('%E', temp.upper())
+
+    text = text.replace('%c', channel)
+    text = text.replace('%C', channel.upper())
+
+    text = text.replace('%r', nick)  # TODO previously this was a random user
+
+    if '%h' in text:
+        for escape, code in colours:
+            text = text.replace(escape, code)
+
+    notice = False
+
+    if '%n' in text:
+        text = text.replace('%n', '')
+
+        notice = True
+
+    return (text, notice)
+
+# Values for one invocation, shared by all templates expanded for it.
+# Returns None when a value contains something that could be picked up by
+# one of the later replacements: then only expand_legacy gives the same
+# output.
+def template_values(query_text, nick, channel):
+    if nick == None or '%' in nick or '%' in query_text or '%' in channel:
+        return None
+
+    values = { 'u': nick, 'U': nick.upper(), 'c': channel, 'C': channel.upper(), 'r': nick,
+               'q': '%q', 'Q': '%Q', 'd': '%d', 'D': '%D', 'e': '%e', 'E': '%E' }
+
+    if len(query_text) > 0:
+        words = query_text.split()
+
+        if len(words) == 0:
+            return None
+
+        values['q'] = query_text
+        values['Q'] = query_text.upper()
+        values['d'] = words[0]
+        values['D'] = words[0].upper()
+
+        qt_space = query_text.find(' ')
+        if qt_space != -1:
+            temp = query_text[qt_space+1:].strip()
+            values['e'] = temp
+            values['E'] = temp.upper()
+
+    return values
+
+class define_template:
+    __slots__ = ('fmt', 'has_random', 'is_notice')
+
+    def __init__(self, fmt, has_random, is_notice):
+        self.fmt        = fmt
+        self.has_random = has_random
+        self.is_notice  = is_notice
+
+    # returns None when the text cannot be compiled (expand_legacy must be used)
+    @staticmethod
+    def compile(text):
+        if placeholder_re.search(text):
+            return None
+
+        has_random = '%R' in text
+
+        text = text.replace('%R', placeholders['R'])
+
+        if '%m' in text:
+            text = '\001ACTION ' + text.strip('%m').strip() + '\001'
+
+        for name in fields:
+            text = text.replace('%' + name, placeholders[name])
+
+        if '%h' in text:
+            for escape, code in colours:
+                text = text.replace(escape, code)
+
+        is_notice = '%n' in text
+
+        text = text.replace('%n', '')
+
+        chunks = placeholder_re.split(text)
+
+        # a '%' right before a value could combine with it into an escape
+        for i in range(1, len(chunks), 2):
+            if chunks[i] != placeholders['R'] and '%' in chunks[i - 1][-longest_escape:]:
+                return None
+
+        names = { v: k for k, v in placeholders.items() }
+
+        fmt = ''.join('{' + names[chunk] + '}' if i & 1 else chunk.replace('{', '{{').replace('}', '}}') for i, chunk in enumerate(chunks))
+
+        return define_template(fmt, has_random, is_notice)
+
+    # returns (text, is_notice)
+    def expand(self, values):
+        if self.has_random:
+            values['R'] = f'{random.randint(0, 100)}'
+
+        return (self.fmt.format_map(values), self.is_notice)
+
+if __name__ == "__main__":
+    # micro-benchmark: expand a large define table both ways and check
+    # that the results are identical
+    words = [ 'hello', '%u', '%U', '%q', '%Q', '%d', '%D', '%e', '%E', '%c', '%C', '%r', '%R', '%n', '%h:red', '%h:light-green', '%h:none', 'world', '{x}', '100%', 'to' ]
+
+    random.seed(1)
+
+    table = []
+
+    for i in range(10000):
+        text = ' '.join(random.choice(words) for j in range(random.randint(1, 12)))
+
+        if i % 10 == 0:
+            text = '%m ' + text
+
+        table.append(text)
+
+    compiled = [define_template.compile(text) for text in table]
+
+    print(f'{len([c for c in compiled if c == None])} of {len(table)} defines need the legacy path')
+
+    invocations = [ ('', 'nick', '#channel'), ('some query text', 'Folkert', '#test'), ('one', 'x', '#y') ]
+
+    for query_text, nick, channel in invocations:
+        random.seed(2)
+
+        start = time.time()
+
+        legacy = [expand_legacy(False, text, query_text, nick, channel) for text in table]
+
+        t_legacy = time.time() - start
+
+        random.seed(2)
+
+        start = time.time()
+
+        values = template_values(query_text, nick, channel)
+
+        fast = [expand_legacy(False, text, query_text, nick, channel) if c == None else c.expand(values) for text, c in zip(table, compiled)]
+
+        t_fast = time.time() - start
+
+        assert legacy == fast
+
+        print(f'query "{query_text}": legacy {t_legacy * 1000:.2f} ms, compiled {t_fast * 1000:.2f} ms ({t_legacy / t_fast:.1f}x)')
@@ -0,0 +1,87 @@
+#! /usr/bin/python3
+
+import queue
+import sys
+import threading
+import time
+import traceback
+
+
+# Fixed set of worker threads, each with its own bounded queue. Work items
+# with the same ordering key always end up in the same queue so they are
+# handled in the order they were received. Key None is reserved for the
+# protocol worker (PING, numerics, membership changes).
+class dispatcher:
+    class worker(threading.Thread):
+        def __init__(self, name, handler, queue_size):
+            super().__init__(daemon=True)
+
+            self.handler   = handler
+
+            self.q         = queue.Queue(maxsize=queue_size)
+
+            self.processed = 0
+            self.dropped   = 0
+            self.wait_sum  = 0.
+            self.wait_max  = 0.
+
+            self.name      = name
+            self.start()
+
+        def run(self):
+            while True:
+                ts, args = self.q.get()
+
+                wait = time.time() - ts
+
+                self.wait_sum += wait
+                self.wait_max  = max(self.wait_max, wait)
+
+                try:
+                    self.handler(*args)
+
+                except Exception as e:
+                    print(f'dispatcher::worker::run: exception "{e}" at line number: {e.__traceback__.tb_lineno}')
+
+                    traceback.print_exc(file=sys.stdout)
+
+                self.processed += 1
+
+        def get_stats(self):
+            return { 'depth': self.q.qsize(), 'processed': self.processed, 'dropped': self.dropped,
+                     'wait_avg': self.wait_sum / self.processed if self.processed > 0 else 0., 'wait_max': self.wait_max }
+
+    def __init__(self, handler, n_workers, queue_size):
+        self.protocol = dispatcher.worker('GHBot dispatch protocol', handler, queue_size)
+
+        self.workers  = [dispatcher.worker(f'GHBot dispatch {i}', handler, queue_size) for i in range(n_workers)]
+
+    # droppable items are discarded when the queue is full, the others
+    # block the caller (and thus the reader) until there's room
+    def put(self, key, droppable, *args):
+        w = self.protocol if key is None else self.workers[hash(key) % len(self.workers)]
+
+        item = (time.time(), args)
+
+        if not droppable:
+            w.q.put(item)
+
+            return True
+
+        try:
+            w.q.put_nowait(item)
+
+            return True
+
+        except queue.Full:
+            w.dropped += 1
+
+        return False
+
+    def get_stats(self):
+        out = { 'protocol': self.protocol.get_stats() }
+
+        for i, w in enumerate(self.workers):
+            out[f'worker-{i}'] = w.get_stats()
+
+        return out
@@ -0,0 +1,88 @@
+#! /usr/bin/python3
+
+import itertools
+import json
+import os
+import time
+
+try:
+    import msgpack
+
+except ImportError as ie:
+    msgpack = None
+
+try:
+    import cbor2
+
+except ImportError as ie:
+    cbor2 = None
+
+
+# Versioned envelope for the structured bot <-> plugin topics:
+#   from/irc-v1/<channel>/<command>  bot -> plugins: what happened on IRC
+#   to/irc-v1/<channel>/<kind>       plugins -> bot: privmsg, notice, topic or mode
+#   to/bot/register-v1               plugins -> bot: { cmd, descr, agrp, hgrp, athr, loc, testament }
+#   to/bot/unregister-v1             plugins -> bot: { commands: [ ... ] }
+#   to/bot/register-bulk-v1          plugins -> bot: { plugin, testament, commands: [ { cmd, descr, ... }, ... ] }
+#   to/bot/heartbeat-v1              plugins -> bot: { plugin }, refreshes all commands of 'plugin'
+# <channel> is the channel name without '#' or '\' followed by a nick for
+# private messages. The prefix (nick!user@host) is in the envelope and
+# not in the topic. A reply carries the id of what it replies to.
+version = 1
+
+codecs = ('json', 'msgpack', 'cbor')
+
+_ids = itertools.count(1)
+_id_prefix = f'{os.getpid():x}{int(time.time()):x}'
+
+def next_id():
+    return f'{_id_prefix}-{next(_ids):x}'
+
+def available(codec):
+    return codec == 'json' or (codec == 'msgpack' and msgpack != None) or (codec == 'cbor' and cbor2 != None)
+
+def make(channel, prefix, command, text, id=None):
+    return { 'v': version, 'channel': channel, 'prefix': prefix, 'command': command, 'ts': time.time(), 'id': id or next_id(), 'text': text }
+
+def encode(envelope, codec):
+    if codec == 'msgpack':
+        return msgpack.packb(envelope)
+
+    if codec == 'cbor':
+        return cbor2.dumps(envelope)
+
+    return json.dumps(envelope).encode('utf-8')
+
+# returns None for anything that is not a version 1 envelope
+def decode(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+
+    try:
+        if payload[0:1] == b'{':
+            envelope = json.loads(payload.decode('utf-8'))
+
+        elif msgpack != None and (0x80 <= payload[0] <= 0x8f or payload[0] in (0xde, 0xdf)):
+            envelope = msgpack.unpackb(payload)
+
+        elif cbor2 != None and 0xa0 <= payload[0] <= 0xbf:
+            envelope = cbor2.loads(payload)
+
+        else:
+            return None
+
+    except Exception as e:
+        return None
+
+    if not isinstance(envelope, dict) or envelope.get('v') != version:
+        return None
+
+    return envelope
+
+# topic level for a channel ('#test' -> 'test') or a nick ('bla' -> '\bla')
+def channel_level(channel):
+    return channel[1:] if channel[0] == '#' else '\\' + channel
+
+# the reverse of channel_level
+def level_channel(level):
+    return level[1:] if level[0] == '\\' else '#' + level
@@ -1,16 +1,26 @@
 #! /usr/bin/python3
 
+from acl_cache import acl_cache
 import configparser
 from dbi import dbi
-import difflib
+from define_store import define_store
+from define_template import escapes, expand_legacy, template_values
 from enum import Enum
+import envelope
 from http_server import http_server
+from inflight import inflight_tracker
 from ircbot import ircbot, irc_keepalive
+import logging
 import math
+from message_ingest import message_ingest
+import metrics
 from mqtt_handler import mqtt_handler
-import nltk
 from plugin_handler import plugins_class
-import random
+from plugin_registry import plugin_registry
+from send_queue import send_queue
+from search import memory_define_search, mysql_define_search, plugin_search
+from suggestions import suggestion_index
+from topic_router import topic_router
 import select
 import socket
 import sys
@@ -26,81 +36,100 @@ class ghbot(ircbot):
         ERROR        = 0x10
         NOT_INTERNAL = 0xff
 
-    def __init__(self, host, port, nick, password, channels, m, db, cmd_prefix, local_plugin_subdir, use_notice, owner, rl_settings):
-        super().__init__(host, port, nick, password, channels, use_notice, owner)
+    def __init__(self, host, port, nick, password, channels, m, db, acls, defines, define_search, cmd_prefix, local_plugin_subdir, use_notice, owner, rl_settings, dispatch_settings, flood_settings, envelope_settings=(None, True), inflight_settings=(30., False), plugin_settings=(60., 5.), isolation_settings=(dict(), 2), who_settings=(300., False), post_settings=(dict(), 1048576, 1000, 100., 2.), autostart=True):
+        super().__init__(host, port, nick, password, channels, use_notice, owner, dispatch_settings, flood_settings, who_settings, autostart)
+
+        # codec for from/irc-v1/... (None: don't publish those), publish the from/irc/... topics as well
+        self.envelope_codec = envelope_settings[0]
+        self.legacy_topics  = envelope_settings[1]
+
+        # seconds to wait for a plugin reply, tell the user when it did not come
+        self.inflight        = inflight_tracker(inflight_settings[0], self._request_timed_out, autostart)
+        self.inflight_notify = inflight_settings[1]
 
         self.cmd_prefix    = cmd_prefix
 
         self.db            = db
+        self.acls          = acls
+        self.defines       = defines
+        self.define_search = define_search
 
         self.mqtt          = m
         self.rl_settings   = rl_settings
 
-        self.plugins       = dict()
-        self.plugins_lock  = threading.Lock()
-        self.plugins_gone  = dict()
+        # seconds after which a plugin that didn't refresh is forgotten, plugins spread
+        # their registrations over this many seconds when the bot asks for them
+        self.plugins       = plugin_registry(plugin_settings[0])
+        self.reg_jitter    = plugin_settings[1]
+
+        # local plugins that run in worker processes ({ name: timeout }, processes per plugin)
+        self.local_plugins = plugins_class(self, local_plugin_subdir, 'ghb_', isolation_settings, autostart=autostart)
 
-        self.local_plugins = plugins_class(self, local_plugin_subdir, 'ghb_')
+        # messages posted via HTTP: tokens ({ name: token }, none: no authentication),
+        # max request size in bytes, max messages per request, rate limit per token (burst, per second)
+        self.ingest        = message_ingest(self, post_settings[0], post_settings[1], post_settings[2], post_settings[3], post_settings[4])
 
-        now                = time.time()
+        # for /metrics; the counters and histograms are updated where things happen
+        metrics.gauge('ghbot_plugins', lambda: { (('state', 'registered'),): len(self.plugins), (('state', 'gone'),): len(self.plugins.get_gone()) }, 'Commands known and commands that stopped working')
+        metrics.gauge('ghbot_threads', threading.active_count, 'Live threads')
 
         here = socket.gethostname()
-        #                          v make these into dictionaries v  TODO
-        self.plugins['addacl']   = ['Add an ACL, format: addacl user|group <user|group> group|cmd <group-name|cmd-name>', 'sysops', now, 'root', here, 'acls']
-        self.plugins['delacl']   = ['Remove an ACL, format: delacl <user> group|cmd <group-name|cmd-name>', 'sysops', now, 'root', here, 'acls']
-        self.plugins['listacls'] = ['List all ACLs for a user or group', 'sysops', now, 'root', here, 'acls']
-        self.plugins['deluser']  = ['Forget a person; removes all ACLs for that nick', 'sysops', now, 'root', here, 'acls']
-        self.plugins['clone']    = ['Clone ACLs from one user to another', 'sysops', now, 'root', here, 'acls']
-        self.plugins['meet']     = ['Use this when a user (nick) has a new hostname: meet <nick>', 'sysops', now, 'root', here, 'acls']
-        self.plugins['merge']    = ['Use this to add a host-alias for an existing user (nick): merge <new-nick> <old-nick>', 'sysops', now, 'root', here, 'acls']
-        self.plugins['commands'] = ['Show list of known commands', None, now, 'root', here, 'help']
-        self.plugins['help']     = ['Help for commands, parameter is the command to get help for', None, now, 'root', here, 'help']
-        self.plugins['more']     = ['Continue outputting a too long line of text', None, now, 'root', here, None]
-        self.plugins['next']     = ['Execute next command from a list', None, now, 'root', here, None]
-        self.plugins['define']   = ['Define a command that will be replied to with a definable text, format: !define <command> <text... with %m (/me), %q (parameters) and %u (nick of invoker) escapes, %n for notice>', None, now, 'root', here, 'defines']
-        self.plugins['deldefine']= ['Delete a define (by number)', None, now, 'root', here, 'defines']
-        self.plugins['alias']    = ['Add a different name for a command, format: !alias <newname> <oldname>', None, now, 'root', here, 'defines']
-        self.plugins['searchdefine'] = ['Search for defines that match a partial text', None, now, 'root', here, 'defines']
-        self.plugins['searchalias'] = ['Search for aliases that match a partial text', None, now, 'root', here, 'defines']
-        self.plugins['viewalias'] = ['Show what an alias is doing', None, now, 'root', here, 'defines']
-        self.plugins['listgroups']= ['Shows a list of available groups', 'sysops', now, 'root', here, 'acls']
-        self.plugins['showgroup']= ['Shows a list of commands or members in a group (showgroup commands|members <groupname>)', 'sysops', now, 'root', here, 'acls']
-        self.plugins['apro']     = ['Show commands that match a partial text', None, now, 'root', here, 'help']
-        self.plugins['reloadlp'] = ['Reload a "local" plugin', 'sysops', now, 'root', here, None]
-        self.plugins['listlp']   = ['List "local" plugins', 'sysops', now, 'root', here, None]
-        self.plugins['showlp']   = ['Show commands of a "local" plugin', 'sysops', now, 'root', here, None]
-        self.plugins['loadlp']   = ['Load "local" plugins that are not loaded yet', 'sysops', now, 'root', here, None]
-        self.plugins['helpgroups'] = ['Show a list of all help-groups there are; a help-group is usually per-plugin', None, now, 'root', here, 'help']
-        self.plugins['showhelpgroup'] = ['Show plugins in a help-group', None, now, 'root', here, 'help']
-        self.plugins['setnick']   = ['change the nick of the bot', 'sysops', now, 'folkert', here, None]
+        self.plugins.add('addacl', 'Add an ACL, format: addacl user|group <user|group> group|cmd <group-name|cmd-name>', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('delacl', 'Remove an ACL, format: delacl <user> group|cmd <group-name|cmd-name>', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('listacls', 'List all ACLs for a user or group', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('deluser', 'Forget a person; removes all ACLs for that nick', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('clone', 'Clone ACLs from one user to another', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('meet', 'Use this when a user (nick) has a new hostname: meet <nick>', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('merge', 'Use this to add a host-alias for an existing user (nick): merge <new-nick> <old-nick>', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('commands', 'Show list of known commands', None, 'root', here, 'help', hardcoded=True)
+        self.plugins.add('help', 'Help for commands, parameter is the command to get help for', None, 'root', here, 'help', hardcoded=True)
+        self.plugins.add('more', 'Continue outputting a too long line of text', None, 'root', here, None, hardcoded=True)
+        self.plugins.add('next', 'Execute next command from a list', None, 'root', here, None, hardcoded=True)
+        self.plugins.add('define', 'Define a command that will be replied to with a definable text, format: !define <command> <text... with %m (/me), %q (parameters) and %u (nick of invoker) escapes, %n for notice>', None, 'root', here, 'defines', hardcoded=True)
+        self.plugins.add('deldefine', 'Delete a define (by number)', None, 'root', here, 'defines', hardcoded=True)
+        self.plugins.add('alias', 'Add a different name for a command, format: !alias <newname> <oldname>', None, 'root', here, 'defines', hardcoded=True)
+        self.plugins.add('searchdefine', 'Search for defines that match a partial text', None, 'root', here, 'defines', hardcoded=True)
+        self.plugins.add('searchalias', 'Search for aliases that match a partial text', None, 'root', here, 'defines', hardcoded=True)
+        self.plugins.add('viewalias', 'Show what an alias is doing', None, 'root', here, 'defines', hardcoded=True)
+        self.plugins.add('listgroups', 'Shows a list of available groups', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('showgroup', 'Shows a list of commands or members in a group (showgroup commands|members <groupname>)', 'sysops', 'root', here, 'acls', hardcoded=True)
+        self.plugins.add('apro', 'Show commands that match a partial text', None, 'root', here, 'help', hardcoded=True)
+        self.plugins.add('reloadlp', 'Reload a "local" plugin', 'sysops', 'root', here, None, hardcoded=True)
+        self.plugins.add('listlp', 'List "local" plugins', 'sysops', 'root', here, None, hardcoded=True)
+        self.plugins.add('showlp', 'Show commands of a "local" plugin', 'sysops', 'root', here, None, hardcoded=True)
+        self.plugins.add('loadlp', 'Load "local" plugins that are not loaded yet', 'sysops', 'root', here, None, hardcoded=True)
+        self.plugins.add('helpgroups', 'Show a list of all help-groups there are; a help-group is usually per-plugin', None, 'root', here, 'help', hardcoded=True)
+        self.plugins.add('showhelpgroup', 'Show plugins in a help-group', None, 'root', here, 'help', hardcoded=True)
+        self.plugins.add('setnick', 'change the nick of the bot', 'sysops', 'folkert', here, None, hardcoded=True)
         self.prio_plugins = ('help', 'helpgroups', 'showhelpgroup')
 
-        self.hardcoded_plugins = set()
-        for p in self.plugins:
-            self.hardcoded_plugins.add(p)
+        # "did you mean" index over commands, defines and aliasses
+        self.suggestions = suggestion_index()
 
-        self.mqtt_plugins_with_testament = set()
+        # substring search over plugin names and descriptions
+        self.plugin_search = plugin_search()
 
         for local_plugin in self.local_plugins.list_plugins():  # iterate over each plugin .py-file
             all_commands = self.local_plugins.get_commandos(local_plugin)
 
             for command, parameters in all_commands:  # iterate over each command that a plugin can have
                 # they're hardcoded; don't allow to override
-                self.hardcoded_plugins.add(command)
-                # register in the plugin-list
-                self.plugins[command] = parameters
+                self.plugins.add(*self._local_command(command, parameters), hardcoded=True)
+
+        for record in self.plugins.snapshot():
+            self.suggestions.add(record.command)
+
+            self.plugin_search.set(record.command, record.descr)
 
-        self.topic_privmsg = []
-        self.topic_notice  = []
-        self.topic_topic   = []
+        self.defines.add_listener(self.suggestions)
+
+        # topics (without the mqtt prefix) that _recv_msg_cb acts on
+        self.router = topic_router()
 
         self.topic_to_nick = f'to/irc-person/'
         
         for channel in self.channels:
-           self.topic_privmsg.append(f'to/irc/{channel[1:]}/privmsg')  # Send reply in channel via PRIVMSG
-           self.topic_notice.append(f'to/irc/{channel[1:]}/notice')   # Send reply in channel via NOTICE
-           self.topic_topic.append(f'to/irc/{channel[1:]}/topic')    # Sets TOPIC for channel
-    
+           self.router.add_channel(channel, self._route_privmsg, self._route_notice, self._route_topic)
 
         self.topic_register = f'to/bot/register'  # topic where plugins announce themselves
         self.topic_register_t = f'to/bot/register-testament'  # topic where plugins announce themselves, with testament e.g. don't need constantly refresh
@@ -108,6 +137,30 @@ class ghbot(ircbot):
 
         self.topic_request = f'to/bot/request'  # topic where plugins request bot-actions
 
+        self.router.add(self.topic_request, self._route_request, (), 'control')
+        self.router.add(self.topic_register, self._register_plugin, (True,), 'control')
+        self.router.add(self.topic_register_t, self._register_plugin, (False,), 'control')
+        self.router.add(self.topic_unregister, self._unregister_plugin, (), 'control')
+        self.router.add('to/bot/register-bulk/+', self._register_bulk, (), 'control')  # all commands of a plugin at once
+        self.router.add('to/bot/heartbeat', self._plugin_heartbeat, (), 'control')
+
+        self.router.add(self.topic_to_nick + '+', self._route_to_nick)
+        self.router.add(self.topic_to_nick + '+/mode', self._route_mode, (), 'command')
+        self.router.add(self.topic_to_nick + '+/#', self._route_to_nick)
+
+        self.router.add('to/irc/+', self._route_pm)  # to/irc/\nick
+        self.router.add('to/irc/+/mode', self._route_mode, (), 'command')
+        self.router.add('to/irc/+/#', self._route_pm)
+
+        # structured variants, see envelope.py
+        self.router.add('to/irc-v1/+/+', self._route_v1_irc)
+        self.router.add('to/bot/register-v1', self._route_v1_register, (), 'control')
+        self.router.add('to/bot/unregister-v1', self._route_v1_unregister, (), 'control')
+        self.router.add('to/bot/register-bulk-v1', self._route_v1_register_bulk, (), 'control')
+        self.router.add('to/bot/heartbeat-v1', self._route_v1_heartbeat, (), 'control')
+
+        self.mqtt.set_classifier(self._topic_class)
+
         self.mqtt.subscribe(self.topic_request, self._recv_msg_cb)
         self.mqtt.subscribe("GHBot/from/irc/#", self._recv_msg_cb)
 
@@ -121,13 +174,19 @@ class ghbot(ircbot):
         #    self.mqtt.subscribe(topic, self._recv_msg_cb)
 
         self.mqtt.subscribe('to/irc/#', self._recv_msg_cb)  # required for pm-commands :-/
-        self.pm_topic = 'to/irc/\\'  # to match on
-
         self.mqtt.subscribe(self.topic_to_nick + '#', self._recv_msg_cb)
 
         self.mqtt.subscribe(self.topic_register, self._recv_msg_cb)
         self.mqtt.subscribe(self.topic_register_t, self._recv_msg_cb)
         self.mqtt.subscribe(self.topic_unregister, self._recv_msg_cb)
+        self.mqtt.subscribe('to/bot/register-bulk/+', self._recv_msg_cb)
+        self.mqtt.subscribe('to/bot/heartbeat', self._recv_msg_cb)
+
+        self.mqtt.subscribe('to/irc-v1/#', self._recv_envelope_cb, raw=True)
+        self.mqtt.subscribe('to/bot/register-v1', self._recv_envelope_cb, raw=True)
+        self.mqtt.subscribe('to/bot/unregister-v1', self._recv_envelope_cb, raw=True)
+        self.mqtt.subscribe('to/bot/register-bulk-v1', self._recv_envelope_cb, raw=True)
+        self.mqtt.subscribe('to/bot/heartbeat-v1', self._recv_envelope_cb, raw=True)
 
         self.host        = host
         self.port        = port
@@ -139,70 +198,66 @@ class ghbot(ircbot):
         self.state       = self.session_state.DISCONNECTED
         self.state_since = time.time()
 
-        self.users       = dict()
         self.user_rl     = dict()  # rate limiting
         self.user_rl_mentioned = dict()  # rate limiting
 
-        self.name = 'GHBot IRC'
-        self.start()
+        self.runtime = None  # set by the asyncio runtime
 
-        self.plugin_cleaner = threading.Thread(target=self._plugin_cleaner)
-        self.plugin_cleaner.start()
+        # with autostart False, async_runtime runs the connection and the timers
+        if autostart:
+            self.name = 'GHBot IRC'
+            self.start()
+
+            self.plugin_cleaner = threading.Thread(target=self._plugin_cleaner)
+            self.plugin_cleaner.start()
 
         # ask plugins to register themselves so that we know which
-        # commands are available (and what they're for etc.)
+        # commands are available (and what they're for etc.); plugins that
+        # know the register-jitter parameter wait a random part of it first
+        self._plugin_parameter('register-jitter', str(self.reg_jitter), True)
+
         self._plugin_command('register')
 
         self._plugin_parameter('prefix', self.cmd_prefix, True)
 
-    # checks how old the the latest registration of a plugin is.
-    # too old? (10 seconds) then forget the plugin-command.
+    # forgets plugin-commands of which the latest registration is too old
+    # (60 seconds); the registry only looks at the ones that are due
     def _plugin_cleaner(self):
         while True:
-            try:
-                time.sleep(4.9)
-
-                to_delete = []
+            time.sleep(4.9)
 
-                now       = time.time()
+            self._clean_plugins()
 
-                self.plugins_lock.acquire()
-
-                for plugin in self.plugins:
-                    if now - self.plugins[plugin][2] >= 60. and plugin not in self.hardcoded_plugins and not plugin in self.mqtt_plugins_with_testament:  # 5 seconds timeout
-                        to_delete.append(plugin)
+    def _clean_plugins(self):
+        try:
+            for plugin in self.plugins.expire():
+                print(f'_clean_plugins: {plugin} was not refreshed, forgetting it')
 
-                for plugin in to_delete:
-                    del self.plugins[plugin]
-                    self.plugins_gone[plugin] = now
+                self.suggestions.remove(plugin)
 
-                self.plugins_lock.release()
+                self.plugin_search.remove(plugin)
 
-            except Exception as e:
-                print(f'_plugin_cleaner: failed to clean: {e}')
+        except Exception as e:
+            print(f'_plugin_cleaner: failed to clean: {e}')
 
     def _plugin_command(self, cmd):
         print("MQTT publish: from/bot/command > " + str(cmd))
-        self.mqtt.publish('from/bot/command', cmd, persistent=False)
+        self.mqtt.publish('from/bot/command', cmd, persistent=False, topic_class='control')
 
     def _plugin_parameter(self, key, value, persistent):
-        self.mqtt.publish(f'from/bot/parameter/{key}', value, persistent=persistent)
+        self.mqtt.publish(f'from/bot/parameter/{key}', value, persistent=persistent, topic_class='control')
 
     def _unregister_plugin(self, msg):
         commands = msg.split(',')
 
-        now = time.time()
-
         for cmd in commands:
-            if not cmd in self.hardcoded_plugins:
-                del self.plugins[cmd]
-                if cmd in self.plugins_gone:
-                    del self.plugins_gone[cmd]
-                    self.plugins_gone[cmd] = now
+            if self.plugins.remove(cmd):
+                self.suggestions.remove(cmd)
 
-    def _register_plugin(self, msg, with_refresh):
-        self.plugins_lock.acquire()
+                self.plugin_search.remove(cmd)
 
+    # cmd=...|descr=...|agrp=...|hgrp=...|athr=...|loc=...
+    def _parse_registration(self, msg):
         try:
             elements = msg.split('|')
 
@@ -234,280 +289,416 @@ class ghbot(ircbot):
                 elif k == 'loc':
                     location = v
 
-            if cmd != None:
-                if not cmd in self.hardcoded_plugins:
-                    if not cmd in self.plugins:
-                        print(f'_register_plugin: first announcement of {cmd}')
+        except Exception as e:
+            print(f'_register_plugin: problem while processing plugin registration "{msg}": {e}')
 
-                    self.plugins[cmd] = [descr, acl_group, time.time(), athr, location, help_group]
+            return None
 
-                    if cmd in self.plugins_gone:
-                        del self.plugins_gone[cmd]
+        return (cmd, descr, acl_group, help_group, athr, location)
 
-                    if not with_refresh:
-                        self.mqtt_plugins_with_testament.add(cmd)
+    def _register_plugin(self, msg, with_refresh):
+        registration = self._parse_registration(msg)
 
-                else:
-                    print(f'_register_plugin: cannot override "hardcoded" plugin ({cmd})')
+        if registration != None:
+            self._add_plugin(*registration, with_refresh)
 
-            else:
-                print(f'_register_plugin: cmd missing in plugin registration')
+    # to/bot/register-bulk/<plugin>: one registration per line
+    def _register_bulk(self, msg, plugin):
+        for line in msg.splitlines():
+            registration = self._parse_registration(line) if line.strip() != '' else None
 
-        except Exception as e:
-            print(f'_register_plugin: problem while processing plugin registration "{msg}": {e}')
+            if registration != None:
+                self._add_plugin(*registration, True, plugin)
+
+    # to/bot/heartbeat: the name of a plugin that registered in bulk
+    def _plugin_heartbeat(self, msg):
+        plugin = msg.strip()
+
+        if not self.plugins.heartbeat(plugin):
+            print(f'_plugin_heartbeat: {plugin} has no commands registered')
+
+    # parameters: [descr, acl_group, ts, athr, location(, help_group)]
+    def _local_command(self, command, parameters):
+        return (command, parameters[0], parameters[1], parameters[3], parameters[4], parameters[5] if len(parameters) >= 6 else None)
+
+    # called by plugins_class when a local plugin was (re)loaded or removed
+    def _local_commands_changed(self, old_commands, new_commands):
+        entries = [ self._local_command(command, parameters) for command, parameters in new_commands ]
+
+        self.plugins.replace(old_commands, entries)
+
+        for command in old_commands:
+            self.suggestions.remove(command)
+
+            self.plugin_search.remove(command)
 
-        self.plugins_lock.release()
+        for entry in entries:
+            self.suggestions.add(entry[0])
+
+            self.plugin_search.set(entry[0], entry[1])
+
+    def _add_plugin(self, cmd, descr, acl_group, help_group, athr, location, with_refresh, plugin=None):
+        if cmd == None:
+            print(f'_register_plugin: cmd missing in plugin registration')
+
+            return
+
+        rc = self.plugins.add(cmd, descr, acl_group, athr, location, help_group, expires=with_refresh, plugin=plugin)
+
+        if rc == plugin_registry.add_rc.REFUSED:
+            print(f'_register_plugin: cannot override "hardcoded" plugin ({cmd})')
+
+        elif rc != plugin_registry.add_rc.HEARTBEAT:
+            if rc == plugin_registry.add_rc.ADDED:
+                print(f'_register_plugin: first announcement of {cmd}')
+
+                self.suggestions.add(cmd)
+
+            self.plugin_search.set(cmd, descr)
+
+    # to/bot/register-v1
+    def _route_v1_register(self, e):
+        help_group = e.get('hgrp')
+
+        self._add_plugin(e.get('cmd'), e.get('descr', ''), e.get('agrp'), help_group.lower() if help_group else None,
+                         e.get('athr', ''), e.get('loc', ''), not e.get('testament', False))
+
+    # to/bot/register-bulk-v1: { 'plugin': ..., 'testament': ..., 'commands': [ registration, ... ] }
+    def _route_v1_register_bulk(self, e):
+        plugin       = e.get('plugin')
+        with_refresh = not e.get('testament', False)
+
+        for r in e.get('commands', []):
+            help_group = r.get('hgrp')
+
+            self._add_plugin(r.get('cmd'), r.get('descr', ''), r.get('agrp'), help_group.lower() if help_group else None,
+                             r.get('athr', ''), r.get('loc', ''), with_refresh, plugin)
+
+    # to/bot/heartbeat-v1
+    def _route_v1_heartbeat(self, e):
+        self._plugin_heartbeat(e.get('plugin', ''))
+
+    # to/bot/unregister-v1
+    def _route_v1_unregister(self, e):
+        self._unregister_plugin(','.join(e.get('commands', [])))
+
+    # to/irc-v1/<channel>/<kind>
+    def _route_v1_irc(self, e, level, kind):
+        text = e.get('text')
+
+        if not isinstance(text, str) or text.find('\n') != -1 or text.find('\r') != -1:
+            print(f'irc::_route_v1_irc: invalid text in envelope for {level}/{kind}')
+
+            return
+
+        target = envelope.level_channel(level)
+
+        if kind == 'privmsg':
+            self.inflight.reply(e.get('id'))
+
+            self.send_ok(target, self.escapes(text), send_queue.BROADCAST)
+
+        elif kind == 'notice':
+            self.inflight.reply(e.get('id'))
+
+            self.send_notice(target, text, send_queue.BROADCAST)
+
+        elif kind == 'topic':
+            self.send(f'TOPIC {target} :{text}', send_queue.BROADCAST)
+
+        elif kind == 'mode':
+            self.send(f'MODE {target} {text}', send_queue.BROADCAST)
+
+        else:
+            print(f'irc::_route_v1_irc: invalid kind {kind}')
 
     def _send_topics_to_plugins(self):
         for channel in self.topics:
-            self.mqtt.publish(f'from/irc/{channel}/topic', self.topics[channel])
+            self._publish_irc(f'from/irc/{channel}/topic', f'#{channel}', '', 'topic', self.topics[channel], 'state')
 
-    def _recv_msg_cb(self, topic, msg):
-        try:
-            #print(f'irc::_recv_msg_cb: received "{msg}" for topic {topic}')
+    # 'id' is None when the command did not go out in an envelope (see inflight.py)
+    def command_dispatched(self, id, command, channel):
+        if id != None:
+            self.inflight.add(id, command, channel)
 
-            topic = topic[len(self.mqtt.get_topix_prefix()):]
-            parts = topic.split('/')
+    def _request_timed_out(self, command, channel):
+        print(f'irc::_request_timed_out: no reply for {command} in {channel}')
 
-            if msg.find('\n') != -1 or msg.find('\r') != -1:
-                print(f'irc::_recv_msg_cb: invalid content to send for {topic}')
-                return
+        if self.inflight_notify:
+            self.send_notice(channel, f'"{command}" did not reply (yet), the plugin may be slow or gone')
 
-            if topic in self.topic_privmsg:
-                self.send_ok('#' + parts[2], self.escapes(msg))
+    def _route_privmsg(self, msg, channel):
+        self.send_ok(channel, self.escapes(msg), send_queue.BROADCAST)
 
-            elif topic in self.topic_notice:
-                self.send_notice('#' + parts[2], msg)
+    def _route_notice(self, msg, channel):
+        self.send_notice(channel, msg, send_queue.BROADCAST)
 
-            elif topic in self.topic_topic:
-                self.send(f'TOPIC #{parts[2]} :{msg}')
+    def _route_topic(self, msg, channel):
+        self.send(f'TOPIC {channel} :{msg}', send_queue.BROADCAST)
 
-            elif topic in self.topic_request:
-                print(f'plugin requested {msg}')
-                if msg == 'topics':
-                    self._send_topics_to_plugins()
+    def _route_request(self, msg):
+        print(f'plugin requested {msg}')
+        if msg == 'topics':
+            self._send_topics_to_plugins()
 
-            elif topic in self.topic_register:
-                self._register_plugin(msg, True)
+    # to/irc-person/<channel>/mode and to/irc/<channel>/mode
+    def _route_mode(self, msg, channel):
+        self.send(f'MODE #{channel} {msg}', send_queue.BROADCAST)
 
-            elif topic in self.topic_register_t:
-                self._register_plugin(msg, False)
+    def _route_to_nick(self, msg, nick, rest=None):
+        if rest != None and rest.split('/')[-1].lower() == 'mode':
+            return self._route_mode(msg, nick)
 
-            elif topic in self.topic_unregister:
-                self._unregister_plugin(msg)
+        if nick[0] == '\\':
+            nick = nick[1:]
 
-            elif parts[0] + '/' + parts[1] in self.topic_to_nick:
-                if parts[-1].lower() == 'mode':
-                    self.send(f'MODE #{parts[2]} {msg}')
+        self.send_ok(nick, msg, send_queue.BROADCAST)
 
-                else:
-                    nick = parts[2]
+    # to/irc/\<nick>[/...]: private message
+    def _route_pm(self, msg, target, rest=None):
+        if rest != None and rest.split('/')[-1].lower() == 'mode':
+            return self._route_mode(msg, target)
 
-                    if nick[0] == '\\':
-                        nick = nick[1:]
+        if target[0] != '\\':
+            print(f'irc::_route_pm: {target} is not a channel the bot is in, nor a nick')
 
-                    self.send_ok(nick, msg)
+            return
 
-            elif self.pm_topic in topic:
-                nick = parts[2][1:]  # remove '\'
+        self.send_ok(target[1:], msg, send_queue.BROADCAST)
 
-                self.send_ok(nick, msg)
+    # from the user store or else via WHO; None when not known. The value
+    # that WHO returns is used as is: the user store may not have it (a
+    # cached WHO reply sends nothing, and it keeps fewer detached users)
+    def _hostmask_of(self, nick):
+        hostmask = self.users.hostmask(nick)
 
-            else:
+        return hostmask if hostmask != None else self.who.wait(nick)
+
+    # for the metrics of incoming MQTT messages
+    def _topic_class(self, topic):
+        return self.router.classify(topic[len(self.mqtt.get_topix_prefix()):])
+
+    # to/irc-v1/... and to/bot/(un)register-v1, see envelope.py
+    def _recv_envelope_cb(self, topic, payload):
+        try:
+            topic = topic[len(self.mqtt.get_topix_prefix()):]
+
+            e = envelope.decode(payload)
+
+            if e == None:
+                print(f'irc::_recv_envelope_cb: invalid envelope for {topic}')
+
+                return
+
+            route = self.router.resolve(topic)
+
+            if route == None:
+                print(f'irc::_recv_envelope_cb: invalid topic {topic}')
+
+                return
+
+            handler, parameters = route
+
+            handler(e, *parameters)
+
+        except Exception as e:
+            print(f'irc::_recv_envelope_cb: exception {e} while processing {topic} (at line number: {e.__traceback__.tb_lineno})')
+
+    def _recv_msg_cb(self, topic, msg):
+        try:
+            #print(f'irc::_recv_msg_cb: received "{msg}" for topic {topic}')
+
+            topic = topic[len(self.mqtt.get_topix_prefix()):]
+
+            if msg.find('\n') != -1 or msg.find('\r') != -1:
+                print(f'irc::_recv_msg_cb: invalid content to send for {topic}')
+                return
+
+            route = self.router.resolve(topic)
+
+            if route == None:
                 print(f'irc::_recv_msg_cb: invalid topic {topic}')
 
                 return
 
+            handler, parameters = route
+
+            handler(msg, *parameters)
+
         except Exception as e:
             print(f'irc::_recv_msg_cb: exception {e} while processing {topic}|{msg} (at line number: {e.__traceback__.tb_lineno})')
 
     def check_acl_alias(self, who):
-        with self.db.db.cursor() as cursor:
-            # see if this is an alias, then if so: pick main address
-            cursor.execute('SELECT main_account FROM account_aliasses WHERE account=%s', (who.lower(),))
+        if self.acls.loaded:
+            return self.acls.resolve_alias(who)
 
-            row = cursor.fetchone()
+        # see if this is an alias, then if so: pick main address
+        rows = self.db.query('SELECT main_account FROM account_aliasses WHERE account=%s', (who.lower(),))
 
-            if row != None:
-                who = row[0].lower()
+        if len(rows) > 0:
+            who = rows[0][0].lower()
 
-                print(f'Using ACL {who}')
+            print(f'Using ACL {who}')
 
-            return who
+        return who
 
+    # the latency is kept per command for commands that are known only, so
+    # that typos don't each get a series of their own
     def check_acls(self, who, command):
-        self.plugins_lock.acquire()
+        start  = time.perf_counter()
 
-        # "no group" is for everyone
-        if command in self.plugins and self.plugins[command][1] == None:
-            self.plugins_lock.release()
-
-            return (True, None)
+        record = self.plugins.get(command)
 
-        plugin_group = self.plugins[command][1]
+        try:
+            return self._check_acls(who, command, record)
 
-        self.plugins_lock.release()
+        finally:
+            metrics.observe('ghbot_acl_check_seconds', (('command', command if record != None else '(unknown)'),), time.perf_counter() - start)
 
-        self.db.probe()  # to prevent those pesky "sever has gone away" problems
+    def _check_acls(self, who, command, record):
+        # "no group" is for everyone
+        if record != None and record.acl_group == None:
+            return (True, None)
 
-        with self.db.db.cursor() as cursor:
-            who = self.check_acl_alias(who)
+        plugin_group = record.acl_group if record != None else None
 
-            # check per user ACLs (can override group as defined in plugin)
-            cursor.execute('SELECT COUNT(*) FROM acls WHERE command=%s AND who=%s', (command.lower(), who.lower()))
+        rc = self.acls.check(who, command, plugin_group)
 
-            row = cursor.fetchone()
+        if rc != None:
+            return (rc, plugin_group)
 
-            if row[0] >= 1:
-                return (True, plugin_group)
+        who = self.check_acl_alias(who)
 
-            # check per group ACLs (can override group as defined in plugin)
-            cursor.execute('SELECT COUNT(*) FROM acls, acl_groups WHERE acl_groups.who=%s AND acl_groups.group_name=acls.who AND command=%s', (who.lower(), command.lower()))
+        # check per user ACLs (can override group as defined in plugin)
+        rows = self.db.query('SELECT COUNT(*) FROM acls WHERE command=%s AND who=%s', (command.lower(), who.lower()))
 
-            row = cursor.fetchone()
+        if rows[0][0] >= 1:
+            return (True, plugin_group)
 
-            if row[0] >= 1:
-                return (True, plugin_group)
+        # check per group ACLs (can override group as defined in plugin)
+        rows = self.db.query('SELECT COUNT(*) FROM acls, acl_groups WHERE acl_groups.who=%s AND acl_groups.group_name=acls.who AND command=%s', (who.lower(), command.lower()))
 
-            # check if user is in group as specified by plugin
-            cursor.execute('SELECT COUNT(*) FROM acl_groups WHERE group_name=%s AND who=%s', (plugin_group, who.lower()))
+        if rows[0][0] >= 1:
+            return (True, plugin_group)
 
-            row = cursor.fetchone()
+        # check if user is in group as specified by plugin
+        rows = self.db.query('SELECT COUNT(*) FROM acl_groups WHERE group_name=%s AND who=%s', (plugin_group, who.lower()))
 
-            if row[0] >= 1:
-                return (True, plugin_group)
+        if rows[0][0] >= 1:
+            return (True, plugin_group)
 
-            return (False, plugin_group)
+        return (False, plugin_group)
 
     def list_acls(self, who):
-        self.db.probe()
-
-        with self.db.db.cursor() as cursor:
-            who = self.check_acl_alias(who)
-
-            cursor.execute('SELECT DISTINCT item FROM (SELECT command AS item FROM acls WHERE who=%s UNION SELECT group_name AS item FROM acl_groups WHERE who=%s) AS in_ ORDER BY item', (who.lower(), who.lower()))
-
-            out = []
+        who = self.check_acl_alias(who)
 
-            for row in cursor:
-                out.append(row[0])
+        rows = self.db.query('SELECT DISTINCT item FROM (SELECT command AS item FROM acls WHERE who=%s UNION SELECT group_name AS item FROM acl_groups WHERE who=%s) AS in_ ORDER BY item', (who.lower(), who.lower()))
 
-            return out
+        return [row[0] for row in rows]
 
     def add_acl(self, who, command):
-        self.db.probe()
-
-        with self.db.db.cursor() as cursor:
-            who = self.check_acl_alias(who)
+        who = self.check_acl_alias(who)
 
-            try:
-                cursor.execute('INSERT INTO acls(command, who) VALUES(%s, %s)', (command.lower(), who.lower()))
+        try:
+            self.db.execute('INSERT INTO acls(command, who) VALUES(%s, %s)', (command.lower(), who.lower()))
 
-                self.db.db.commit()
+            self.acls.add_acl(who, command)
 
-                return (True, 'Ok')
+            return (True, 'Ok')
 
-            except Exception as e:
-                return (False, f'irc::add_acl: failed to insert acl ({e})')
+        except Exception as e:
+            return (False, f'irc::add_acl: failed to insert acl ({e})')
 
     def del_acl(self, who, command):
-        self.db.probe()
+        who = self.check_acl_alias(who)
 
-        with self.db.db.cursor() as cursor:
-            who = self.check_acl_alias(who)
+        try:
+            rowcount, lastrowid = self.db.execute('DELETE FROM acls WHERE command=%s AND who=%s LIMIT 1', (command.lower(), who.lower()))
 
-            try:
-                cursor.execute('DELETE FROM acls WHERE command=%s AND who=%s LIMIT 1', (command.lower(), who.lower()))
+            if rowcount == 0:
+                return (False, 'That command/nick combination was not known')
 
-                self.db.db.commit()
+            # LIMIT 1: a duplicate row still grants it
+            rows = self.db.query('SELECT COUNT(*) FROM acls WHERE command=%s AND who=%s', (command.lower(), who.lower()))
 
-                if cursor.rowcount == 1:
-                    return (True, 'Ok')
+            if rows[0][0] == 0:
+                self.acls.del_acl(who, command)
 
-                return (False, 'That command/nick combination was not known')
+            return (True, 'Ok')
 
-            except Exception as e:
-                return (False, f'irc::del_acl: failed to delete acl ({e})')
+        except Exception as e:
+            return (False, f'irc::del_acl: failed to delete acl ({e})')
 
     def forget_acls(self, who):
         match_ = who + '!%'
 
-        with self.db.db.cursor() as cursor:
-            who = self.check_acl_alias(who)
-
-            try:
+        try:
+            with self.db.transaction() as cursor:
                 cursor.execute('DELETE FROM acls WHERE who LIKE %s', (match_,))
                 any_del = cursor.rowcount == 1
 
                 cursor.execute('DELETE FROM acl_groups WHERE who LIKE %s', (match_,))
                 any_del |= cursor.rowcount == 1
 
-                self.db.db.commit()
+            self.acls.forget_like(match_)
 
-                if any_del:
-                    return (True, 'Ok')
+            if any_del:
+                return (True, 'Ok')
 
-                return (False, 'No acls found for that nick')
+            return (False, 'No acls found for that nick')
 
-            except Exception as e:
-                return (False, f'irc::forget_acls: failed to forget acls for {match_}: {e}')
+        except Exception as e:
+            return (False, f'irc::forget_acls: failed to forget acls for {match_}: {e}')
 
     def clone_acls(self, from_, to_):
-        with self.db.db.cursor() as cursor:
-            who = self.check_acl_alias(who)
+        who = self.check_acl_alias(who)
 
-            try:
+        try:
+            with self.db.transaction() as cursor:
                 cursor.execute('SELECT group_name FROM acl_groups WHERE who=%s', (from_,))
 
                 for row in cursor.fetchall():
                     cursor.execute('INSERT INTO acl_groups(group_name, who) VALUES(%s, %s)', (row, to_))
 
-                self.db.db.commit()
+            return (True, 'Ok')
 
-                return (True, 'Ok')
-
-            except Exception as e:
-                return (False, f'failed to clone acls: {e}')
+        except Exception as e:
+            return (False, f'failed to clone acls: {e}')
 
     def merge_nick(self, new_nick, old_nick):
-        with self.db.db.cursor() as cursor:
-            if '%' in old_nick or '%' in new_nick:
-                return (False, 'haxxxor')
+        if '%' in old_nick or '%' in new_nick:
+            return (False, 'haxxxor')
 
-            match_ = old_nick if '!' in old_nick else (old_nick + '!%')
+        match_ = old_nick if '!' in old_nick else (old_nick + '!%')
 
-            try:
-                cursor.execute('SELECT who FROM acl_groups WHERE who LIKE %s GROUP BY who', (match_,))
-
-                rows = cursor.fetchall()
+        try:
+            rows = self.db.query('SELECT who FROM acl_groups WHERE who LIKE %s GROUP BY who', (match_,))
 
-                if len(rows) == 0:
-                    return (False, f'Old user ({old_nick}) is not known')
+            if len(rows) == 0:
+                return (False, f'Old user ({old_nick}) is not known')
 
-                if len(rows) > 1:
-                    full_names = [row[0] for row in rows]
+            if len(rows) > 1:
+                full_names = [row[0] for row in rows]
 
-                    return (False, f'Old user ({old_nick}) is ambiguous: {", ".join(full_names)}')
+                return (False, f'Old user ({old_nick}) is ambiguous: {", ".join(full_names)}')
 
-                print(rows, new_nick)
+            print(rows, new_nick)
 
-                cursor.execute('INSERT INTO account_aliasses(main_account, account) VALUES(%s, %s)', (rows[0][0], new_nick.lower()))
+            self.db.execute('INSERT INTO account_aliasses(main_account, account) VALUES(%s, %s)', (rows[0][0], new_nick.lower()))
 
-                self.db.db.commit()
+            self.acls.add_alias(new_nick, rows[0][0])
 
-                return (True, 'Ok')
+            return (True, 'Ok')
 
-            except Exception as e:
-                return (False, f'failed to add alias: {e}, {e.__traceback__.tb_lineno}')
+        except Exception as e:
+            return (False, f'failed to add alias: {e}, {e.__traceback__.tb_lineno}')
 
     # new_fullname is the new 'nick!user@host'
     def update_acls(self, who, new_fullname):
-        self.db.probe()
-
         match_ = who + '!%'
 
-        with self.db.db.cursor() as cursor:
-            try:
+        try:
+            with self.db.transaction() as cursor:
                 cursor.execute('UPDATE acls SET who=%s WHERE who LIKE %s', (new_fullname, match_))
 
                 any_upd = cursor.rowcount == 1
@@ -516,83 +707,64 @@ class ghbot(ircbot):
 
                 any_upd |= cursor.rowcount == 1
 
-                self.db.db.commit()
+            self.acls.rename_like(match_, new_fullname)
 
-                if any_upd:
-                    return (True, 'Ok')
+            if any_upd:
+                return (True, 'Ok')
 
-                return (False, 'No such user')
+            return (False, 'No such user')
 
-            except Exception as e:
-                return (False, f'irc::update_acls: failed to update acls ({e})')
+        except Exception as e:
+            return (False, f'irc::update_acls: failed to update acls ({e})')
 
     def group_add(self, who, group):
-        self.db.probe()
-
         who = self.check_acl_alias(who)
 
-        with self.db.db.cursor() as cursor:
-            try:
-                cursor.execute('INSERT INTO acl_groups(who, group_name) VALUES(%s, %s)', (who.lower(), group.lower()))
+        try:
+            self.db.execute('INSERT INTO acl_groups(who, group_name) VALUES(%s, %s)', (who.lower(), group.lower()))
 
-                self.db.db.commit()
+            self.acls.group_add(who, group)
 
-                return (True, 'Ok')
+            return (True, 'Ok')
 
-            except Exception as e:
-                return (False, f'irc::group_add: failed to insert group-member ({e})')
+        except Exception as e:
+            return (False, f'irc::group_add: failed to insert group-member ({e})')
 
     def group_del(self, who, group):
-        self.db.probe()
-
         who = self.check_acl_alias(who)
 
-        with self.db.db.cursor() as cursor:
-            try:
-                cursor.execute('DELETE FROM acl_groups WHERE who=%s AND group_name=%s LIMIT 1', (who.lower(), group.lower()))
-
-                self.db.db.commit()
-
-                if cursor.rowcount == 1:
-                    return (True, 'Ok')
+        try:
+            rowcount, lastrowid = self.db.execute('DELETE FROM acl_groups WHERE who=%s AND group_name=%s LIMIT 1', (who.lower(), group.lower()))
 
+            if rowcount == 0:
                 return (False, 'That user/group combination was not known')
 
-            except Exception as e:
-                return (False, f'irc::group-del: failed to delete group-member ({e}, {e.__traceback__.tb_lineno})')
-
-    def check_user_known(self, user):
-        if '!' in user:
-            for cur_user in self.users:
-                if self.users[cur_user] == user:
-                    return True
+            # LIMIT 1: a duplicate row still makes it a member
+            rows = self.db.query('SELECT COUNT(*) FROM acl_groups WHERE who=%s AND group_name=%s', (who.lower(), group.lower()))
 
-            return False
+            if rows[0][0] == 0:
+                self.acls.group_del(who, group)
 
-        if not user in self.users:
-            return False
+            return (True, 'Ok')
 
-        if self.users[user] == None or self.users[user] == '?':
-            return False
+        except Exception as e:
+            return (False, f'irc::group-del: failed to delete group-member ({e}, {e.__traceback__.tb_lineno})')
 
-        return True
+    # nick or nick!user@host
+    def check_user_known(self, user):
+        return self.users.known(user)
 
     def is_group(self, group):
-        self.db.probe()
-
-        with self.db.db.cursor() as cursor:
-            try:
-                cursor.execute('SELECT COUNT(*) FROM acl_groups WHERE group_name=%s LIMIT 1', (group.lower(), ))
-
-                row = cursor.fetchone()
+        try:
+            rows = self.db.query('SELECT COUNT(*) FROM acl_groups WHERE group_name=%s LIMIT 1', (group.lower(), ))
 
-                if row[0] >= 1:
-                    return True
+            if rows[0][0] >= 1:
+                return True
 
-            except Exception as e:
-                send_notice(self.owner, f'irc::is_group: failed to query database for group {group} ({e})')
+        except Exception as e:
+            send_notice(self.owner, f'irc::is_group: failed to query database for group {group} ({e})')
 
-            return False
+        return False
 
     # e.g. 'group', 'bla' where 'group' is the key and 'bla' the value
     def find_key_in_list(self, list_, item, search_start):
@@ -608,24 +780,8 @@ class ghbot(ircbot):
 
         return idx
 
-    def invoke_who_and_wait(self, user):
-        self.send(f'WHO {user}')
-
-        start = time.time()
-
-        while self.check_user_known(user) == False:
-            t_diff = time.time() - start
-
-            if t_diff >= 5.0:
-                break
-
-            with self.cond_352:
-                self.cond_352.wait(5.0 - t_diff)
-
     def list_plugins(self):
-        self.plugins_lock.acquire()
-        plugins = sorted(self.plugins)
-        self.plugins_lock.release()
+        plugins = self.plugins.commands()
 
         for prio in self.prio_plugins:
             plugins.remove(prio)
@@ -633,210 +789,98 @@ class ghbot(ircbot):
         return ', '.join(list(self.prio_plugins) + plugins)
 
     def add_define(self, command, is_alias, arguments):
-        self.db.probe()
-
-        with self.db.db.cursor() as cursor:
-            try:
-                cursor.execute('INSERT INTO aliasses(command, is_command, replacement_text) VALUES(%s, %s, %s)', (command.lower(), 1 if is_alias else 0, arguments))
+        try:
+            rowcount, lastrowid = self.db.execute('INSERT INTO aliasses(command, is_command, replacement_text) VALUES(%s, %s, %s)', (command.lower(), 1 if is_alias else 0, arguments))
 
-                self.db.db.commit()
+            self.defines.add(lastrowid, command, is_alias, arguments)
 
-                return (True, cursor.lastrowid, 'Ok')
+            return (True, lastrowid, 'Ok')
 
-            except Exception as e:
-                return (False, -1, f'irc::add_define: failed to insert alias ({e})')
+        except Exception as e:
+            return (False, -1, f'irc::add_define: failed to insert alias ({e})')
 
     def del_define(self, nr):
-        self.db.probe()
-
-        with self.db.db.cursor() as cursor:
-            try:
-                cursor.execute('DELETE FROM aliasses WHERE nr=%s', (nr,))
+        try:
+            rowcount, lastrowid = self.db.execute('DELETE FROM aliasses WHERE nr=%s', (nr,))
 
-                self.db.db.commit()
+            self.defines.delete(nr)
 
-                if cursor.rowcount == 1:
-                    return (True, 'Ok')
+            if rowcount == 1:
+                return (True, 'Ok')
 
-                return (False, f'irc::del_define: unexpected affected rows count {cursor.rowcount}')
+            return (False, f'irc::del_define: unexpected affected rows count {rowcount}')
 
-            except Exception as e:
-                return (False, f'irc::del_define: failed to delete alias {nr} ({e})')
+        except Exception as e:
+            return (False, f'irc::del_define: failed to delete alias {nr} ({e})')
 
     def search_help(self, word):
-        results = []
-        word = word.lower()
-        for command in self.plugins:
-            text = self.plugins[command][0].lower()
-            if word in text:
-                results.append(command)
-                if len(results) >= 4:
-                    break
-        return results
+        return self.plugin_search.by_description(word, 4)
 
+    @metrics.timed('ghbot_lookup_seconds', (('function', 'similar_to'),))
     def similar_to(self, wrong):
-        best_score        = 1000
-        best_alternative  = '(no suggestion)'
-
-        best_score2       = -1000
-        best_alternative2 = '(no suggestion)'
-
-        for command in self.plugins:
-            current_score = nltk.edit_distance(command, wrong)
-
-            current_score2 = difflib.SequenceMatcher(None, command, wrong).ratio()
-
-            if current_score < best_score:
-                best_score = current_score
-
-                best_alternative = command
-
-            if current_score2 > best_score2:
-                best_score2 = current_score2
-
-                best_alternative2 = command
+        results = self.suggestions.suggest(wrong)
 
-        results = [best_alternative, best_alternative2]
-
-        self.db.probe()
-
-        with self.db.db.cursor() as cursor:
-            try:
-                cursor.execute('SELECT command FROM aliasses WHERE command SOUNDS LIKE %s', (wrong,))
-                row = cursor.fetchone()
-                results.append(row[0])
-
-            except Exception as e:
-                pass
+        if len(results) == 0:
+            return ['(no suggestion)']
 
         return results
 
     def search_define(self, what, verbose):
-        self.db.probe()
-
-        with self.db.db.cursor() as cursor:
-            try:
-                if verbose:
-                    cursor.execute('SELECT command, nr, replacement_text FROM aliasses WHERE nr=%s OR command like %s OR replacement_text like %s ORDER BY nr DESC', (what, f'%%{what.lower()}%%', f'%%{what}%%'))
-
-                else:
-                    cursor.execute('SELECT command, nr, replacement_text FROM aliasses WHERE nr=%s OR command like %s ORDER BY nr DESC', (what, f'%%{what.lower()}%%',))
-
-                results = []
-
-                for row in cursor:
-                    results.append(row)
+        try:
+            results = self.define_search.search(what, verbose)
 
-                if len(results) > 0:
-                    return (results, True, 'Ok')
+            if len(results) > 0:
+                return (results, True, 'Ok')
 
-            except Exception as e:
-                return (None, False, f'irc::del_define: failed to delete alias {nr} ({e})')
+        except Exception as e:
+            return (None, False, f'irc::search_define: failed to search for {what} ({e})')
 
-            return (None, True, 'None')
+        return (None, True, 'None')
 
     def escapes(self, text):
-        if '%R' in text:
-            text = text.replace('%R', f'{random.randint(0, 100)}')
-
-        if '%m' in text:
-            text = text.strip('%m')
-
-            text = '\001ACTION ' + text.strip() + '\001'
-
-        return text
+        return escapes(text)
 
+    @metrics.timed('ghbot_lookup_seconds', (('function', 'check_aliasses'),))
     def check_aliasses(self, text, username, is_command, channel):
         parts   = text.split(' ')
         command = parts[0]
 
-        with self.db.db.cursor() as cursor:
-            cursor.execute('SELECT is_command, replacement_text FROM aliasses WHERE command=%s AND is_command=%s ORDER BY RAND() LIMIT 100', (command.lower(), 1 if is_command else 0))
+        rows = self.defines.lookup(command, is_command)
 
-            rows = cursor.fetchall()
-            if len(rows) == 0:
-                return None
-
-            space = text.find(' ')
-            if space == -1:
-                query_text = username
-
-                if '!' in query_text:
-                    query_text = query_text[0:query_text.find('!')]
-
-            else:
-                query_text = text[space + 1:]
-
-            rc = []
-
-            for row in rows:
-                is_command = row[0]
-                repl_text  = row[1]
-
-                if is_command:  # initially only replaces command
-                    text = repl_text + ' ' + query_text
-
-                else:
-                    text = repl_text
-
-                text = self.escapes(text)
-
-                if username != None:
-                    exclamation_mark = username.find('!')
-
-                    if exclamation_mark != -1:
-                        username = username[0:exclamation_mark]
-
-                    text = text.replace('%u', username)
-                    text = text.replace('%U', username.upper())
+        if len(rows) == 0:
+            return None
 
-                if len(query_text) > 0:
-                    text = text.replace('%q', query_text)
-                    text = text.replace('%Q', query_text.upper())
+        space = text.find(' ')
+        if space == -1:
+            query_text = username
 
-                    text = text.replace('%d', query_text.split()[0])
-                    text = text.replace('%D', query_text.split()[0].upper())
+            if '!' in query_text:
+                query_text = query_text[0:query_text.find('!')]
 
-                    qt_space = query_text.find(' ')
-                    if qt_space != -1:
-                        temp = query_text[qt_space+1:].strip()
-                        text = text.replace('%e', temp)
-                        text = text.replace('%E', temp.upper())
+        else:
+            query_text = text[space + 1:]
 
-                text = text.replace('%c', channel)
-                text = text.replace('%C', channel.upper())
+        if username != None:
+            exclamation_mark = username.find('!')
 
-                text = text.replace('%r', username)  # TODO previously this was a random user
+            if exclamation_mark != -1:
+                username = username[0:exclamation_mark]
 
-                if '%h' in text:
-                    text = text.replace('%h:none',  '\003')
-                    text = text.replace('%h:white', '\0030')
-                    text = text.replace('%h:black', '\0031')
-                    text = text.replace('%h:blue', '\0032')
-                    text = text.replace('%h:green', '\0033')
-                    text = text.replace('%h:red', '\0034')
-                    text = text.replace('%h:brown', '\0035')
-                    text = text.replace('%h:purple', '\0036')
-                    text = text.replace('%h:orange', '\0037')
-                    text = text.replace('%h:yellow', '\0038')
-                    text = text.replace('%h:light-green', '\0039')
-                    text = text.replace('%h:cyan', '\00310')
-                    text = text.replace('%h:light-cyan', '\00311')
-                    text = text.replace('%h:light-blue', '\00312')
-                    text = text.replace('%h:pink', '\00313')
-                    text = text.replace('%h:grey', '\00314')
-                    text = text.replace('%h:light-grey', '\00315')
+        # computed once for all rows; None if the compiled templates cannot be used
+        values = template_values(query_text, username, channel)
 
-                notice = False
+        rc = []
 
-                if '%n' in text:
-                    text = text.replace('%n', '')
+        for is_command, repl_text, template in rows:
+            if template == None or values == None:
+                text, notice = expand_legacy(is_command, repl_text, query_text, username, channel)
 
-                    notice = True
+            else:
+                text, notice = template.expand(values)
 
-                rc.append((is_command, text, notice))
+            rc.append((is_command, text, notice))
 
-            return rc
+        return rc
 
     def invoke_internal_commands(self, prefix, command, splitted_args, channel):
         if not self.rl_settings is None:
@@ -844,6 +888,7 @@ class ghbot(ircbot):
                 self.user_rl[prefix] = token_bucket.TokenBucket(self.rl_settings[0], self.rl_settings[1])  # max x commands in y seconds
                 self.user_rl_mentioned[prefix] = False
             if self.user_rl[prefix].allow_request() == False:
+                metrics.inc('ghbot_rate_limited_total')
                 if self.user_rl_mentioned[prefix] == False:
                     self.send_error(channel, f'Rate limited, please wait {self.rl_settings[0]:.2f} seconds')
                     self.user_rl_mentioned[prefix] = True
@@ -892,10 +937,10 @@ class ghbot(ircbot):
             cmd_idx   = self.find_key_in_list(splitted_args, 'cmd',   2)
 
             if not identifier_is_known and target_type == 'user':
-                self.invoke_who_and_wait(check_user)
+                hostmask = self.who.wait(check_user)
 
-                if check_user in self.users:
-                    identifier = self.users[check_user]
+                if hostmask != None:
+                    identifier = hostmask
 
             # print(identifier, check_user, splitted_args)
 
@@ -916,12 +961,8 @@ class ghbot(ircbot):
             elif cmd_idx != None:
                 cmd_name = splitted_args[cmd_idx + 1]
 
-                self.plugins_lock.acquire()
-
                 plugin_known = cmd_name in self.plugins
 
-                self.plugins_lock.release()
-
                 if plugin_known:
                     rc = self.add_acl(identifier, cmd_name)  # who, command
                     if rc[0]:  # who, command
@@ -950,10 +991,10 @@ class ghbot(ircbot):
             cmd_idx   = self.find_key_in_list(splitted_args, 'cmd',   2)
 
             if not identifier_is_known and target_type == 'user':
-                self.invoke_who_and_wait(check_user)
+                hostmask = self.who.wait(check_user)
 
-                if check_user in self.users:
-                    identifier = self.users[check_user]
+                if hostmask != None:
+                    identifier = hostmask
 
             if group_idx != None:
                 group_name = splitted_args[group_idx + 1]
@@ -990,10 +1031,10 @@ class ghbot(ircbot):
 
         elif command == 'listacls':
             if not identifier_is_known:
-                self.invoke_who_and_wait(check_user)
+                hostmask = self.who.wait(check_user)
 
-                if check_user in self.users:
-                    identifier = self.users[check_user]
+                if hostmask != None:
+                    identifier = hostmask
 
             if identifier != None:
                 acls = self.list_acls(identifier)
@@ -1011,13 +1052,13 @@ class ghbot(ircbot):
             if splitted_args != None and len(splitted_args) == 2:
                 user_to_update = splitted_args[1]
 
-                self.invoke_who_and_wait(user_to_update)
+                hostmask = self.who.wait(user_to_update)
 
-                if user_to_update in self.users:
-                    ok, error_text = self.update_acls(user_to_update, self.users[user_to_update])
+                if hostmask != None:
+                    ok, error_text = self.update_acls(user_to_update, hostmask)
 
                     if ok:
-                        self.send_ok(channel, f'User {user_to_update} updated to {self.users[user_to_update]}')
+                        self.send_ok(channel, f'User {user_to_update} updated to {hostmask}')
 
                     else:
                         self.send_error(channel, error_text)
@@ -1033,13 +1074,13 @@ class ghbot(ircbot):
                 new_nick = splitted_args[1].lower()
                 old_nick = splitted_args[2].lower()
 
-                self.invoke_who_and_wait(new_nick)
+                hostmask = self.who.wait(new_nick)
 
-                if new_nick in self.users:
-                    ok, error_text = self.merge_nick(self.users[new_nick], old_nick)
+                if hostmask != None:
+                    ok, error_text = self.merge_nick(hostmask, old_nick)
 
                     if ok:
-                        self.send_ok(channel, f'Added alias for {old_nick}: {self.users[new_nick]}')
+                        self.send_ok(channel, f'Added alias for {old_nick}: {hostmask}')
 
                     else:
                         self.send_error(channel, error_text)
@@ -1059,12 +1100,8 @@ class ghbot(ircbot):
 
         elif command == 'define' or command == 'alias':
             if len(splitted_args) >= 3:
-                self.plugins_lock.acquire()
-
                 plugin_known = splitted_args[1] in self.plugins
 
-                self.plugins_lock.release()
-
                 if plugin_known:
                     self.send_error(channel, f'Cannot override internal/plugin commands')
 
@@ -1163,18 +1200,16 @@ class ghbot(ircbot):
             if len(splitted_args) == 2:
                 cmd = splitted_args[1]
 
-                self.plugins_lock.acquire()
+                record = self.plugins.get(cmd)
 
-                if cmd in self.plugins:
-                    self.send_ok(channel, f'Command {cmd}: {self.plugins[cmd][0]} (group: {self.plugins[cmd][1]})')
+                if record != None:
+                    self.send_ok(channel, f'Command {cmd}: {record.descr} (group: {record.acl_group})')
 
                 else:
                     suggestions = [x for x in self.similar_to(cmd) if x != None]
                     suggestions += [x for x in self.search_help(cmd) if x != None]
                     self.send_error(channel, f'Command/plugin not known (maybe {" or ".join(set(suggestions))}?)')
 
-                self.plugins_lock.release()
-
             else:
                 plugins = self.list_plugins()
 
@@ -1183,15 +1218,9 @@ class ghbot(ircbot):
             return self.internal_command_rc.HANDLED
 
         elif command == 'helpgroups':
-            self.plugins_lock.acquire()
-
-            plugin_list = [self.plugins[x][5] for x in self.plugins if len(self.plugins[x]) == 6]
-            plugin_set = set(plugin_list)  # make unique
-            plugin_list = [x for x in plugin_set if not x is None]  # strip None
+            plugin_list = self.plugins.get_help_groups()
 
-            self.send_ok(channel, f'Command groups: {", ".join(sorted(plugin_list))}')
-
-            self.plugins_lock.release()
+            self.send_ok(channel, f'Command groups: {", ".join(plugin_list)}')
 
             return self.internal_command_rc.HANDLED
 
@@ -1199,15 +1228,9 @@ class ghbot(ircbot):
             if len(splitted_args) == 2:
                 group = splitted_args[1].lower()
 
-                self.plugins_lock.acquire()
-
-                plugin_list = [x for x in self.plugins if len(self.plugins[x]) >= 6 and self.plugins[x][5] == group]
-                plugin_set = set(plugin_list)  # make unique
-                plugin_list = [x for x in plugin_set if not x is None]  # strip None
+                plugin_list = self.plugins.by_help_group(group)
 
-                self.send_ok(channel, f'Commands in group {group}: {", ".join(sorted(plugin_list))}')
-
-                self.plugins_lock.release()
+                self.send_ok(channel, f'Commands in group {group}: {", ".join(plugin_list)}')
 
                 return self.internal_command_rc.HANDLED
 
@@ -1249,14 +1272,11 @@ class ghbot(ircbot):
                 from_user = from_.split('!')[0] if '!' in from_ else from_
                 to_user   = to_.split('!')[0]   if '!' in to_   else to_
 
-                if not from_user in self.users or self.users[from_user] == '?':
-                    self.invoke_who_and_wait(from_user)
-
-                if not to_user in self.users or self.users[to_user] == '?':
-                    self.invoke_who_and_wait(to_user)
+                from_mask = self._hostmask_of(from_user)
+                to_mask   = self._hostmask_of(to_user)
 
-                if from_user in self.users and to_user in self.users and self.users[from_user] != '?' and self.users[to_user] != '?':
-                    error = self.clone_acls(self.users[from_user], self.users[to_user])
+                if from_mask != None and to_mask != None:
+                    error = self.clone_acls(from_mask, to_mask)
 
                     if error == None:
                         self.send_ok(channel, f'User {from_} cloned (to {to_})')
@@ -1274,29 +1294,18 @@ class ghbot(ircbot):
 
         elif command == 'listgroups':
             try:
-                with self.db.db.cursor() as cursor:
-                    cursor.execute('SELECT DISTINCT who FROM acls')
-
-                    groups = set()
-
-                    # defined by sysop(s)
-                    for row in cursor.fetchall():
-                        groups.add(row[0])
-
-                    # defined by plugins
-                    self.plugins_lock.acquire()
+                groups = set()
 
-                    for plugin in self.plugins:
-                        group = self.plugins[plugin][1]
+                # defined by sysop(s)
+                for row in self.db.query('SELECT DISTINCT who FROM acls'):
+                    groups.add(row[0])
 
-                        if group != None:
-                            groups.add(group)
+                # defined by plugins
+                groups.update(self.plugins.get_acl_groups())
 
-                    self.plugins_lock.release()
+                groups_str = ', '.join(groups) if len(groups) > 1 else '(none)'
 
-                    groups_str = ', '.join(groups) if len(groups) > 1 else '(none)'
-
-                    self.send_ok(channel, f'Defined groups: {groups_str}')
+                self.send_ok(channel, f'Defined groups: {groups_str}')
 
             except Exception as e:
                 self.send_error(channel, f'listgroups: exception "{e}" at line number: {e.__traceback__.tb_lineno}')
@@ -1308,48 +1317,37 @@ class ghbot(ircbot):
                 which = splitted_args[1]
                 group = splitted_args[2]
 
-                with self.db.db.cursor() as cursor:
-                    if which.lower() == 'commands':
-                        cursor.execute('SELECT command FROM acls WHERE who=%s', (group,))
-
-                        commands = set()
+                if which.lower() == 'commands':
+                    commands = set()
 
-                        # defined by sysop(s)
-                        for row in cursor.fetchall():
-                            commands.add(row[0])
-
-                        # defined by plugins
-                        self.plugins_lock.acquire()
-
-                        for plugin in self.plugins:
-                            if self.plugins[plugin][1] == group:
-                                commands.add(plugin)
-
-                        self.plugins_lock.release()
+                    # defined by sysop(s)
+                    for row in self.db.query('SELECT command FROM acls WHERE who=%s', (group,)):
+                        commands.add(row[0])
 
-                        commands_str = ', '.join(commands)
+                    # defined by plugins
+                    commands.update(self.plugins.by_acl_group(group))
 
-                        self.send_ok(channel, f'Commands in group {group}: {commands_str}')
+                    commands_str = ', '.join(commands)
 
-                    elif which.lower() == 'members':
-                        cursor.execute('SELECT who FROM acl_groups WHERE group_name=%s', (group,))
+                    self.send_ok(channel, f'Commands in group {group}: {commands_str}')
 
-                        members = set()
+                elif which.lower() == 'members':
+                    members = set()
 
-                        for row in cursor.fetchall():
-                            member = row[0]
+                    for row in self.db.query('SELECT who FROM acl_groups WHERE group_name=%s', (group,)):
+                        member = row[0]
 
-                            if '!' in member:
-                                member = member[0:member.find('!')]
+                        if '!' in member:
+                            member = member[0:member.find('!')]
 
-                            members.add(member)
+                        members.add(member)
 
-                        members_str = ', '.join(members)
+                    members_str = ', '.join(members)
 
-                        self.send_ok(channel, f'Members in group {group}: {members_str}')
+                    self.send_ok(channel, f'Members in group {group}: {members_str}')
 
-                    else:
-                        self.send_error(channel, 'Command is: showgroup members|commands <groupname>')
+                else:
+                    self.send_error(channel, 'Command is: showgroup members|commands <groupname>')
 
             return self.internal_command_rc.HANDLED
 
@@ -1360,13 +1358,8 @@ class ghbot(ircbot):
 
             which = splitted_args[1].lower()
 
-            for plugin in self.plugins:
-                if which in plugin:
-                    matching.add(plugin)
-
-            for plugin in self.hardcoded_plugins:
-                if which in plugin:
-                    matching.add(plugin)
+            for plugin in self.plugin_search.by_name(which):
+                matching.add(plugin)
 
             rc, err = self.find_alias_define_by_substring(which)
 
@@ -1404,7 +1397,7 @@ class ghbot(ircbot):
 
             if which in self.local_plugins.list_plugins():
                 if self.local_plugins.reload_module(which):
-                    self.send_ok(channel, f'Local plugins {which} reloaded')
+                    self.send_ok(channel, f'Local plugins {which} reloaded in {self.local_plugins.load_times[which] * 1000:.1f} ms')
 
                     return self.internal_command_rc.HANDLED
 
@@ -1445,61 +1438,152 @@ class ghbot(ircbot):
         return self.internal_command_rc.NOT_INTERNAL
 
     def find_alias_define_by_substring(self, which):
-        try:
-            self.db.probe()
+        rows = []
 
-            with self.db.db.cursor() as cursor:
-                cursor.execute('SELECT command, is_command, nr FROM aliasses WHERE command like %s', (f'%%{which}%%',))
-
-                rows = []
-
-                for row in cursor:
-                    rows.append((row[0], 'alias' if row[1] == 1 else 'define', row[2]))
+        try:
+            for row in self.define_search.by_name(which):
+                rows.append((row[0], 'alias' if row[1] else 'define', row[2]))
 
-                return (rows, None)
+            return (rows, None)
 
         except Exception as e:
-            return (rows, f'irc::add_define: failed to insert alias ({e})')
+            return (rows, f'irc::find_alias_define_by_substring: failed to search for {which} ({e})')
 
     def irc_command_insertion_point(self, prefix, command, arguments):
         if command.upper() in [ 'JOIN', 'PART', 'KICK', 'NICK', 'QUIT', 'MODE' ] or command.isnumeric():
             ch = arguments[0]
             if ch[0] == '#':
                 ch = ch[1:]
-            self.mqtt.publish(f'from/irc/{ch}/{prefix}/{command}', ' '.join(arguments))
+
+            channel = arguments[0] if arguments[0][0] == '#' else prefix.split('!')[0]
+
+            self._publish_irc(f'from/irc/{ch}/{prefix}/{command}', channel, prefix, command, ' '.join(arguments), 'event')
 
         return True
 
-if len(sys.argv) != 2:
-    print('Filename of configuration file required')
+# not when imported, e.g. by the worker processes of isolated plugins (see plugin_handler.py)
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print('Filename of configuration file required')
+
+        sys.exit(1)
+
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+
+    # threads or asyncio; with asyncio the objects below don't start their own threads
+    use_asyncio = config['general'].get('runtime', 'threads') == 'asyncio'
+    autostart   = not use_asyncio
+
+    # host, user, password, database, pool size
+    db = dbi(config['db']['host'], config['db']['user'], config['db']['password'], config['db']['database'], int(config['db'].get('pool-size', '4')), autostart)
+
+    # database, resync interval
+    acls = acl_cache(db, int(config['acl']['resync-interval']) if 'acl' in config else 300, autostart)
+
+    # database, change-check interval
+    defines = define_store(db, int(config['defines']['check-interval']) if 'defines' in config else 10, autostart)
+
+    # memory or mysql (needs the FULLTEXT indexes from ghbot.sql)
+    if 'search' in config and config['search'].get('backend', 'memory') == 'mysql':
+        define_search = mysql_define_search(db)
+
+    else:
+        define_search = memory_define_search()
+
+    defines.add_listener(define_search)
+
+    # penalty, burst, coalesce, max lines in the reply and broadcast lanes
+    flood_settings = (2., 10., True, 1000)
+    if 'flood' in config:
+        flood_settings = (float(config['flood'].get('penalty', '2')), float(config['flood'].get('burst', '10')), config['flood'].get('coalesce', 'true').lower() == 'true', int(config['flood'].get('queue-size', '1000')))
+
+    logging.basicConfig(stream=sys.stdout, format='%(message)s')
+    logging.getLogger('mqtt_handler').setLevel(config['mqtt'].get('log-level', 'warning').upper())
+
+    # queue size, qos per topic class ("class:qos ..."), topic classes to retain, 1 in n 'message' kept under pressure
+    publish_settings = (int(config['mqtt'].get('queue-size', '10000')),
+                        { c: int(q) for c, q in (item.split(':') for item in config['mqtt'].get('qos', 'control:1 command:1').split()) },
+                        set(config['mqtt'].get('retain', '').split()),
+                        int(config['mqtt'].get('sample-message', '4')))
+
+    # codec for the from/irc-v1/... topics (none, json, msgpack or cbor), keep publishing from/irc/...
+    envelope_codec = config['mqtt'].get('envelope', 'none')
+
+    if envelope_codec == 'none':
+        envelope_codec = None
+
+    elif not envelope.available(envelope_codec):
+        print(f'{envelope_codec} is not installed, using json for envelopes')
+
+        envelope_codec = 'json'
+
+    envelope_settings = (envelope_codec, config['mqtt'].get('legacy-topics', 'true').lower() == 'true')
+
+    # seconds to wait for a reply from a plugin, tell the user when none came
+    inflight_settings = (30., False)
+    if 'inflight' in config:
+        inflight_settings = (float(config['inflight'].get('timeout', '30')), config['inflight'].get('notify', 'false').lower() == 'true')
+
+    plugin_settings = (60., 5.)
+    if 'plugins' in config:
+        plugin_settings = (float(config['plugins'].get('timeout', '60')), float(config['plugins'].get('register-jitter', '5')))
+
+    # seconds a WHO answer is used, WHO for each channel after joining it
+    who_settings = (300., False)
+    if 'who' in config:
+        who_settings = (float(config['who'].get('ttl', '300')), config['who'].get('warm-up', 'false').lower() == 'true')
+
+    isolation_settings = (dict(), 2)
+    if 'local-plugins' in config:
+        isolated = dict()
+
+        # name or name:timeout
+        for item in config['local-plugins'].get('isolated', '').split():
+            name, sep, timeout = item.partition(':')
+
+            isolated[name] = float(timeout if timeout != '' else config['local-plugins'].get('timeout', '10'))
+
+        isolation_settings = (isolated, int(config['local-plugins'].get('workers', '2')))
+
+    # tokens (name:token ...), max request size, max messages per request, burst and messages per second per token
+    post_settings = (dict(item.split(':', 1) for item in config['httpd'].get('post-tokens', '').split()),
+                     int(config['httpd'].get('post-max-bytes', '1048576')),
+                     int(config['httpd'].get('post-max-messages', '1000')),
+                     float(config['httpd'].get('post-capacity', '100')),
+                     float(config['httpd'].get('post-refill-rate', '2')))
+
+    # broker_ip, topic_prefix
+    m = mqtt_handler(config['mqtt']['host'], int(config['mqtt']['port']), config['mqtt']['prefix'], autostart, publish_settings)
 
-    sys.exit(1)
+    # rate limiting
+    rate_limiting = None
+    if 'rate_limiting' in config:
+        rate_limiting = (float(config['rate_limiting']['capacity']), float(config['rate_limiting']['refill_rate']))
 
-config = configparser.ConfigParser()
-config.read(sys.argv[1])
+    # workers, queue size
+    dispatch_settings = (4, 256)
+    if 'dispatch' in config:
+        dispatch_settings = (int(config['dispatch'].get('workers', '4')), int(config['dispatch'].get('queue-size', '256')))
 
-# host, user, password, database
-db = dbi(config['db']['host'], config['db']['user'], config['db']['password'], config['db']['database'])
+    # host, port, nick, channel, m, db, command_prefix
+    g = ghbot(config['irc']['host'], int(config['irc']['port']), config['irc']['nick'], 
+              config['irc']['password'], config['irc']['channels'].split(','), m, db, acls, defines, define_search,
+              config['irc']['prefix'], 'plugins', config['general']['use-notice'].lower() == 'true',
+              config['irc']['owner'], rate_limiting, dispatch_settings, flood_settings, envelope_settings, inflight_settings, plugin_settings, isolation_settings, who_settings, post_settings, autostart)
 
-# broker_ip, topic_prefix
-m = mqtt_handler(config['mqtt']['host'], int(config['mqtt']['port']), config['mqtt']['prefix'])
+    if use_asyncio:
+        from async_runtime import async_runtime
 
-# rate limiting
-rate_limiting = None
-if 'rate_limiting' in config:
-    rate_limiting = (float(config['rate_limiting']['capacity']), float(config['rate_limiting']['refill_rate']))
+        async_runtime(g, int(config['httpd']['port'])).run()
 
-# host, port, nick, channel, m, db, command_prefix
-g = ghbot(config['irc']['host'], int(config['irc']['port']), config['irc']['nick'], 
-          config['irc']['password'], config['irc']['channels'].split(','), m, db,
-          config['irc']['prefix'], 'plugins', config['general']['use-notice'].lower() == 'true',
-          config['irc']['owner'], rate_limiting)
+        sys.exit(0)
 
-ka = irc_keepalive(g)
+    ka = irc_keepalive(g)
 
-h = http_server(int(config['httpd']['port']), g)
+    h = http_server(int(config['httpd']['port']), g)
 
-print('Go!')
+    print('Go!')
 
-while True:
-    time.sleep(3600.)
+    while True:
+        time.sleep(3600.)
@@ -18,7 +18,9 @@ CREATE TABLE `aliasses` (
   `replacement_text` TEXT COLLATE utf8mb4_unicode_ci NOT NULL,
   `nr` int(12) NOT NULL AUTO_INCREMENT,
   PRIMARY KEY (`nr`),
-  KEY `command` (`command`)
+  KEY `command` (`command`),
+  FULLTEXT KEY `ft_command` (`command`),
+  FULLTEXT KEY `ft_command_text` (`command`, `replacement_text`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE `account_aliasses` (
@@ -0,0 +1,140 @@
+#! /usr/bin/python3
+
+import envelope
+import paho.mqtt.client as mqtt
+import random
+import threading
+import time
+
+
+# Reference helper for plugins that use the structured topics (see
+# envelope.py). Usage:
+#
+#   p = ghbot_plugin('mqtt.local', 1883, 'GHBot/', 'myplugin')
+#
+#   def hello(p, e):
+#       p.reply(e, f'Hello {e["prefix"].split("!")[0]}!')
+#
+#   p.add_command('hello', hello, 'Say hello', athr='me')
+#   p.run()
+#
+# All commands are registered in one message (named after client_id) when
+# the bot asks for it, spread over the register-jitter parameter of the bot.
+# Every 'refresh' seconds a heartbeat keeps them alive (the bot forgets
+# commands that are not refreshed within a minute); every 'reregister'-th
+# time the registration is sent instead, in case the bot forgot them.
+class ghbot_plugin:
+    def __init__(self, broker_ip, broker_port, topic_prefix, client_id, codec='json', refresh=10., reregister=6):
+        self.topic_prefix = topic_prefix
+        self.name         = client_id
+        self.codec        = codec
+        self.refresh      = refresh
+        self.reregister   = reregister
+        self.jitter       = 0.
+
+        self.commands     = dict()  # command -> (function, registration)
+
+        self.client = mqtt.Client(client_id=client_id, clean_session=True)
+
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+
+        self.client.connect(broker_ip, broker_port, 60)
+
+    def add_command(self, command, function, descr, agrp=None, hgrp=None, athr='', loc=''):
+        registration = { 'cmd': command, 'descr': descr, 'agrp': agrp, 'hgrp': hgrp, 'athr': athr, 'loc': loc }
+
+        self.commands[command] = (function, registration)
+
+        self.client.subscribe(f'{self.topic_prefix}from/irc-v1/+/{command}')
+
+        self.register_all()
+
+    def register_all(self):
+        out = { 'v': envelope.version, 'plugin': self.name, 'testament': False, 'commands': [ c[1] for c in self.commands.values() ] }
+
+        self.client.publish(f'{self.topic_prefix}to/bot/register-bulk-v1', envelope.encode(out, self.codec))
+
+    def heartbeat(self):
+        self.client.publish(f'{self.topic_prefix}to/bot/heartbeat-v1', envelope.encode({ 'v': envelope.version, 'plugin': self.name }, self.codec))
+
+    def unregister_all(self):
+        self.client.publish(f'{self.topic_prefix}to/bot/unregister-v1', envelope.encode({ 'v': envelope.version, 'commands': list(self.commands) }, self.codec))
+
+    # 'kind' is privmsg, notice, topic or mode; replies to the channel or nick 'e' came from
+    def reply(self, e, text, kind='privmsg'):
+        out = { 'v': envelope.version, 'id': e['id'], 'text': text }
+
+        self.client.publish(f'{self.topic_prefix}to/irc-v1/{envelope.channel_level(e["channel"])}/{kind}', envelope.encode(out, self.codec))
+
+    def _on_connect(self, client, userdata, flags, rc):
+        client.subscribe(f'{self.topic_prefix}from/bot/command')
+        client.subscribe(f'{self.topic_prefix}from/bot/parameter/register-jitter')
+
+        for command in self.commands:
+            client.subscribe(f'{self.topic_prefix}from/irc-v1/+/{command}')
+
+        self.register_all()
+
+    def _on_message(self, client, userdata, msg):
+        topic = msg.topic[len(self.topic_prefix):]
+
+        if topic == 'from/bot/command':
+            if msg.payload == b'register':
+                # after a restart of the bot all plugins get this at the same time
+                threading.Timer(random.uniform(0., self.jitter), self.register_all).start()
+
+            return
+
+        if topic == 'from/bot/parameter/register-jitter':
+            try:
+                self.jitter = float(msg.payload)
+
+            except ValueError as ve:
+                print(f'ghbot_plugin::_on_message: invalid register-jitter: {msg.payload}')
+
+            return
+
+        e = envelope.decode(msg.payload)
+
+        if e == None or not e.get('command') in self.commands:
+            return
+
+        try:
+            self.commands[e['command']][0](self, e)
+
+        except Exception as ex:
+            print(f'ghbot_plugin::_on_message: {e["command"]} failed: {ex}')
+
+    def _refresher(self):
+        n = 0
+
+        while True:
+            time.sleep(self.refresh)
+
+            n += 1
+
+            if n % self.reregister == 0:
+                self.register_all()
+
+            else:
+                self.heartbeat()
+
+    def run(self):
+        threading.Thread(target=self._refresher, daemon=True).start()
+
+        self.client.loop_forever()
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print(f'Usage: {sys.argv[0]} broker-host topic-prefix')
+
+        sys.exit(1)
+
+    p = ghbot_plugin(sys.argv[1], 1883, sys.argv[2], 'ghbot_plugin_example')
+
+    p.add_command('echo', lambda p, e: p.reply(e, e['text']), 'Repeat what was said', athr='ghbot_plugin.py')
+
+    p.run()
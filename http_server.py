@@ -1,119 +1,332 @@
 #! /usr/bin/python3
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import gzip
+import hashlib
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
+import metrics
 import pickle
-import socketserver
+import resource
+import string
 import threading
 import time
 from urllib.parse import parse_qs
 
 
-class http_requesthandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        p = self.path
+def json_reply(data):
+    return (200, 'application/json', bytes(json.dumps(data), 'utf8'))
 
-        if '?' in p:
-            p = p[0:p.find('?')]
+def render_index(ghbot):
+    rows = []
 
-        if p == '/index.html' or p == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
+    for record in ghbot.plugins.snapshot():
+        rows.append(f'<tr><td>{escape(record.command)}</td><td>{escape(str(record.acl_group))}</td><td>{escape(str(record.author))}</td><td>{escape(str(record.location))}</td></tr>')
+        rows.append(f'<tr><td colspan=4>{escape(str(record.descr))}</td></tr>')
 
-            page  = '<html>'
-            page += '<head><title>GHBot</title></head>'
-            page += '<body>'
-            page += '<h1>GHbot</h1>'
+    page = ''.join([ '<html>',
+                     '<head><title>GHBot</title></head>',
+                     '<body>',
+                     '<h1>GHbot</h1>',
+                     '<h2>loaded plugins</h2>',
+                     '<table border=1>',
+                     '<tr><th>command</th><th>group</th><th>author</th><th>location</th></tr>',
+                     '<tr><th colspan=4>description</th></tr>' ] + rows +
+                   [ '</table>',
+                     '</body>',
+                     '</html>' ])
 
-            page += '<h2>loaded plugins</h2>'
-            page += '<table border=1>'
-            page += '<tr><th>command</th><th>group</th><th>author</th><th>location</th></tr>'
-            page += '<tr><th colspan=4>description</th></tr>'
+    return (200, 'text/html', bytes(page, 'utf8'))
 
-            for p in self.server.context_data.plugins:
-                record = self.server.context_data.plugins[p]
+def render_plugins_loaded(ghbot):
+    plugins = []
 
-                # [descr, acl_group, time.time(), athr, location]
+    for record in ghbot.plugins.snapshot():
+        record_out = dict()
+        record_out['command']    = record.command
+        record_out['descr']      = record.descr
+        record_out['acl_group']  = record.acl_group
+        record_out['latest_ka']  = ghbot.plugins.last_seen(record)
+        record_out['author']     = record.author
+        record_out['location']   = record.location
+        record_out['help_group'] = record.help_group
 
-                page += f'<tr><td>{p}</td><td>{record[1]}</td><td>{record[3]}</td><td>{record[4]}</td></tr>'
-                page += f'<tr><td colspan=4>{record[0]}</td></tr>'
+        plugins.append(record_out)
 
-            page += '</table>'
+    return json_reply(plugins)
 
-            page += '</body>'
-            page += '</html>'
+def render_plugins_unresponsive(ghbot):
+    return json_reply(ghbot.plugins.get_gone())
 
-            self.wfile.write(bytes(page, 'utf8'))
+# A page rendered from the plugin registry, kept until the registry changes
+# (see plugin_registry.generation) or it is 'max_age' seconds old (a
+# heartbeat does not change the generation but does change 'latest_ka').
+class snapshot:
+    def __init__(self, render, max_age=5.):
+        self.render  = render
+        self.max_age = max_age
 
-        elif p == '/plugins-loaded.cgi':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
+        self.lock    = threading.Lock()
 
-            plugins = []
+        self.key     = None
+        self.built   = 0.
+        self.reply   = None  # content type, body, etag, gzipped body
 
-            for p in self.server.context_data.plugins:
-                record = self.server.context_data.plugins[p]
+        self.hits    = 0
+        self.builds  = 0
 
-                record_out = dict()
-                record_out['command']   = p
-                record_out['descr']     = record[0]
-                record_out['acl_group'] = record[1]
-                record_out['latest_ka'] = record[2]
-                record_out['author']    = record[3]
-                record_out['location']  = record[4]
+    def get(self, ghbot):
+        with self.lock:
+            now = time.time()
 
-                plugins.append(record_out)
+            if self.key != ghbot.plugins.generation or now - self.built >= self.max_age:
+                # read before rendering: a change during it leads to a rebuild next time
+                self.key   = ghbot.plugins.generation
+                self.built = now
 
-            self.wfile.write(bytes(json.dumps(plugins), 'utf8'))
+                code, content_type, body = self.render(ghbot)
 
-        elif p == '/plugins-unresponsive.cgi':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
+                self.reply = (content_type, body, make_etag(body), gzip.compress(body))
 
-            self.wfile.write(bytes(json.dumps(self.server.plugins_gone), 'utf8'))
+                self.builds += 1
 
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
+            else:
+                self.hits += 1
 
-            self.wfile.write(bytes('nope', 'utf8'))
+            return self.reply
 
+snapshots = { '/': snapshot(render_index), '/index.html': snapshot(render_index),
+              '/plugins-loaded.cgi': snapshot(render_plugins_loaded), '/plugins-unresponsive.cgi': snapshot(render_plugins_unresponsive) }
 
-    def do_POST(self):
-        p = self.path
+def make_etag(body):
+    return '"' + hashlib.sha1(body).hexdigest()[0:20] + '"'
 
-        if p == '/post-message.cgi':
-            content_len = int(self.headers['Content-Length'])
-            raw_body = self.rfile.read(content_len)
-            utf8_body = raw_body.decode('utf8')
-            parsed_input = json.loads(utf8_body)
+# the gzipped body is a different representation: it needs an ETag of its own
+def gzip_etag(etag):
+    return etag[:-1] + '-gz"'
 
-            if 'channel' in parsed_input and 'text' in parsed_input:
-                self.server.context_data.send_ok(parsed_input['channel'], parsed_input['text'])
+# If-None-Match is a list of (possibly weak) ETags or '*'
+def etag_matches(etag, if_none_match):
+    tags = [ tag.strip() for tag in if_none_match.split(',') ]
 
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
+    return '*' in tags or etag in tags or 'W/' + etag in tags
 
-                self.wfile.write(bytes('ok', 'utf8'))
+class http_error(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
 
-            else:
-                self.send_response(500)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
+        self.code = code
+
+# for a request body; raises http_error when the Content-Length header is
+# not a (non-negative) number or larger than 'limit'
+def content_length(headers, limit):
+    value = headers.get('content-length', '0').strip()
+
+    if not (value.isascii() and value.isdigit()):
+        raise http_error(400, 'invalid Content-Length')
+
+    n = int(value)
+
+    if n > limit:
+        raise http_error(413, 'too large')
+
+    return n
+
+# the size line of a chunk in a chunked body (hexadecimal, optionally followed by ';extension')
+def chunk_size(line):
+    value = line.split(b';')[0].strip()
+
+    if value == b'' or any(not chr(c) in string.hexdigits for c in value):
+        raise http_error(400, 'invalid chunk size')
+
+    return int(value, 16)
+
+# returns (http status code, content type, body); shared by the threaded
+# server below and the one of the asyncio runtime
+def handle_get(ghbot, p):
+    if '?' in p:
+        p = p[0:p.find('?')]
+
+    if p in snapshots:
+        return snapshots[p].render(ghbot)
+
+    if p == '/http.cgi':
+        return json_reply({ path: { 'hits': s.hits, 'builds': s.builds } for path, s in snapshots.items() })
+
+    if p == '/plugins-registry.cgi':
+        return json_reply(ghbot.plugins.get_stats())
+
+    if p == '/local-plugins.cgi':
+        return json_reply(ghbot.local_plugins.get_stats())
+
+    if p == '/users.cgi':
+        return json_reply(ghbot.users.get_stats())
+
+    if p == '/who.cgi':
+        return json_reply(ghbot.who.get_stats())
+
+    if p == '/dispatcher.cgi':
+        return json_reply(ghbot.dispatcher.get_stats())
+
+    if p == '/db.cgi':
+        return json_reply(ghbot.db.get_stats())
+
+    if p == '/send-queue.cgi':
+        return json_reply(ghbot.sender.get_stats())
+
+    if p == '/inflight.cgi':
+        return json_reply(ghbot.inflight.get_stats())
+
+    if p == '/mqtt.cgi':
+        return json_reply(ghbot.mqtt.get_stats())
+
+    if p == '/acl-cache.cgi':
+        return json_reply(ghbot.acls.get_stats())
+
+    if p == '/runtime.cgi':
+        out = { 'runtime': 'threads' if ghbot.runtime == None else 'asyncio', 'threads': threading.active_count(),
+                'max-rss-kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss }
+
+        if ghbot.runtime != None:
+            out.update(ghbot.runtime.get_stats())
+
+        return json_reply(out)
+
+    # Prometheus scrape target
+    if p == '/metrics':
+        return (200, 'text/plain; version=0.0.4; charset=utf-8', bytes(metrics.render(), 'utf8'))
+
+    return (404, 'text/html', bytes('nope', 'utf8'))
+
+# 'headers' has lowercase names
+def handle_post(ghbot, p, headers, raw_body):
+    if p == '/post-message.cgi':
+        code, reply, single = ghbot.ingest.submit(headers, raw_body)
+
+        # one object: the reply it always got
+        if code == 202 and single:
+            return (200, 'text/html', bytes('ok', 'utf8'))
+
+        return (code, 'application/json', bytes(json.dumps(reply), 'utf8'))
+
+    return (404, 'text/html', bytes('nope', 'utf8'))
+
+# 'headers' has lowercase names; returns (http status code, [ (header, value), ... ], body)
+# without Content-Length. GET replies get an ETag (a matching If-None-Match
+# gives a 304) and are gzipped when the client accepts that.
+def respond(ghbot, method, p, headers, raw_body):
+    gzipped = None
+    etag    = None
+
+    if method == 'GET':
+        path = p[0:p.find('?')] if '?' in p else p
+
+        if path in snapshots:
+            code = 200
 
-                self.wfile.write(bytes('Parameter(s) missing', 'utf8'))
+            content_type, body, etag, gzipped = snapshots[path].get(ghbot)
 
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
+            code, content_type, body = handle_get(ghbot, p)
+
+            if code == 200:
+                etag = make_etag(body)
+
+    elif method == 'POST':
+        code, content_type, body = handle_post(ghbot, p, headers, raw_body)
+
+    else:
+        code, content_type, body = (501, 'text/html', bytes('nope', 'utf8'))
+
+    out = [ ('Content-Type', content_type) ]
+
+    use_gzip = 'gzip' in headers.get('accept-encoding', '') and len(body) >= 512
+
+    if use_gzip:
+        out.append(('Content-Encoding', 'gzip'))
+        out.append(('Vary', 'Accept-Encoding'))
+
+    if etag != None:
+        if use_gzip:
+            etag = gzip_etag(etag)
+
+        out.append(('ETag', etag))
+
+        if etag_matches(etag, headers.get('if-none-match', '')):
+            return (304, [ ('ETag', etag) ] + ([ ('Vary', 'Accept-Encoding') ] if use_gzip else []), b'')
+
+    if use_gzip:
+        body = gzipped if gzipped != None else gzip.compress(body)
+
+    return (code, out, body)
+
+class http_requesthandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def _handle(self, method, raw_body):
+        headers = { name.lower(): value for name, value in self.headers.items() }
+
+        self._reply(*respond(self.server.context_data, method, self.path, headers, raw_body))
+
+    def _reply(self, code, out, body):
+        self.send_response(code)
+
+        for name, value in out:
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle('GET', b'')
+
+    # raises http_error when the body is larger than 'limit' bytes (it is
+    # not read then) or its size is invalid; a chunked body is what e.g.
+    # curl sends for NDJSON from a pipe
+    def _read_body(self, headers, limit):
+        if headers.get('transfer-encoding', '').lower() != 'chunked':
+            return self.rfile.read(content_length(headers, limit))
+
+        chunks = []
+        size   = 0
+
+        while True:
+            n = chunk_size(self.rfile.readline())
+
+            if n == 0:
+                # trailers
+                while not self.rfile.readline() in (b'\r\n', b'\n', b''):
+                    pass
+
+                return b''.join(chunks)
+
+            size += n
+
+            if size > limit:
+                raise http_error(413, 'too large')
+
+            chunks.append(self.rfile.read(n))
+
+            self.rfile.readline()
+
+    def do_POST(self):
+        headers = { name.lower(): value for name, value in self.headers.items() }
+
+        try:
+            raw_body = self._read_body(headers, self.server.context_data.ingest.max_bytes)
+
+        except http_error as he:
+            self.close_connection = True
+
+            self._reply(he.code, [ ('Content-Type', 'text/html') ], bytes(str(he), 'utf8'))
+
+            return
 
-            self.wfile.write(bytes('nope', 'utf8'))
+        self._handle('POST', raw_body)
 
 class http_server(threading.Thread):
     def __init__(self, port, ghbot):
@@ -126,10 +339,12 @@ class http_server(threading.Thread):
         self.start()
 
     def run(self):
-        socketserver.TCPServer.allow_reuse_address = True
+        # a thread per connection, so that a slow client only delays itself
+        ThreadingHTTPServer.allow_reuse_address = True
+        ThreadingHTTPServer.daemon_threads      = True
 
         while True:
-            server = socketserver.TCPServer(('', self.port), http_requesthandler)
+            server = ThreadingHTTPServer(('', self.port), http_requesthandler)
 
             server.context_data = self.ghbot
 
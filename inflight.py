@@ -0,0 +1,110 @@
+#! /usr/bin/python3
+
+import heapq
+from stats import histogram
+import threading
+import time
+
+
+# Keeps track of commands that were handed to MQTT plugins and are waiting
+# for a reply. Only commands that went out in an envelope (see envelope.py)
+# are tracked: a reply names the request it belongs to by its id. Legacy
+# traffic carries no id and can't be matched reliably (plugins also post
+# unsolicited messages and replies of several lines), so it is not counted.
+# Requests that are not answered before their deadline count as timeouts and
+# are passed to 'on_timeout'.
+class inflight_tracker(threading.Thread):
+    def __init__(self, timeout, on_timeout, autostart=True):
+        super().__init__(daemon=True)
+
+        self.timeout    = timeout
+        self.on_timeout = on_timeout  # function(command, channel)
+
+        self.lock       = threading.Lock()
+
+        self.requests   = dict()  # id -> (command, start, reply channel)
+        self.deadlines  = []      # heap of (deadline, id)
+
+        self.latencies  = dict()  # command -> histogram
+        self.answered   = dict()  # command -> count
+        self.timeouts   = dict()  # command -> count
+
+        # else the owner calls expire() regularly
+        if autostart:
+            self.name = 'GHBot in-flight'
+            self.start()
+
+    def add(self, id, command, channel):
+        now = time.time()
+
+        with self.lock:
+            self.requests[id] = (command, now, channel)
+
+            heapq.heappush(self.deadlines, (now + self.timeout, id))
+
+    # returns False when 'id' is not an open request (e.g. None: a reply
+    # without an envelope id, or one that timed out already)
+    def reply(self, id):
+        with self.lock:
+            if id == None or not id in self.requests:
+                return False
+
+            command, start, channel = self.requests.pop(id)
+
+            self.answered[command] = self.answered.get(command, 0) + 1
+
+            if not command in self.latencies:
+                self.latencies[command] = histogram()
+
+            latency = self.latencies[command]
+
+        latency.add(time.time() - start)
+
+        return True
+
+    def expire(self):
+        now     = time.time()
+        expired = []
+
+        with self.lock:
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                deadline, id = heapq.heappop(self.deadlines)
+
+                if not id in self.requests:
+                    continue  # answered
+
+                command, start, channel = self.requests.pop(id)
+
+                self.timeouts[command] = self.timeouts.get(command, 0) + 1
+
+                expired.append((command, channel))
+
+        for command, channel in expired:
+            try:
+                self.on_timeout(command, channel)
+
+            except Exception as e:
+                print(f'inflight_tracker::expire: exception {e}')
+
+    def run(self):
+        while True:
+            time.sleep(0.5)
+
+            self.expire()
+
+    def get_stats(self):
+        with self.lock:
+            commands = set(self.answered) | set(self.timeouts)
+
+            out = { 'inflight': len(self.requests), 'timeout': self.timeout, 'commands': dict() }
+
+            latencies = dict(self.latencies)
+
+            for command in commands:
+                out['commands'][command] = { 'answered': self.answered.get(command, 0), 'timeouts': self.timeouts.get(command, 0) }
+
+        for command in commands:
+            if command in latencies:
+                out['commands'][command]['latency'] = latencies[command].get_stats()
+
+        return out
@@ -1,13 +1,21 @@
 #! /usr/bin/python3
 
+from dispatcher import dispatcher
 from enum import Enum
+import envelope
+from line_reader import line_reader
 import math
+import metrics
+import os
 import select
+from send_queue import send_queue
 import socket
 import sys
 import threading
 import time
 import traceback
+from user_store import user_store
+from who_resolver import who_resolver
 
 class more():
     limit = 450
@@ -24,31 +32,31 @@ class more():
     def has_more(self, channel):
         return self.more[channel] != ''
 
-    def send(self, channel, text):
+    def send(self, channel, text, lane=send_queue.REPLY):
         try:
             if len(text) > more.limit:
                 self.more[channel] = text
 
-                self.send_more(channel)
+                self.send_more(channel, lane)
 
             else:
                 if channel[0] == '\\':
                     channel = channel[1:]
 
-                self.channel.send(f'{self.command} {channel} :{text}')
+                self.channel.send(f'{self.command} {channel} :{text}', lane)
 
                 self.more[channel] = ''
 
         except Exception as e:
             print(f'more::send: exception "{e}" at {e.__traceback__.tb_lineno}')
 
-    def send_more(self, channel):
+    def send_more(self, channel, lane=send_queue.REPLY):
         try:
             if not channel in self.more or self.more[channel] == '':
                 if channel[0] == '\\':
                     channel = channel[1:]
 
-                self.channel.send(f'{self.command} {channel} :No more more')
+                self.channel.send(f'{self.command} {channel} :No more more', lane)
 
             else:
                 space = self.more[channel].find(' ', 450, more.limit - 25)
@@ -69,7 +77,7 @@ class more():
                 if channel[0] == '\\':
                     channel = channel[1:]
 
-                self.channel.send(f'{self.command} {channel} :{current_more} \3{4}({n} more)')
+                self.channel.send(f'{self.command} {channel} :{current_more} \3{4}({n} more)', lane)
 
         except Exception as e:
             print(f'more::send_more: exception "{e}" at {e.__traceback__.tb_lineno}')
@@ -89,7 +97,11 @@ class ircbot(threading.Thread):
     state_timeout = 120         # state changes must not take longer than this
     last_ping     = time.time() # last time a PING was sent
 
-    def __init__(self, host, port, nick, password, channels, use_notice, owner):
+    # states in which run() has something to send itself
+    active_states = [ session_state.DISCONNECTING, session_state.CONNECTED_PASS, session_state.CONNECTED_NICK,
+                      session_state.CONNECTED_USER, session_state.CONNECTED_JOIN ]
+
+    def __init__(self, host, port, nick, password, channels, use_notice, owner, dispatch_settings=(4, 256), flood_settings=(2., 10., True, 1000), who_settings=(300., False), autostart=True):
         super().__init__()
 
         self.use_notice  = use_notice
@@ -104,21 +116,44 @@ class ircbot(threading.Thread):
         self.next        = dict()
 
         self.fd          = None
+        self.fd_lock     = threading.Lock()
+
+        self.reader      = line_reader()
+
+        # lets other threads wake up the receive loop on a state change
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
 
         self.owner       = owner
 
+        self.envelope_codec = None  # see ghbot
+        self.legacy_topics  = True
+
         self.state       = self.session_state.DISCONNECTED
         self.state_since = time.time()
 
-        self.users       = dict()
+        self.users       = user_store()
+        self.isupport    = dict()  # from 005
+        self.names_batch = dict()  # channel -> nicks, until 366
+        self.who_batch   = []      # until 315
+        self.just_joined = set()   # channels of which the NAMES list is expected
 
-        self.cond_352    = threading.Condition()
+        # seconds a WHO answer is used, send a WHO for each channel after joining it
+        self.who         = who_resolver(self, who_settings[0], who_settings[1])
 
         self.topics      = dict()
 
         self.more_priv   = more(self, 'PRIVMSG', channels)
         self.more_noti   = more(self, 'NOTICE' if use_notice else 'PRIVMSG',  channels)
 
+        # workers, queue size; the asyncio runtime brings its own dispatcher
+        self.dispatch_settings = dispatch_settings
+        self.dispatcher  = dispatcher(self.handle_irc_command_thread_wrapper, dispatch_settings[0], dispatch_settings[1]) if autostart else None
+
+        # penalty, burst, coalesce, lines per lane
+        self.sender      = send_queue(self.send_now, self._can_send, flood_settings[0], flood_settings[1], flood_settings[2], flood_settings[3])
+
         for channel in channels:
             self.joined_ch[channel] = False
             self.next     [channel] = False
@@ -130,13 +165,44 @@ class ircbot(threading.Thread):
 
         self.state_since = time.time()
 
+        if s == self.session_state.DISCONNECTED:
+            self.sender.clear()
+
+            self.users.clear()
+
+            self.who.clear()
+
+        try:
+            os.write(self.wakeup_w, b'\0')
+
+        except BlockingIOError as bioe:
+            pass  # a wake-up is pending already
+
+    def _is_me(self, nick):
+        return self.users.key(nick) == self.users.key(self.nick)
+
     def get_state(self):
         return self.state
 
-    def send(self, s):
+    def _can_send(self, lane):
+        if lane == send_queue.PROTOCOL:
+            return not self.state in [ self.session_state.DISCONNECTED, self.session_state.DISCONNECTING ]
+
+        return self.state == self.session_state.RUNNING
+
+    # queues a line for the writer thread
+    def send(self, s, lane=send_queue.REPLY):
+        return self.sender.put(s, lane)
+
+    # writes a line to the server right away
+    def send_now(self, s):
         try:
             print(s)
-            self.fd.send(f'{s}\r\n'.encode('utf-8'))
+
+            with self.fd_lock:
+                self.fd.sendall(f'{s}\r\n'.encode('utf-8'))
+
+            metrics.inc('ghbot_irc_lines_sent_total', (('command', s.split(' ', 1)[0].upper()),))
 
             return True
 
@@ -149,11 +215,11 @@ class ircbot(threading.Thread):
 
         return False
 
-    def send_notice(self, channel, text):
-        self.more_noti.send(channel, text)
+    def send_notice(self, channel, text, lane=send_queue.REPLY):
+        self.more_noti.send(channel, text, lane)
 
-    def send_ok(self, channel, text):
-        self.more_priv.send(channel, text)
+    def send_ok(self, channel, text, lane=send_queue.REPLY):
+        self.more_priv.send(channel, text, lane)
 
     def send_more(self, channel):
         if self.more_noti.has_more(channel):
@@ -171,6 +237,24 @@ class ircbot(threading.Thread):
     def send_error_notice(self, channel, text):
         self.more_noti.send(channel, f'\3{4}ERROR: \2{text}')
 
+    # publishes an IRC event in the legacy format and/or as an envelope;
+    # returns the (correlation) id that went along in the envelope, None
+    # when no envelope was sent
+    def _publish_irc(self, legacy_topic, channel, prefix, command, text, topic_class):
+        if self.legacy_topics:
+            self.mqtt.publish(legacy_topic, text, topic_class=topic_class)
+
+        if self.envelope_codec == None:
+            return None
+
+        id = envelope.next_id()
+
+        e = envelope.make(channel, prefix, command, text, id)
+
+        self.mqtt.publish(f'from/irc-v1/{envelope.channel_level(channel)}/{command}', envelope.encode(e, self.envelope_codec), topic_class=topic_class)
+
+        return id
+
     def parse_irc_line(self, s):
         # from https://stackoverflow.com/questions/930700/python-parsing-irc-messages
 
@@ -193,26 +277,16 @@ class ircbot(threading.Thread):
 
         return prefix, command, args
 
-    def invoke_who_and_wait(self, user):
-        self.send(f'WHO {user}')
-
-        start = time.time()
-
-        while self.check_user_known(user) == False:
-            t_diff = time.time() - start
-
-            if t_diff >= 5.0:
-                break
-
-            with self.cond_352:
-                self.cond_352.wait(5.0 - t_diff)
-
     def similar_to(self, wrong):
         assert False
 
     def invoke_internal_commands(self, prefix, command, splitted_args, channel):
         return self.internal_command_rc.NOT_INTERNAL
 
+    # a command was handed to the plugins; replies go to 'channel'
+    def command_dispatched(self, id, command, channel):
+        pass
+
     def handle_irc_commands(self, prefix, command, args):
         self.last_ping = time.time()
 
@@ -226,23 +300,52 @@ class ircbot(threading.Thread):
 
                     self._set_state(self.session_state.DISCONNECTING)
 
+            elif command == '005':  # what the server supports
+                for token in args[1:-1]:
+                    name, sep, value = token.partition('=')
+
+                    self.isupport[name] = value
+
+                    if name == 'CASEMAPPING':
+                        self.users.set_casemapping(value)
+
+                    elif name == 'PREFIX' and ')' in value:  # e.g. (ov)@+
+                        self.users.set_prefixes(value[value.find(')') + 1:])
+
             elif command == '352':  # reponse to 'WHO'
                 #print(prefix, command, args)
-                self.users[args[5].lower()] = f'{args[5]}!{args[2]}@{args[3]}'
+                self.who_batch.append((args[5], args[2], args[3], args[1] if args[1] != '*' else None))
+
+                self.who.on_reply(args[5], args[2], args[3])
+
+            elif command == '354':  # reponse to WHOX: token, user, host, nick, account
+                if len(args) >= 6 and args[1] == who_resolver.whox_token:
+                    self.who_batch.append((args[4], args[2], args[3], None))
+
+                    self.who.on_reply(args[4], args[2], args[3], args[5])
+
+            elif command == '315':  # end of WHO
+                self.users.who(self.who_batch)
+
+                self.who_batch = []
+
+                self.who.on_end(args[1])
 
             elif command == '353':  # users in the channel
-                for user in args[3].split(' '):
-                    self.users[user.lower()] = '?'
+                self.names_batch.setdefault(args[2], []).extend(args[3].split(' '))
+
+            elif command == '366':  # end of NAMES
+                self.users.names(args[1], self.names_batch.pop(args[1], []))
+
+                if args[1] in self.just_joined:
+                    self.just_joined.discard(args[1])
+
+                    self.who.on_joined(args[1])
 
             elif command == '331' or command == '332':  # no topic set / topic
                 self.topics[args[1][1:]] = args[2]
 
-                self.mqtt.publish(f'from/irc/{args[1][1:]}/topic', args[2])
-
-            # 315 is 'end of who'
-            if command == '352' or command == '315':
-                with self.cond_352:
-                    self.cond_352.notify_all()
+                self._publish_irc(f'from/irc/{args[1][1:]}/topic', args[1], prefix, 'topic', args[2], 'state')
 
         elif command == 'JOIN':
             if self.state == self.session_state.CONNECTED_WAIT:
@@ -259,49 +362,51 @@ class ircbot(threading.Thread):
                 if all_joined:
                     self._set_state(self.session_state.RUNNING)
 
-            self.users[prefix.split('!')[0].lower()] = prefix.lower()
+            if self._is_me(prefix.split('!')[0]):
+                self.users.joined(args[0])
 
-        elif command == 'PART' or command == 'QUIT':
-            #print(prefix, command)
-            nick = prefix.split('!')[0].lower()
+                self.just_joined.add(args[0])
 
-            if nick in self.users:
-                del self.users[nick]
+            self.users.join(args[0], prefix)
 
-        elif command == 'KICK':
-            nick = args[1].lower()
+        elif command == 'PART':
+            #print(prefix, command)
+            nick = prefix.split('!')[0]
 
-            if nick in self.users:
-                del self.users[nick]
+            for channel in args[0].split(','):
+                if self._is_me(nick):
+                    self.users.parted(channel)
 
-        elif command == 'NICK':
-            try:
-                old_lower_prefix = prefix.lower()
+                else:
+                    self.users.part(channel, nick)
 
-                excl_mark    = old_lower_prefix.find('!')
+        elif command == 'QUIT':
+            self.users.quit(prefix.split('!')[0])
 
-                old_user     = old_lower_prefix[0:excl_mark]
+            self.who.forget(prefix.split('!')[0])
 
-                if old_user in self.users:
-                    del self.users[old_user]
-            
-                new_user     = args[0].lower()
+        elif command == 'KICK':
+            if self._is_me(args[1]):
+                self.users.parted(args[0])
 
-                new_prefix   = new_user + old_lower_prefix[excl_mark:]
+            else:
+                self.users.part(args[0], args[1])
 
-                self.users[new_user] = new_prefix
+        elif command == 'NICK':
+            try:
+                self.users.nick_change(prefix.split('!')[0], args[0])
 
-                #print(f'{old_lower_prefix} => {new_prefix}')
+                self.who.forget(prefix.split('!')[0])
 
             except Exception as e:
                 self.send_notice(self.owner, f'irc::handle_irc_command: exception "{e}" during execution of IRC command NICK at line number: {e.__traceback__.tb_lineno}')
 
         elif command == 'PING':
             if len(args) >= 1:
-                self.send(f'PONG {args[0]}')
+                self.send(f'PONG {args[0]}', send_queue.PROTOCOL)
 
             else:
-                self.send(f'PONG')
+                self.send(f'PONG', send_queue.PROTOCOL)
             
             print("irc::run: PONG")
             self.last_ping = time.time()
@@ -361,8 +466,10 @@ class ircbot(threading.Thread):
 
                             method = self.send_error
 
-                        if command in self.plugins_gone:
-                            method(channel, f'{nick}: command "{command}" is unresponsive for {time.time() - self.plugins_gone[command]:.2f} seconds')
+                        gone_since = self.plugins.gone_since(command)
+
+                        if gone_since != None:
+                            method(channel, f'{nick}: command "{command}" is unresponsive for {time.time() - gone_since:.2f} seconds')
 
                         else:
                             rc = self.check_aliasses(text[1:], prefix, False, channel)
@@ -404,10 +511,14 @@ class ircbot(threading.Thread):
                                     if '!' in person:
                                         person = person[0:person.find('!')]
 
-                                    self.mqtt.publish(f'from/irc/\\{person}/{prefix}/{command}', text)
+                                    id = self._publish_irc(f'from/irc/\\{person}/{prefix}/{command}', person, prefix, command, text, 'command')
+
+                                    self.command_dispatched(id, command, person)
 
                                 else:
-                                    self.mqtt.publish(f'from/irc/{channel[1:]}/{prefix}/{command}', text)
+                                    id = self._publish_irc(f'from/irc/{channel[1:]}/{prefix}/{command}', channel, prefix, command, text, 'command')
+
+                                    self.command_dispatched(id, command, channel)
 
                             elif rc == self.internal_command_rc.ERROR:
                                 pass
@@ -419,16 +530,16 @@ class ircbot(threading.Thread):
                             self.send_error(response_channel, f'Command "{command}" denied for user "{prefix}", one must be in {group_for_command}')
 
                 else:
-                    self.mqtt.publish(f'from/irc/{channel[1:]}/{prefix}/message', args[1])
+                    self._publish_irc(f'from/irc/{channel[1:]}/{prefix}/message', channel, prefix, 'message', args[1], 'message')
 
         elif command == 'NOTICE':
             if len(args) >= 2:
-                self.mqtt.publish(f'from/irc/{args[0][1:]}/{prefix}/notice', args[1])
+                self._publish_irc(f'from/irc/{args[0][1:]}/{prefix}/notice', args[0] if args[0][0] == '#' else prefix.split('!')[0], prefix, 'notice', args[1], 'message')
 
         elif command == 'TOPIC':
             self.topics[args[0][1:]] = args[1]
 
-            self.mqtt.publish(f'from/irc/{args[0][1:]}/topic', args[1])
+            self._publish_irc(f'from/irc/{args[0][1:]}/topic', args[0], prefix, 'topic', args[1], 'state')
 
         elif command == 'INVITE':
             # do not enter any channel, only the selected
@@ -445,6 +556,8 @@ class ircbot(threading.Thread):
         return True
 
     def handle_irc_command_thread_wrapper(self, prefix, command, arguments):
+        start = time.perf_counter()
+
         try:
             if self.irc_command_insertion_point(prefix, command, arguments):
                 self.handle_irc_commands(prefix, command, arguments)
@@ -454,11 +567,124 @@ class ircbot(threading.Thread):
 
             traceback.print_exc(file=sys.stdout)
 
+        metrics.observe('ghbot_dispatch_seconds', (('command', command),), time.perf_counter() - start)
+
+    # returns the ordering key (None for the protocol worker) and whether
+    # the line may be dropped when the bot cannot keep up
+    def _dispatch_key(self, prefix, command, arguments):
+        if command in [ 'PRIVMSG', 'NOTICE' ] and len(arguments) >= 2:
+            target = arguments[0]
+
+            if target[0] in '#&':
+                key = target.lower()
+
+            else:
+                key = prefix.split('!')[0].lower()
+
+            droppable = command == 'NOTICE' or arguments[1][0:1] != self.cmd_prefix
+
+            return key, droppable
+
+        if command == 'TOPIC' and len(arguments) >= 1:
+            return arguments[0].lower(), False
+
+        return None, False
+
+    # how long (in ms) the receive loop may wait for data in the current state
+    def _poll_timeout(self):
+        if self.state in ircbot.active_states:
+            return 0
+
+        if self.state == self.session_state.RUNNING:
+            return None  # until data arrives or the state changes
+
+        return max(0., ircbot.state_timeout - (time.time() - self.state_since)) * 1000
+
+    def _receive(self):
+        try:
+            data = self.fd.recv(16384)
+
+        except Exception as e:
+            print(f'irc::run: cannot receive from irc-server: {e}')
+
+            data = b''
+
+        if data == b'':
+            if not self.state in [ self.session_state.DISCONNECTED, self.session_state.DISCONNECTING ]:
+                print('irc::run: connection to irc-server lost')
+
+                self._set_state(self.session_state.DISCONNECTING)
+
+            return
+
+        for key, droppable, prefix, command, arguments in self._parse_received(data):
+            # dropped lines are counted in the dispatcher statistics
+            self.dispatcher.put(key, droppable, prefix, command, arguments)
+
+    # yields (key, droppable, prefix, command, arguments) for each line completed by 'data'
+    def _parse_received(self, data):
+        for line in self.reader.feed(data):
+            prefix, command, arguments = self.parse_irc_line(line)
+
+            metrics.inc('ghbot_irc_lines_received_total', (('command', command),))
+
+            key, droppable = self._dispatch_key(prefix, command, arguments)
+
+            yield key, droppable, prefix, command, arguments
+
+    # sends what the current registration state requires
+    def _registration_step(self):
+        if self.state == self.session_state.CONNECTED_PASS:
+            if self.password == '' or self.password == None or self.send_now(f'PASS {self.password}'):
+                self._set_state(self.session_state.CONNECTED_NICK)
+
+        elif self.state == self.session_state.CONNECTED_NICK:
+            # apparently only error responses are returned, no acks
+            if self.send_now(f'NICK {self.nick}'):
+                self._set_state(self.session_state.CONNECTED_USER)
+
+        elif self.state == self.session_state.CONNECTED_USER:
+            if self.send_now(f'USER {self.nick} 0 * :{self.nick}'):
+                self._set_state(self.session_state.USER_WAIT)
+
+        elif self.state == self.session_state.CONNECTED_JOIN:
+            all_ok = True
+
+            for channel in self.channels:
+                if self.send_now(f'JOIN {channel}') == False:
+                    all_ok = False
+
+                    break
+
+            if all_ok:
+                self._set_state(self.session_state.CONNECTED_WAIT)
+
+        elif self.state == self.session_state.USER_WAIT:
+            # handled elsewhere
+            pass
+
+        elif self.state == self.session_state.CONNECTED_WAIT:
+            # handled elsewhere
+            pass
+
+        elif self.state == self.session_state.RUNNING:
+            pass
+
+        else:
+            print(f'irc::run: internal error, invalid state {self.state}')
+
+    def _check_state_timeout(self):
+        if not self.state in [ self.session_state.DISCONNECTED, self.session_state.DISCONNECTING, self.session_state.RUNNING ]:
+            takes = time.time() - self.state_since
+
+            if takes > ircbot.state_timeout:
+                #print(f'irc::run: state {self.state} timeout ({takes} > {ircbot.state_timeout})')
+
+                self._set_state(self.session_state.DISCONNECTING)
+
     def run(self):
         print('irc::run: started')
 
-        buffer = ''
-
         while True:
             if self.state == self.session_state.DISCONNECTING:
                 self.fd.close()
@@ -473,9 +699,12 @@ class ircbot(threading.Thread):
                 try:
                     self.fd.connect((self.host, self.port))
 
+                    self.reader.reset()
+
                     self.poller = select.poll()
 
                     self.poller.register(self.fd, select.POLLIN)
+                    self.poller.register(self.wakeup_r, select.POLLIN)
 
                     self._set_state(self.session_state.CONNECTED_PASS)
 
@@ -484,76 +713,27 @@ class ircbot(threading.Thread):
                     
                     self.fd.close()
 
-            elif self.state == self.session_state.CONNECTED_PASS:
-                if self.password == '' or self.password == None or self.send(f'PASS {self.password}'):
-                    self._set_state(self.session_state.CONNECTED_NICK)
-
-            elif self.state == self.session_state.CONNECTED_NICK:
-                # apparently only error responses are returned, no acks
-                if self.send(f'NICK {self.nick}'):
-                    self._set_state(self.session_state.CONNECTED_USER)
-
-            elif self.state == self.session_state.CONNECTED_USER:
-                if self.send(f'USER {self.nick} 0 * :{self.nick}'):
-                    self._set_state(self.session_state.USER_WAIT)
-
-            elif self.state == self.session_state.CONNECTED_JOIN:
-                all_ok = True
-
-                for channel in self.channels:
-                    if self.send(f'JOIN {channel}') == False:
-                        all_ok = False
-
-                        break
-
-                if all_ok:
-                    self._set_state(self.session_state.CONNECTED_WAIT)
-
-            elif self.state == self.session_state.USER_WAIT:
-                # handled elsewhere
-                pass
-
-            elif self.state == self.session_state.CONNECTED_WAIT:
-                # handled elsewhere
-                pass
-
-            elif self.state == self.session_state.RUNNING:
-                pass
-
             else:
-                print(f'irc::run: internal error, invalid state {self.state}')
-
-            if self.state != self.session_state.DISCONNECTED and (len(buffer) > 0 or len(self.poller.poll(100)) > 0):
-                lf_index = buffer.find('\n')
+                self._registration_step()
 
-                if lf_index == -1:
-                    try:
-                        buffer += self.fd.recv(4096).decode('utf-8')
+            if self.state != self.session_state.DISCONNECTED:
+                for fd, event in self.poller.poll(self._poll_timeout()):
+                    if fd == self.wakeup_r:
+                        try:
+                            os.read(self.wakeup_r, 4096)
 
-                    except Exception as e:
-                        print(f'irc::run: cannot decode text from irc-server')
+                        except BlockingIOError as bioe:
+                            pass
 
-                    lf_index = buffer.find('\n')
-
-                    if lf_index == -1:
-                        continue
-                
-                line = buffer[0:lf_index].rstrip('\r').strip()
-                buffer = buffer[lf_index + 1:]
+                    elif event & select.POLLIN:
+                        self._receive()
 
-                prefix, command, arguments = self.parse_irc_line(line)
+                    elif not self.state in [ self.session_state.DISCONNECTED, self.session_state.DISCONNECTING ]:
+                        print(f'irc::run: connection to irc-server failed (poll event {event})')
 
-                t = threading.Thread(target=self.handle_irc_command_thread_wrapper, args=(prefix, command, arguments), daemon=True)
-                t.name = 'GHBot input'
-                t.start()
+                        self._set_state(self.session_state.DISCONNECTING)
 
-            if not self.state in [ self.session_state.DISCONNECTED, self.session_state.DISCONNECTING, self.session_state.RUNNING ]:
-                takes = time.time() - self.state_since
-
-                if takes > ircbot.state_timeout:
-                    #print(f'irc::run: state {self.state} timeout ({takes} > {ircbot.state_timeout})')
-
-                    self._set_state(self.session_state.DISCONNECTING)
+            self._check_state_timeout()
 
 class irc_keepalive(threading.Thread):
     def __init__(self, i):
@@ -0,0 +1,89 @@
+#! /usr/bin/python3
+
+
+# Splits what comes from recv() into lines. Data is kept as bytes until a
+# line is complete: a UTF-8 sequence cannot contain a '\n' byte so it can't
+# be split by it, and a sequence that was cut in two by recv() is whole
+# again by the time its line is decoded. Lines that are not valid UTF-8
+# (older clients often send latin-1) are decoded as latin-1 instead of
+# being dropped.
+class line_reader:
+    max_line_length = 16384  # ircv3 allows 8191 bytes of tags + 512 bytes of message
+
+    def __init__(self):
+        self.buffer     = bytearray()
+        self.discarding = False  # a line was too long: drop the rest of it
+
+        self.lines      = 0
+        self.fallbacks  = 0  # lines that were decoded as latin-1
+        self.overflows  = 0  # lines that were dropped for being too long
+
+    def reset(self):
+        self.buffer.clear()
+
+        self.discarding = False
+
+    @staticmethod
+    def _decode(b):
+        try:
+            return b.decode('utf-8'), False
+
+        except UnicodeDecodeError as ude:
+            return b.decode('latin-1'), True
+
+    # returns the list of lines that were completed by 'data'; the part of
+    # a line that is too long that comes after the cut is not a line of its
+    # own (it is whatever the sender put there), it is skipped up to and
+    # including its '\n'
+    def feed(self, data):
+        if self.discarding:
+            end = data.find(b'\n')
+
+            if end == -1:
+                return []
+
+            data = data[end + 1:]
+
+            self.discarding = False
+
+        self.buffer += data
+
+        end = self.buffer.rfind(b'\n')
+
+        out = []
+
+        if end != -1:
+            chunks = bytes(memoryview(self.buffer)[0:end]).split(b'\n')
+
+            del self.buffer[0:end + 1]
+
+            for chunk in chunks:
+                if len(chunk) > line_reader.max_line_length:
+                    self.overflows += 1
+
+                    continue
+
+                line, fallback = self._decode(chunk)
+
+                line = line.rstrip('\r').strip()
+
+                if line == '':
+                    continue
+
+                out.append(line)
+
+                self.fallbacks += fallback
+
+            self.lines += len(out)
+
+        if len(self.buffer) > line_reader.max_line_length:
+            self.buffer.clear()
+
+            self.discarding = True
+
+            self.overflows += 1
+
+        return out
+
+    def get_stats(self):
+        return { 'lines': self.lines, 'latin-1': self.fallbacks, 'overflows': self.overflows, 'buffered': len(self.buffer) }
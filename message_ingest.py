@@ -0,0 +1,253 @@
+#! /usr/bin/python3
+
+import hmac
+import json
+import metrics
+from send_queue import send_queue
+import threading
+import time
+import token_bucket
+
+
+class ingest_error(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+
+        self.code = code
+
+# Messages posted via HTTP (/post-message.cgi): one {"channel": ..., "text": ...}
+# object, a JSON array of them or NDJSON (one object per line). A batch is
+# checked as a whole (no CR/LF/NUL, size limits) before anything is sent;
+# then the messages are grouped per channel, joined into as few lines as
+# fit, and put in the broadcast lane of the send queue so that the poster
+# does not wait for IRC.
+#
+# With 'tokens' (name -> token) a poster must send "Authorization: Bearer
+# <token>"; the name is the source that the rate limit (a token bucket of
+# 'capacity' lines, refilled with 'refill_rate' per second) applies to. It
+# counts the lines that go to IRC after joining, so many short messages cost
+# little; a batch that needs more than 'capacity' lines can never be sent
+# and gets a 413 instead of a 429. A batch is accepted only as a whole and
+# only when the broadcast lane of the send queue has room for all of it
+# (else 503), so that nothing that got a 202 is dropped later on.
+# Without tokens everyone shares the source 'anonymous'.
+class message_ingest:
+    separator = ' / '
+
+    def __init__(self, bot, tokens=dict(), max_bytes=1048576, max_messages=1000, capacity=100., refill_rate=2.):
+        self.bot          = bot
+        self.tokens       = tokens
+        self.max_bytes    = max_bytes
+        self.max_messages = max_messages
+        self.capacity     = capacity
+        self.refill_rate  = refill_rate
+
+        self.lock         = threading.Lock()
+
+        self.buckets      = dict()  # source -> TokenBucket
+
+    # returns the source or None when the token is missing or wrong
+    def authenticate(self, headers):
+        if len(self.tokens) == 0:
+            return 'anonymous'
+
+        scheme, sep, token = headers.get('authorization', '').partition(' ')
+
+        if scheme.lower() != 'bearer' or token == '':
+            return None
+
+        for name, secret in self.tokens.items():
+            if hmac.compare_digest(token.strip().encode('utf8'), secret.encode('utf8')):
+                return name
+
+        return None
+
+    # returns a list of (channel, text) and whether the body was one object
+    def parse(self, raw_body):
+        if len(raw_body) > self.max_bytes:
+            raise ingest_error(413, f'More than {self.max_bytes} bytes')
+
+        try:
+            body = raw_body.decode('utf8').strip()
+
+        except UnicodeDecodeError as ude:
+            raise ingest_error(400, 'Not UTF-8')
+
+        single = False
+
+        try:
+            if body.startswith('['):
+                items = json.loads(body)
+
+            else:
+                items = [ json.loads(body) ]
+
+                single = True
+
+        except json.JSONDecodeError as jde:
+            # NDJSON
+            items  = []
+
+            single = False
+
+            for nr, line in enumerate(body.split('\n')):
+                if line.strip() == '':
+                    continue
+
+                try:
+                    items.append(json.loads(line))
+
+                except json.JSONDecodeError as jde:
+                    raise ingest_error(400, f'Line {nr + 1} is not JSON: {jde}')
+
+        if len(items) == 0:
+            raise ingest_error(400, 'No messages')
+
+        if len(items) > self.max_messages:
+            raise ingest_error(413, f'More than {self.max_messages} messages')
+
+        return [ self._check(nr, item) for nr, item in enumerate(items) ], single
+
+    def _check(self, nr, item):
+        if not isinstance(item, dict) or not isinstance(item.get('channel'), str) or not isinstance(item.get('text'), str):
+            raise ingest_error(400, f'Message {nr}: "channel" and/or "text" missing')
+
+        channel = item['channel']
+        text    = item['text'].strip()
+
+        if channel == '' or any(c in channel for c in ' ,\r\n\0\7'):
+            raise ingest_error(400, f'Message {nr}: invalid channel')
+
+        if any(c in text for c in '\r\n\0'):
+            raise ingest_error(400, f'Message {nr}: CR, LF or NUL in text')
+
+        if text == '':
+            raise ingest_error(400, f'Message {nr}: empty text')
+
+        return channel, text
+
+    def _bucket(self, source):
+        with self.lock:
+            if not source in self.buckets:
+                self.buckets[source] = token_bucket.TokenBucket(self.capacity, self.refill_rate)
+
+            return self.buckets[source]
+
+    # bytes of 'PRIVMSG <channel> :<text>' in an IRC line of 512 bytes
+    # (including CR LF), with room for the ':nick!user@host ' that the
+    # server puts in front of it when passing it on
+    @staticmethod
+    def text_limit(channel, prefix_reserve=100):
+        return 512 - 2 - prefix_reserve - len(f'PRIVMSG {channel} :'.encode('utf8'))
+
+    # pieces of at most 'limit' bytes (UTF-8), split at a space where possible
+    @staticmethod
+    def split(text, limit):
+        pieces = []
+
+        while len(text.encode('utf8')) > limit:
+            # whole characters only
+            piece = text.encode('utf8')[0:limit].decode('utf8', 'ignore')
+
+            space = piece.rfind(' ')
+
+            if space > 0:
+                piece = piece[0:space]
+
+            pieces.append(piece)
+
+            text = text[len(piece):].strip()
+
+        if text != '':
+            pieces.append(text)
+
+        return pieces
+
+    # texts for the same channel, joined into as few lines as fit in an IRC
+    # line; longer texts are split
+    @staticmethod
+    def coalesce(messages):
+        lines = dict()  # channel -> [ line, ... ], in the order of first appearance
+        sep   = len(message_ingest.separator.encode('utf8'))
+
+        for channel, text in messages:
+            channel_lines = lines.setdefault(channel, [])
+
+            limit = message_ingest.text_limit(channel)
+
+            for piece in message_ingest.split(text, limit):
+                if len(channel_lines) > 0 and len(channel_lines[-1].encode('utf8')) + sep + len(piece.encode('utf8')) <= limit:
+                    channel_lines[-1] += message_ingest.separator + piece
+
+                else:
+                    channel_lines.append(piece)
+
+        return [ (channel, line) for channel, channel_lines in lines.items() for line in channel_lines ]
+
+    # returns the http status code, the reply (a dict) and whether the body
+    # was one object (the form that /post-message.cgi always accepted)
+    def submit(self, headers, raw_body):
+        source = self.authenticate(headers)
+
+        if source == None:
+            metrics.inc('ghbot_http_messages_total', (('source', '(unauthorized)'), ('result', 'refused')))
+
+            return 401, { 'error': 'Missing or wrong token' }, False
+
+        try:
+            messages, single = self.parse(raw_body)
+
+        except ingest_error as ie:
+            metrics.inc('ghbot_http_messages_total', (('source', source), ('result', 'invalid')))
+
+            return ie.code, { 'error': str(ie) }, False
+
+        lines = []
+
+        for channel, text in self.coalesce(messages):
+            # \nick: a private message, as with send_ok()
+            if channel[0] == '\\':
+                channel = channel[1:]
+
+            lines.append(f'PRIVMSG {channel} :{text}')
+
+        if len(lines) > self.capacity:
+            metrics.inc('ghbot_http_messages_total', (('source', source), ('result', 'invalid')), len(messages))
+
+            return 413, { 'error': f'Needs {len(lines)} lines, at most {self.capacity:g} are allowed at once' }, False
+
+        sender = self.bot.sender
+
+        if sender.room(send_queue.BROADCAST) < len(lines):
+            metrics.inc('ghbot_http_messages_total', (('source', source), ('result', 'queue-full')), len(messages))
+
+            return 503, { 'error': 'Send queue is full' }, False
+
+        if not self._bucket(source).allow_request(len(lines)):
+            metrics.inc('ghbot_http_messages_total', (('source', source), ('result', 'rate-limited')), len(messages))
+
+            return 429, { 'error': f'Rate limited ({self.capacity:g} lines, {self.refill_rate:g} per second)', 'retry_after': len(lines) / self.refill_rate }, False
+
+        # the lane may have filled up since room() (the tokens are spent then)
+        if not sender.put_all(lines, send_queue.BROADCAST):
+            metrics.inc('ghbot_http_messages_total', (('source', source), ('result', 'queue-full')), len(messages))
+
+            return 503, { 'error': 'Send queue is full' }, False
+
+        metrics.inc('ghbot_http_messages_total', (('source', source), ('result', 'accepted')), len(messages))
+
+        # lines in the broadcast lane up to and including the last one of this batch
+        position, eta = sender.backlog(send_queue.BROADCAST)
+
+        return 202, { 'accepted': len(messages), 'lines': len(lines), 'position': position, 'eta': eta }, single
+
+metrics.describe('ghbot_http_messages_total', 'counter', 'Messages posted via HTTP, per source and result')
+
+if __name__ == "__main__":
+    messages = [ ('#test', f'build {i} failed') for i in range(100) ] + [ ('#ops', 'x' * 1000), ('#ops', 'ü€ ' * 300) ]
+
+    start = time.time()
+
+    lines = message_ingest.coalesce(messages)
+
+    print(f'{len(messages)} messages -> {len(lines)} lines in {(time.time() - start) * 1000:.2f} ms')
@@ -0,0 +1,247 @@
+#! /usr/bin/python3
+
+import bisect
+from stats import histogram
+import threading
+import time
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, extra=''):
+    text = ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+    if extra != '':
+        text = f'{text},{extra}' if text != '' else extra
+
+    return '{' + text + '}' if text != '' else ''
+
+# Counters and histograms in the Prometheus text format (version 0.0.4).
+# Every thread counts in a dict of its own, so inc() and observe() take no
+# lock; render() adds the dicts up. Those of threads that stopped (e.g. the
+# ones that served a HTTP connection) are folded into 'retired' then, and
+# when a new thread finds that the list of shards doubled since the last
+# time (so that a bot that is never scraped does not keep them all).
+# Gauges are functions that are invoked by render(); they return a number or
+# a dict of labels -> number.
+#
+# 'labels' is a tuple of (name, value) pairs, e.g. (('command', 'PRIVMSG'),).
+# The histogram buckets are those of stats.histogram with a few below 5 ms
+# for the database and the lookups.
+class metrics:
+    bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025) + histogram.bounds
+
+    def __init__(self):
+        self.lock    = threading.Lock()
+
+        self.local   = threading.local()
+        self.shards  = []      # (thread, dict of (name, labels) -> value)
+        self.retired = dict()  # the same, of threads that are gone
+        self.prune   = 64      # fold in the dead shards when there are this many
+
+        self.types   = dict()  # name -> (type, help text)
+        self.gauges  = dict()  # name -> function
+
+    def describe(self, name, type_, text):
+        with self.lock:
+            self.types[name] = (type_, text)
+
+    def _shard(self):
+        try:
+            return self.local.shard
+
+        except AttributeError as ae:
+            shard = dict()
+
+            self.local.shard = shard
+
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+
+                if len(self.shards) >= self.prune:
+                    self._fold()
+
+                    self.prune = max(64, len(self.shards) * 2)
+
+            return shard
+
+    # folds the shards of threads that stopped into 'retired'; lock must be held
+    def _fold(self):
+        alive = []
+
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+
+            else:
+                for key, value in list(shard.items()):
+                    self._add(self.retired, key, value)
+
+        self.shards = alive
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key   = (name, labels)
+
+        shard[key] = shard.get(key, 0) + value
+
+    # 'value' in seconds
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        key   = (name, labels)
+
+        h = shard.get(key)
+
+        if h == None:
+            h = shard[key] = [0] * (len(metrics.bounds) + 2)  # bucket counts, > last bound, sum
+
+        h[bisect.bisect_left(metrics.bounds, value)] += 1
+        h[-1] += value
+
+    # decorator: observes how long the function takes
+    def timed(self, name, labels=()):
+        def wrap(function):
+            def timed_function(*args, **kwargs):
+                start = time.perf_counter()
+
+                try:
+                    return function(*args, **kwargs)
+
+                finally:
+                    self.observe(name, labels, time.perf_counter() - start)
+
+            timed_function.__name__ = function.__name__
+            timed_function.__doc__  = function.__doc__
+
+            return timed_function
+
+        return wrap
+
+    def gauge(self, name, function, text=''):
+        with self.lock:
+            self.gauges[name] = function
+
+            self.types[name]  = ('gauge', text)
+
+    @staticmethod
+    def _add(totals, key, value):
+        if isinstance(value, list):
+            if key in totals:
+                totals[key] = [ a + b for a, b in zip(totals[key], value) ]
+
+            else:
+                totals[key] = list(value)
+
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+    # returns (dict of (name, labels) -> value, dict of name -> gauge function)
+    def collect(self):
+        with self.lock:
+            self._fold()
+
+            alive  = list(self.shards)
+
+            totals = { key: list(value) if isinstance(value, list) else value for key, value in self.retired.items() }
+
+            gauges = dict(self.gauges)
+
+        # copying a dict and a list is atomic, whatever the owning thread does
+        for thread, shard in alive:
+            for key, value in list(shard.items()):
+                self._add(totals, key, list(value) if isinstance(value, list) else value)
+
+        return totals, gauges
+
+    def render(self):
+        totals, gauges = self.collect()
+
+        by_name = dict()
+
+        for (name, labels), value in totals.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        for name, function in gauges.items():
+            try:
+                value = function()
+
+            except Exception as e:
+                print(f'metrics::render: gauge {name} failed: {e}')
+
+                continue
+
+            by_name[name] = list(value.items()) if isinstance(value, dict) else [ ((), value) ]
+
+        with self.lock:
+            types = dict(self.types)
+
+        out = []
+
+        for name in sorted(by_name):
+            type_, text = types.get(name, ('histogram' if isinstance(by_name[name][0][1], list) else 'counter', ''))
+
+            if text != '':
+                out.append(f'# HELP {name} {text}')
+
+            out.append(f'# TYPE {name} {type_}')
+
+            for labels, value in sorted(by_name[name], key=lambda e: e[0]):
+                if not isinstance(value, list):
+                    out.append(f'{name}{_labels(labels)} {value}')
+
+                    continue
+
+                cumulative = 0
+
+                for bound, count in zip(metrics.bounds + (None, ), value):
+                    cumulative += count
+
+                    le = f'le="{bound:g}"' if bound != None else 'le="+Inf"'
+
+                    out.append(f'{name}_bucket{_labels(labels, le)} {cumulative}')
+
+                out.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+                out.append(f'{name}_count{_labels(labels)} {cumulative}')
+
+        return '\n'.join(out) + '\n'
+
+# one registry for the whole bot
+registry = metrics()
+
+describe = registry.describe
+inc      = registry.inc
+observe  = registry.observe
+timed    = registry.timed
+gauge    = registry.gauge
+render   = registry.render
+
+describe('ghbot_irc_lines_received_total', 'counter',   'Lines received from the IRC server, per command')
+describe('ghbot_irc_lines_sent_total',     'counter',   'Lines sent to the IRC server, per command')
+describe('ghbot_dispatch_seconds',         'histogram', 'Time spent handling a received IRC line, per command')
+describe('ghbot_acl_check_seconds',        'histogram', 'Time spent checking the ACLs of a bot command')
+describe('ghbot_db_query_seconds',         'histogram', 'Duration of database statements, per kind')
+describe('ghbot_lookup_seconds',           'histogram', 'Duration of define and suggestion lookups')
+describe('ghbot_mqtt_messages_total',      'counter',   'MQTT messages received and published, per topic class')
+describe('ghbot_rate_limited_total',       'counter',   'Bot commands refused by the per-user rate limit')
+
+if __name__ == "__main__":
+    n = 1000000
+
+    start = time.time()
+
+    for i in range(n):
+        inc('test_total', (('command', 'PRIVMSG'),))
+
+    print(f'inc: {(time.time() - start) * 1000000000 / n:.0f} ns')
+
+    start = time.time()
+
+    for i in range(n):
+        observe('test_seconds', (('command', 'PRIVMSG'),), 0.003)
+
+    print(f'observe: {(time.time() - start) * 1000000000 / n:.0f} ns')
+
+    gauge('test_threads', threading.active_count, 'Live threads')
+
+    print(render())
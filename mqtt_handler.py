@@ -1,12 +1,124 @@
 #! /usr/bin/python3
 
+import collections
+import logging
+import metrics
 import paho.mqtt.client as mqtt
 import threading
 import time
+from topic_trie import topic_trie
 
 
+log = logging.getLogger('mqtt_handler')
+
+# Outgoing messages are queued and published by a separate thread so that
+# the IRC side never waits for the broker. Every message has a class that
+# selects its QoS and retain flag:
+#   control  from/bot/command, from/bot/parameter/...
+#   command  bot commands for plugins
+#   state    channel topics
+#   message  channel messages and notices
+#   event    JOIN/PART/NICK/MODE/numerics
+# When the queue is half full, 'event' messages are dropped and only one in
+# 'sample' 'message' messages is kept; when it is full, messages of every
+# class are dropped (and counted), so that a broker that is gone can't make
+# the queue grow without bound.
+class mqtt_publisher(threading.Thread):
+    topic_classes = ('control', 'command', 'state', 'message', 'event')
+
+    def __init__(self, client, queue_size, qos, retain, sample):
+        super().__init__(daemon=True)
+
+        self.client     = client
+
+        self.queue_size = queue_size
+        self.qos        = qos     # topic class -> 0, 1 or 2
+        self.retain     = retain  # topic classes that are always retained
+        self.sample     = sample
+
+        self.q          = collections.deque()
+        self.cond       = threading.Condition()
+
+        self.stats      = { c: { 'queued': 0, 'published': 0, 'dropped': 0, 'sampled': 0, 'latency_sum': 0., 'latency_max': 0. } for c in mqtt_publisher.topic_classes }
+        self.n_message  = 0
+
+        self.name = 'GHBot MQTT publisher'
+        self.start()
+
+    # returns False when the message was dropped
+    def put(self, topic, content, persistent, topic_class):
+        stats = self.stats[topic_class]
+
+        with self.cond:
+            depth = len(self.q)
+
+            if depth >= self.queue_size:
+                stats['dropped'] += 1
+
+                return False
+
+            if depth >= self.queue_size // 2 and topic_class in ('message', 'event'):
+                if topic_class == 'event':
+                    stats['dropped'] += 1
+
+                    return False
+
+                self.n_message += 1
+
+                if self.n_message % self.sample != 0:
+                    stats['sampled'] += 1
+
+                    return False
+
+            self.q.append((time.time(), topic, content, persistent or topic_class in self.retain, topic_class))
+
+            stats['queued'] += 1
+
+            self.cond.notify()
+
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.q) == 0:
+                    self.cond.wait()
+
+                batch = list(self.q)
+
+                self.q.clear()
+
+            for ts, topic, content, retain, topic_class in batch:
+                try:
+                    self.client.publish(topic, content, qos=self.qos.get(topic_class, 0), retain=retain)
+
+                except Exception as e:
+                    log.error(f'mqtt_publisher::run: cannot publish to {topic}: {e}')
+
+                stats = self.stats[topic_class]
+
+                latency = time.time() - ts
+
+                stats['published']   += 1
+                stats['latency_sum'] += latency
+                stats['latency_max']  = max(stats['latency_max'], latency)
+
+                metrics.inc('ghbot_mqtt_messages_total', (('direction', 'out'), ('topic_class', topic_class)))
+
+    def get_stats(self):
+        out = { 'depth': len(self.q) }
+
+        for topic_class, stats in self.stats.items():
+            out[topic_class] = { 'queued': stats['queued'], 'published': stats['published'], 'dropped': stats['dropped'], 'sampled': stats['sampled'],
+                                 'latency_avg': stats['latency_sum'] / stats['published'] if stats['published'] > 0 else 0., 'latency_max': stats['latency_max'] }
+
+        return out
+
 class mqtt_handler(threading.Thread):
-    def __init__(self, broker_ip, broker_port, topic_prefix):
+    # queue size, qos per topic class, topic classes to retain, 1 in n 'message' kept under pressure
+    default_publish_settings = (10000, { 'control': 1, 'command': 1 }, set(), 4)
+
+    def __init__(self, broker_ip, broker_port, topic_prefix, autostart=True, publish_settings=default_publish_settings):
         super().__init__()
 
         self.client = mqtt.Client(client_id='harkbot_ghbot_daemon', clean_session=False)
@@ -14,6 +126,10 @@ class mqtt_handler(threading.Thread):
         self.topic_prefix = topic_prefix
 
         self.topics = []
+        self.trie   = topic_trie()  # topic filter -> callbacks, for on_message
+        self.raw    = set()         # callbacks that want the payload as bytes
+
+        self.classify = None        # topic -> topic class (or None), for the metrics of incoming messages
 
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
@@ -25,51 +141,84 @@ class mqtt_handler(threading.Thread):
                 break
 
             except Exception as e:
-                print(f'exception "{e}" at line number: {e.__traceback__.tb_lineno}')
+                log.error(f'exception "{e}" at line number: {e.__traceback__.tb_lineno}')
 
                 time.sleep(1)
 
-        self.name = 'GHBot MQTT'
-        self.start()
+        self.publisher = mqtt_publisher(self.client, publish_settings[0], publish_settings[1], publish_settings[2], publish_settings[3])
+
+        # else the asyncio runtime drives the client
+        if autostart:
+            self.name = 'GHBot MQTT'
+            self.start()
 
     def get_topix_prefix(self):
         return self.topic_prefix
 
-    def subscribe(self, topic, msg_recv_cb):
-        print(f'mqtt_handler::topic: subscribe to {self.topic_prefix}{topic}')
+    # with raw=True the callback gets the payload as bytes (e.g. for msgpack)
+    def subscribe(self, topic, msg_recv_cb, raw=False):
+        log.info(f'mqtt_handler::topic: subscribe to {self.topic_prefix}{topic}')
+
+        if raw:
+            self.raw.add(msg_recv_cb)
 
         self.topics.append((self.topic_prefix + topic, msg_recv_cb))
+        self.trie.add(self.topic_prefix + topic, msg_recv_cb)
         self.client.subscribe(self.topic_prefix + topic)
 
+    # attributes: persistent (retain, default False) and topic_class (default 'command')
     def publish(self, topic, content, **attributes):
-        print(f'mqtt_handler::topic: publish "{content}" to "{self.topic_prefix}{topic}"')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'mqtt_handler::topic: publish "{content}" to "{self.topic_prefix}{topic}"')
 
-        persistent = False
-        if 'persistent' in attributes:
-            persistent = attributes['persistent']
+        persistent  = attributes.get('persistent', False)
+        topic_class = attributes.get('topic_class', 'command')
 
-        self.client.publish(self.topic_prefix + topic, content, retain=persistent)
+        return self.publisher.put(self.topic_prefix + topic, content, persistent, topic_class)
+
+    # 'classify' gets the full topic and returns one of mqtt_publisher.topic_classes or None
+    def set_classifier(self, classify):
+        self.classify = classify
+
+    def get_stats(self):
+        return self.publisher.get_stats()
 
     def on_connect(self, client, userdata, flags, rc):
         for topic in self.topics:
-            print(f'mqtt_handler::topic: re-subscribe to {topic[0]}')
+            log.info(f'mqtt_handler::topic: re-subscribe to {topic[0]}')
             self.client.subscribe(topic[0])
 
     def on_message(self, client, userdata, msg):
-        # print(f'mqtt_handler::topic: received "{msg.payload}" in topic "{msg.topic}"')
+        # log.debug(f'mqtt_handler::topic: received "{msg.payload}" in topic "{msg.topic}"')
 
-        for topic in self.topics:
-            cleaned = topic[0].replace('#','')
+        callbacks = self.trie.match(msg.topic)
+
+        # incoming messages are classified by the route the topic takes
+        topic_class = self.classify(msg.topic) if self.classify != None and len(callbacks) > 0 else None
+
+        metrics.inc('ghbot_mqtt_messages_total', (('direction', 'in'), ('topic_class', topic_class if topic_class != None else 'unhandled')))
+
+        if len(callbacks) == 0:
+            log.warning(f'mqtt_handler::topic: no handler for topic "{msg.topic}"')
+
+            return
+
+        payload = None
+
+        # a callback that was subscribed via several matching filters is invoked once
+        for callback in callbacks:
+            if callback in self.raw:
+                callback(msg.topic, msg.payload)
 
-            if cleaned in msg.topic:
-                topic[1](msg.topic, msg.payload.decode('utf-8'))
+                continue
 
-                return
+            if payload == None:
+                payload = msg.payload.decode('utf-8')
 
-        print(f'mqtt_handler::topic: no handler for topic "{msg.topic}"')
+            callback(msg.topic, payload)
 
     def run(self):
         while True:
-            print('mqtt_handler::run: looping')
+            log.info('mqtt_handler::run: looping')
 
             self.client.loop_forever()
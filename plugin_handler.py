@@ -1,77 +1,644 @@
 #! /usr/bin/python3
 
 import importlib
+import json
+import multiprocessing
 import os
+import queue
+from stats import histogram
 import sys
+import threading
+import time
 
+try:
+    import inotify_simple
+
+except ImportError as ie:
+    inotify_simple = None
+
+
+# Stands in for the bot in a worker process: the send-methods that a plugin
+# calls are recorded and replayed by the bot when the call returns.
+class ghbot_proxy:
+    def __init__(self, attributes):
+        self.attributes = attributes  # e.g. nick and cmd_prefix of the bot
+        self.calls      = []
+
+    def __getattr__(self, name):
+        if name in self.attributes:
+            return self.attributes[name]
+
+        if name.startswith('send'):
+            return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+        raise AttributeError(f'{name} is not available to isolated plugins')
+
+# Main loop of a worker process: runs one call at a time. 'generation'
+# changes when the plugin was reloaded in the bot; the module is then
+# reloaded here as well.
+def _isolated_worker(conn):
+    generations = dict()  # module name -> generation that was imported
+
+    while True:
+        try:
+            module_name, generation, attributes, nick, parameters = conn.recv()
+
+        except EOFError as eofe:
+            return
+
+        try:
+            module = importlib.import_module(module_name)
+
+            if generations.get(module_name, generation) != generation:
+                module = importlib.reload(module)
+
+            generations[module_name] = generation
+
+            proxy = ghbot_proxy(attributes)
+
+            rc    = module.process(proxy, nick, parameters)
+
+            conn.send((True, (rc, proxy.calls)))
+
+        except Exception as e:
+            conn.send((False, f'{e}'))
+
+# Runs the process() of one local plugin in worker processes of its own so
+# that blocking or crashing does not take the dispatch thread with it.
+# Calls don't wait for the result; the send-calls of the plugin are
+# replayed when it is there. Each worker process has a thread in the bot
+# that hands it one call at a time. When a call takes longer than
+# 'timeout', only that process is killed and replaced; the command is then
+# reported as gone until a call succeeds. At most 'max_pending' calls per
+# worker wait for one; more are refused (the user is told the plugin is
+# busy) so that a plugin that hangs can't make the backlog grow without
+# bound. Calls that are refused or time out are counted as not handled.
+#
+# The processes are started by a forkserver, not forked from the bot: a
+# child of a process with this many threads could inherit a lock that is
+# held (e.g. of stdout or logging) and hang.
+class isolated_plugin:
+    context     = multiprocessing.get_context('forkserver')
+
+    max_pending = 10  # per worker process
+
+    def __init__(self, plugins, name, workers, timeout):
+        self.plugins    = plugins  # plugins_class
+        self.name       = name
+        self.workers    = workers
+        self.timeout    = timeout
+
+        self.lock       = threading.Lock()
+
+        self.jobs       = queue.Queue(workers * isolated_plugin.max_pending)  # (start, attributes, nick, parameters)
+        self.generation = 0  # incremented when the plugin is reloaded
+        self.busy       = 0
+
+        self.timeouts   = 0
+        self.crashes    = 0
+        self.restarts   = 0
+        self.rejected   = 0
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, daemon=True, name=f'GHBot isolated {name} {i}').start()
+
+    def _start_process(self):
+        conn, child_conn = isolated_plugin.context.Pipe()
+
+        process = isolated_plugin.context.Process(target=_isolated_worker, args=(child_conn,), daemon=True, name=f'GHBot {self.name}')
+        process.start()
+
+        child_conn.close()
+
+        return process, conn
+
+    # when the plugin was reloaded; the workers reload it before their next call
+    def reloaded(self):
+        with self.lock:
+            self.generation += 1
+
+    def call(self, nick, parameters):
+        ghbot      = self.plugins.ghbot
+
+        attributes = { 'nick': ghbot.nick, 'cmd_prefix': ghbot.cmd_prefix } if ghbot != None else dict()
+
+        try:
+            self.jobs.put_nowait((time.time(), attributes, nick, parameters))
+
+        except queue.Full as qf:
+            with self.lock:
+                self.rejected += 1
+
+            self.plugins._account(self.name, 0., False, True)
+
+            ghbot = self.plugins.ghbot
+
+            if ghbot != None:
+                ghbot.send_error(parameters[3], f'command {parameters[1]} is busy, try again later')
+
+    def _worker(self):
+        process, conn = self._start_process()
+
+        module_name   = f'{self.plugins.directory}.{self.name}'
+
+        while True:
+            start, attributes, nick, parameters = self.jobs.get()
+
+            with self.lock:
+                self.busy += 1
+
+                generation = self.generation
+
+            ok     = None  # None: timed out
+            result = None
+            broken = False
+
+            try:
+                conn.send((module_name, generation, attributes, nick, parameters))
+
+                if conn.poll(self.timeout):
+                    ok, result = conn.recv()
+
+            except (EOFError, OSError) as e:
+                ok     = False
+                result = f'worker process stopped ({e})'
+                broken = True
+
+            if ok == True:
+                self._done(start, parameters, result)
+
+            elif ok == False:
+                self._failed(start, parameters, result)
+
+            else:
+                self._timed_out(start, parameters)
+
+            # a process that hangs or died is replaced, the others are not affected
+            if ok == None or broken:
+                process.kill()
+                process.join()
+
+                conn.close()
+
+                process, conn = self._start_process()
+
+                with self.lock:
+                    self.restarts += 1
+
+            with self.lock:
+                self.busy -= 1
+
+    def _done(self, start, parameters, result):
+        rc, calls = result
+
+        self.plugins._account(self.name, time.time() - start, rc, False)
+
+        self.plugins._set_gone(parameters[1], False)
+
+        ghbot = self.plugins.ghbot
+
+        for method, args, kwargs in calls:
+            try:
+                getattr(ghbot, method)(*args, **kwargs)
+
+            except Exception as e:
+                print(f'isolated_plugin: replaying {method} of {self.name} failed: {e}')
+
+    def _failed(self, start, parameters, e):
+        with self.lock:
+            self.crashes += 1
+
+        print(f'while invoking isolated local plugin {self.name}: "{e}"')
+
+        self.plugins._account(self.name, time.time() - start, False, True)
+
+        self._report(parameters, f'command {parameters[1]} failed')
+
+    def _timed_out(self, start, parameters):
+        with self.lock:
+            self.timeouts += 1
+
+        print(f'isolated_plugin: {self.name} did not finish within {self.timeout} seconds, replacing its worker')
+
+        self.plugins._account(self.name, time.time() - start, False, True)
+
+        self._report(parameters, f'command {parameters[1]} timed out')
+
+    def _report(self, parameters, text):
+        prefix, command, arguments, channel = parameters
+
+        self.plugins._set_gone(command, True)
+
+        ghbot = self.plugins.ghbot
+
+        if ghbot != None:
+            ghbot.send_error(channel, text)
+
+    def get_stats(self):
+        with self.lock:
+            return { 'workers': self.workers, 'timeout': self.timeout, 'pending': self.jobs.qsize() + self.busy, 'timeouts': self.timeouts, 'crashes': self.crashes, 'restarts': self.restarts,
+                     'rejected': self.rejected }
+
+# A command is handed to the plugin that lists it in get_commandos() (see
+# 'dispatch'). Plugins that set 'catch_all = True' (or that have no
+# get_commandos()) get all commands that no plugin claims or handled, in
+# the order in which they were loaded.
+#
+# The commands of each plugin are kept in a manifest (in the __pycache__
+# directory of the plugins, next to the byte code of the plugins; it is
+# generated state) together with the mtime of its file. A plugin of which
+# the file did not change since then is imported when it is first needed,
+# not at startup. The directory is watched (inotify if inotify_simple is
+# installed, else by polling the mtimes) and a plugin that changed is
+# reloaded; the dispatch table is then replaced as a whole and the bot is
+# told which commands went away and which are new.
+#
+# Plugins in 'isolation_settings' ({ name: timeout }, number of worker
+# processes per plugin) run in worker processes (see isolated_plugin); the
+# command is then not offered to other plugins, but it is only counted as
+# handled in the statistics when the worker returned. Those plugins can
+# only call the send-methods of the bot.
 class plugins_class:
-    def __init__(self, ghbot_instance, directory, name_prefix):
-        print(self, ghbot_instance)
+    manifest_file = os.path.join('__pycache__', 'ghbot-manifest.json')
+
+    def __init__(self, ghbot_instance, directory, name_prefix, isolation_settings=(dict(), 2), watch_interval=2., autostart=True):
         self.ghbot       = ghbot_instance
         self.directory   = directory
         self.name_prefix = name_prefix
 
-        self.plugins     = dict()
+        self.plugins     = dict()  # plugin name -> module (None: not imported yet)
+        self.manifest    = dict()  # plugin name -> { 'mtime': ..., 'catch_all': ..., 'commands': [ [ command, parameters ], ... ] }
 
-        self.load_modules()
+        self.isolation   = isolation_settings
+        self.isolated    = dict()  # plugin name -> isolated_plugin
 
-    def load_modules(self):
-        which = []
+        self.lock        = threading.Lock()
+        self.load_lock   = threading.RLock()  # (re)loading and indexing of modules
+
+        # replaced as a whole when plugins are (re)loaded
+        self.dispatch    = dict()  # command -> plugin name
+        self.catch_all   = []      # plugin names
+
+        self.stats       = dict()  # plugin name -> { 'invoked': ..., 'handled': ..., 'errors': ..., 'duration': histogram }
+
+        self.load_times  = dict()  # plugin name -> seconds the latest (re)load took
+
+        start = time.time()
+
+        self.load_modules(False)
+
+        self.startup_time = time.time() - start
+
+        print(f'plugins_class: found {len(self.plugins)} local plugins in {self.startup_time * 1000:.1f} ms, {len(self.plugins) - self._n_imported()} not imported yet')
+
+        # else the owner calls check() every 'watch_interval' seconds
+        self.watch_interval = watch_interval
+
+        if autostart:
+            self.watcher = threading.Thread(target=self._watch, daemon=True, name='GHBot local plugins')
+            self.watcher.start()
+
+    def _n_imported(self):
+        return len([ module for module in self.plugins.values() if module != None ])
+
+    def _scan(self):
+        files = dict()  # plugin name -> mtime
+
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(self.name_prefix) and entry.name.endswith('.py'):
+                files[entry.name[:-3]] = entry.stat().st_mtime
+
+        return files
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, plugins_class.manifest_file), 'r') as fh:
+                return json.load(fh)
+
+        except FileNotFoundError as fnfe:
+            pass
+
+        except Exception as e:
+            print(f'plugins_class: cannot read manifest: {e}')
+
+        return dict()
+
+    def _write_manifest(self):
+        name = os.path.join(self.directory, plugins_class.manifest_file)
 
         try:
-            for filename in os.listdir(self.directory):
-                name_only = filename.rstrip('.py')
+            os.makedirs(os.path.dirname(name), exist_ok=True)
 
-                if filename[0:len(self.name_prefix)] == self.name_prefix and not name_only in self.plugins:
-                    full_name = f'{self.directory}.{name_only}'
-                    self.plugins[name_only] = importlib.import_module(full_name)
+            with open(name + '.tmp', 'w') as fh:
+                json.dump(self.manifest, fh)
 
-                    which.append(name_only)
+            os.replace(name + '.tmp', name)
 
         except Exception as e:
-            print(f'while loading modules: "{e}" at line number: {e.__traceback__.tb_lineno}')
+            print(f'plugins_class: cannot write manifest: {e}')
+
+    def _import(self, name):
+        full_name = f'{self.directory}.{name}'
+
+        start     = time.time()
+
+        # only the module itself, not others of which the name contains it
+        module    = importlib.reload(sys.modules[full_name]) if full_name in sys.modules else importlib.import_module(full_name)
+
+        self.load_times[name] = time.time() - start
+
+        return module
+
+    def _index(self, name, module, mtime):
+        catch_all = getattr(module, 'catch_all', False) or not hasattr(module, 'get_commandos')
+
+        commands  = [] if catch_all else [ [ command, list(parameters) ] for command, parameters in module.get_commandos() ]
+
+        self.manifest[name] = { 'mtime': mtime, 'catch_all': catch_all, 'commands': commands }
+
+    def _build_dispatch(self):
+        dispatch  = dict()
+        catch_all = []
+
+        for name, entry in list(self.manifest.items()):
+            if entry['catch_all']:
+                catch_all.append(name)
+
+                continue
+
+            for command, parameters in entry['commands']:
+                if command in dispatch:
+                    print(f'plugins_class: command {command} of {name} is already handled by {dispatch[command]}')
+
+                else:
+                    dispatch[command] = name
+
+        self.dispatch  = dispatch
+        self.catch_all = catch_all
+
+        for name, timeout in self.isolation[0].items():
+            if name in catch_all:
+                print(f'plugins_class: {name} does not list its commands, it can not be isolated')
+
+            elif name in self.plugins and not name in self.isolated:
+                self.isolated[name] = isolated_plugin(self, name, self.isolation[1], timeout)
+
+    def _changed(self, name, old_commands):
+        new_commands = self.manifest[name]['commands'] if name in self.manifest else []
+
+        if self.ghbot != None:
+            self.ghbot._local_commands_changed([ c[0] for c in old_commands ], new_commands)
+
+    # returns the names of the plugins that were not loaded yet; 'notify'
+    # is False at startup, when the bot reads the commands itself
+    def load_modules(self, notify=True):
+        which = []
+
+        with self.load_lock:
+            try:
+                files    = self._scan()
+
+                manifest = self._read_manifest()
+
+            except Exception as e:
+                print(f'while loading modules: "{e}" at line number: {e.__traceback__.tb_lineno}')
+
+                files    = dict()
+
+            for name, mtime in sorted(files.items()):
+                if name in self.plugins:
+                    continue
+
+                try:
+                    if name in manifest and manifest[name].get('mtime') == mtime:
+                        self.manifest[name] = manifest[name]
+
+                        self.plugins[name]  = None  # imported when needed
+
+                    else:
+                        module = self._import(name)
+
+                        self._index(name, module, mtime)
+
+                        self.plugins[name]  = module
+
+                    which.append(name)
+
+                except Exception as e:
+                    print(f'while loading module {name}: "{e}" at line number: {e.__traceback__.tb_lineno}')
+
+            if len(which) > 0:
+                self._write_manifest()
+
+            self._build_dispatch()
+
+        if notify:
+            for name in which:
+                self._changed(name, [])
 
         return which
 
+    def _module(self, name):
+        module = self.plugins.get(name)
+
+        if module != None:
+            return module
+
+        with self.load_lock:
+            if self.plugins.get(name) == None:
+                self.plugins[name] = self._import(name)
+
+                print(f'plugins_class: imported {name} in {self.load_times[name] * 1000:.1f} ms')
+
+            return self.plugins[name]
+
+    def _account(self, name, duration, handled, error):
+        with self.lock:
+            if not name in self.stats:
+                self.stats[name] = { 'invoked': 0, 'handled': 0, 'errors': 0, 'duration': histogram() }
+
+            stats = self.stats[name]
+
+            stats['invoked'] += 1
+
+            if handled:
+                stats['handled'] += 1
+
+            if error:
+                stats['errors'] += 1
+
+        stats['duration'].add(duration)
+
+    def _set_gone(self, command, gone):
+        if self.ghbot == None:
+            return
+
+        if gone:
+            self.ghbot.plugins.set_gone(command)
+
+        else:
+            self.ghbot.plugins.clear_gone(command)
+
+    def _invoke(self, name, nick, parameters):
+        if name in self.isolated:
+            self.isolated[name].call(nick, parameters)
+
+            return True
+
+        start = time.time()
+        error = False
+
+        try:
+            rc = self._module(name).process(self.ghbot, nick, parameters)
+
+        except Exception as e:
+            print(f'while invoking local plugin {name}: "{e}" at line number: {e.__traceback__.tb_lineno}')
+
+            rc    = False
+            error = True
+
+        self._account(name, time.time() - start, rc, error)
+
+        return rc
+
+    # parameters: (prefix, command, arguments, channel)
     # returns True if any plugin processed the command
     def process(self, nick, parameters):
-        for name in self.plugins:
-            try:
-                if self.plugins[name].process(self.ghbot, nick, parameters):
-                    return True
+        name = self.dispatch.get(parameters[1])
 
-            except Exception as e:
-                print(f'while invoking local plugin {name}: "{e}" at line number: {e.__traceback__.tb_lineno}')
+        if name != None and self._invoke(name, nick, parameters):
+            return True
+
+        for name in self.catch_all:
+            if self._invoke(name, nick, parameters):
+                return True
 
         return False
 
     def list_plugins(self):
         return [name for name in self.plugins]
 
+    # [ (command, parameters), ... ], from the manifest
     def get_commandos(self, name):
-        return self.plugins[name].get_commandos()
+        return [ (command, parameters) for command, parameters in self.manifest[name]['commands'] ]
 
     def reload_module(self, name):
-        ok = False
+        with self.load_lock:
+            if not name in self.plugins:
+                return False
 
-        full_name = f'{self.directory}.{name}'
+            old_commands = self.manifest.get(name, {}).get('commands', [])
+
+            try:
+                mtime  = os.stat(os.path.join(self.directory, name + '.py')).st_mtime
+
+                module = self._import(name)
+
+                self._index(name, module, mtime)
+
+            except Exception as e:
+                print(f'while reloading local plugin {name}: "{e}" at line number: {e.__traceback__.tb_lineno}')
+
+                return False
+
+            self.plugins[name] = module
+
+            self._write_manifest()
+
+            self._build_dispatch()
+
+        print(f'plugins_class: reloaded {name} in {self.load_times[name] * 1000:.1f} ms')
+
+        self._changed(name, old_commands)
+
+        if name in self.isolated:
+            self.isolated[name].reloaded()
+
+        return True
+
+    def _forget(self, name):
+        with self.load_lock:
+            old_commands = self.manifest.pop(name, {}).get('commands', [])
+
+            del self.plugins[name]
+
+            self._write_manifest()
+
+            self._build_dispatch()
+
+        print(f'plugins_class: {name} was removed')
+
+        self._changed(name, old_commands)
+
+    # reloads plugins of which the file changed, loads new ones and forgets removed ones
+    def check(self):
+        try:
+            files = self._scan()
+
+        except Exception as e:
+            print(f'plugins_class::check: cannot scan {self.directory}: {e}')
+
+            return
+
+        for name in list(self.plugins):
+            if not name in files:
+                self._forget(name)
+
+            # no manifest entry: loading it failed earlier
+            elif files[name] != self.manifest.get(name, {}).get('mtime'):
+                self.reload_module(name)
+
+        if len(set(files) - set(self.plugins)) > 0:
+            self.load_modules()
+
+    def _watch(self):
+        if inotify_simple == None:
+            while True:
+                time.sleep(self.watch_interval)
+
+                self.check()
+
+        inotify = inotify_simple.INotify()
+        flags   = inotify_simple.flags
+
+        inotify.add_watch(self.directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE)
+
+        while True:
+            events = inotify.read()
+
+            # an editor may write a file in several steps
+            time.sleep(0.1)
+
+            events += inotify.read(timeout=0)
+
+            if any(e.name.startswith(self.name_prefix) and e.name.endswith('.py') for e in events):
+                self.check()
+
+    def get_stats(self):
+        out = { 'commands': len(self.dispatch), 'catch-all': list(self.catch_all), 'startup-time': self.startup_time,
+                'loaded': len(self.plugins), 'imported': self._n_imported(), 'load-times': dict(self.load_times), 'plugins': dict() }
+
+        with self.lock:
+            stats = { name: dict(s) for name, s in self.stats.items() }
+
+        for name, s in stats.items():
+            s['duration'] = s['duration'].get_stats()
 
-        for k, v in list(sys.modules.items()):
-            if full_name in k:
-                importlib.reload(v)
+            out['plugins'][name] = s
 
-                ok = True
+        for name, isolated in self.isolated.items():
+            out['plugins'].setdefault(name, dict())['isolated'] = isolated.get_stats()
 
-        return ok
+        return out
 
 if __name__ == "__main__":
     plugin_subdir = 'plugins'  # relative path!!
-    plugins = plugins_class(None, plugin_subdir, 'ghb_')
+    plugins = plugins_class(None, plugin_subdir, 'ghb_', autostart=False)
 
     print(plugins.list_plugins())
 
-    plugins.process('test', '!door_open')
+    plugins.process('test', ('test', 'door_open', [], '#test'))
 
-    print(plugins.get_commandos('doorcontrol'))
+    print(plugins.get_commandos('ghb_door'))
 
-    print(plugins.reload_module('doorcontrol'))
+    print(plugins.reload_module('ghb_door'))
@@ -0,0 +1,361 @@
+#! /usr/bin/python3
+
+from enum import Enum
+import heapq
+import threading
+import time
+
+
+class plugin_record:
+    __slots__ = ('command', 'descr', 'acl_group', 'last_seen', 'author', 'location', 'help_group', 'hardcoded', 'expires', 'plugin')
+
+    def __init__(self, command, descr, acl_group, last_seen, author, location, help_group, hardcoded, expires, plugin):
+        self.command    = command
+        self.descr      = descr
+        self.acl_group  = acl_group
+        self.last_seen  = last_seen
+        self.author     = author
+        self.location   = location
+        self.help_group = help_group
+        self.hardcoded  = hardcoded
+        self.expires    = expires  # False for hardcoded commands and plugins with a testament
+        self.plugin     = plugin   # name of the plugin that registered it in bulk (None: registered on its own)
+
+    def same_as(self, other):
+        return (self.descr, self.acl_group, self.author, self.location, self.help_group, self.expires, self.plugin) == (other.descr, other.acl_group, other.author, other.location, other.help_group, other.expires, other.plugin)
+
+# The commands the bot knows about: the built-in ones, the ones from local
+# plugins and the ones MQTT plugins announce. MQTT plugins that don't send
+# a registration for 'timeout' seconds are forgotten (and remembered in
+# 'gone' so that users can be told why a command does not work).
+#
+# Records are replaced, not changed, when a registration differs from the
+# previous one; so a record returned by get() or snapshot() can be used
+# after the lock is released. A registration that only refreshes a plugin
+# updates 'last_seen' and nothing else. The expiry heap holds at most one
+# entry per command; when it is due and the plugin was seen in the mean
+# time, it is pushed back with the new deadline.
+#
+# Commands registered in bulk belong to a plugin; a heartbeat of that plugin
+# refreshes all of them at once (see heartbeat()).
+class plugin_registry:
+    class add_rc(Enum):
+        REFUSED   = 0  # tried to override a hardcoded command
+        HEARTBEAT = 1
+        UPDATED   = 2
+        ADDED     = 3
+
+    def __init__(self, timeout=60.):
+        self.timeout     = timeout
+
+        self.lock        = threading.Lock()
+
+        self.records     = dict()  # command -> plugin_record
+        self.acl_groups  = dict()  # acl group -> set of commands
+        self.help_groups = dict()  # help group -> set of commands
+        self.authors     = dict()  # author -> set of commands
+        self.owners      = dict()  # plugin -> set of commands
+        self.owner_seen  = dict()  # plugin -> latest heartbeat
+
+        self.deadlines   = []      # heap of (deadline, command)
+        self.queued      = set()   # commands with an entry in 'deadlines'
+        self.gone        = dict()  # command -> when it was forgotten
+
+        self.generation  = 0       # incremented on every change other than a heartbeat
+
+        self.n_heartbeat = 0
+        self.n_expired   = 0
+
+    @staticmethod
+    def _index_add(index, key, command):
+        if key != None:
+            index.setdefault(key, set()).add(command)
+
+    @staticmethod
+    def _index_remove(index, key, command):
+        if key != None and key in index:
+            commands = index[key]
+
+            commands.discard(command)
+
+            if len(commands) == 0:
+                del index[key]
+
+    def _unlink(self, record):
+        self._index_remove(self.acl_groups,  record.acl_group,  record.command)
+        self._index_remove(self.help_groups, record.help_group, record.command)
+        self._index_remove(self.authors,     record.author,     record.command)
+        self._index_remove(self.owners,      record.plugin,     record.command)
+
+        if record.plugin != None and not record.plugin in self.owners:
+            self.owner_seen.pop(record.plugin, None)
+
+    def _link(self, record):
+        self._index_add(self.acl_groups,  record.acl_group,  record.command)
+        self._index_add(self.help_groups, record.help_group, record.command)
+        self._index_add(self.authors,     record.author,     record.command)
+        self._index_add(self.owners,      record.plugin,     record.command)
+
+    def _last_seen(self, record):
+        return max(record.last_seen, self.owner_seen.get(record.plugin, 0.)) if record.plugin != None else record.last_seen
+
+    # 'expires' is False for plugins that announced a testament
+    def add(self, command, descr, acl_group, author, location, help_group, hardcoded=False, expires=True, plugin=None):
+        now    = time.time()
+
+        record = plugin_record(command, descr, acl_group, now, author, location, help_group, hardcoded, expires and not hardcoded, plugin)
+
+        with self.lock:
+            old = self.records.get(command)
+
+            if old != None:
+                if old.hardcoded and not hardcoded:
+                    return plugin_registry.add_rc.REFUSED
+
+                if old.same_as(record):
+                    old.last_seen     = now
+
+                    self.n_heartbeat += 1
+
+                    return plugin_registry.add_rc.HEARTBEAT
+
+                self._unlink(old)
+
+            self.records[command] = record
+
+            self._link(record)
+
+            if record.expires and not command in self.queued:
+                heapq.heappush(self.deadlines, (now + self.timeout, command))
+
+                self.queued.add(command)
+
+            self.gone.pop(command, None)
+
+            self.generation += 1
+
+        return plugin_registry.add_rc.ADDED if old == None else plugin_registry.add_rc.UPDATED
+
+    # hardcoded commands can't be removed; returns True when 'command' was known
+    def remove(self, command):
+        with self.lock:
+            record = self.records.get(command)
+
+            if record == None or record.hardcoded:
+                return False
+
+            self._unlink(record)
+
+            del self.records[command]
+
+            self.generation += 1
+
+        return True
+
+    # for reloaded local plugins: forgets 'commands' and adds 'entries'
+    # ((command, descr, acl_group, author, location, help_group), all
+    # hardcoded) in one go, so that no one sees a state in between
+    def replace(self, commands, entries):
+        now = time.time()
+
+        with self.lock:
+            for command in commands:
+                record = self.records.pop(command, None)
+
+                if record != None:
+                    self._unlink(record)
+
+            for command, descr, acl_group, author, location, help_group in entries:
+                old = self.records.get(command)
+
+                if old != None:
+                    self._unlink(old)
+
+                record = plugin_record(command, descr, acl_group, now, author, location, help_group, True, False, None)
+
+                self.records[command] = record
+
+                self._link(record)
+
+                self.gone.pop(command, None)
+
+            self.generation += 1
+
+    # refreshes all commands that 'plugin' registered in bulk; returns
+    # False when it has none (e.g. they expired: it should register again)
+    def heartbeat(self, plugin):
+        with self.lock:
+            if not plugin in self.owners:
+                return False
+
+            self.owner_seen[plugin] = time.time()
+
+            self.n_heartbeat += 1
+
+        return True
+
+    # returns the commands that were forgotten
+    def expire(self, now=None):
+        if now == None:
+            now = time.time()
+
+        expired = []
+
+        with self.lock:
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                deadline, command = heapq.heappop(self.deadlines)
+
+                record = self.records.get(command)
+
+                if record == None or not record.expires:
+                    self.queued.discard(command)
+
+                    continue
+
+                deadline = self._last_seen(record) + self.timeout
+
+                if deadline > now:
+                    heapq.heappush(self.deadlines, (deadline, command))
+
+                    continue
+
+                self._unlink(record)
+
+                del self.records[command]
+
+                self.queued.discard(command)
+
+                self.gone[command] = now
+
+                expired.append(command)
+
+            if len(expired) > 0:
+                self.generation += 1
+
+                self.n_expired  += len(expired)
+
+        return expired
+
+    # when the next plugin could expire (None: no plugin can)
+    def next_deadline(self):
+        with self.lock:
+            return self.deadlines[0][0] if len(self.deadlines) > 0 else None
+
+    def get(self, command):
+        with self.lock:
+            return self.records.get(command)
+
+    def __contains__(self, command):
+        with self.lock:
+            return command in self.records
+
+    def __len__(self):
+        with self.lock:
+            return len(self.records)
+
+    def commands(self):
+        with self.lock:
+            commands = list(self.records)
+
+        return sorted(commands)
+
+    # all records, sorted by command
+    def snapshot(self):
+        with self.lock:
+            records = list(self.records.values())
+
+        return sorted(records, key=lambda r: r.command)
+
+    # for commands that are known but don't work (e.g. a local plugin that hangs)
+    def set_gone(self, command):
+        with self.lock:
+            if not command in self.gone:
+                self.gone[command] = time.time()
+
+                self.generation += 1
+
+    def clear_gone(self, command):
+        with self.lock:
+            if self.gone.pop(command, None) != None:
+                self.generation += 1
+
+    def gone_since(self, command):
+        with self.lock:
+            return self.gone.get(command)
+
+    def get_gone(self):
+        with self.lock:
+            return dict(self.gone)
+
+    def get_acl_groups(self):
+        with self.lock:
+            groups = list(self.acl_groups)
+
+        return sorted(groups)
+
+    def get_help_groups(self):
+        with self.lock:
+            groups = list(self.help_groups)
+
+        return sorted(groups)
+
+    def by_acl_group(self, group):
+        with self.lock:
+            commands = list(self.acl_groups.get(group, ()))
+
+        return sorted(commands)
+
+    def by_help_group(self, group):
+        with self.lock:
+            commands = list(self.help_groups.get(group, ()))
+
+        return sorted(commands)
+
+    def last_seen(self, record):
+        with self.lock:
+            return self._last_seen(record)
+
+    def by_plugin(self, plugin):
+        with self.lock:
+            commands = list(self.owners.get(plugin, ()))
+
+        return sorted(commands)
+
+    def by_author(self, author):
+        with self.lock:
+            commands = list(self.authors.get(author, ()))
+
+        return sorted(commands)
+
+    def get_stats(self):
+        with self.lock:
+            return { 'commands': len(self.records), 'plugins': len(self.owners), 'gone': len(self.gone), 'heap': len(self.deadlines), 'generation': self.generation,
+                     'heartbeats': self.n_heartbeat, 'expired': self.n_expired }
+
+if __name__ == "__main__":
+    n = 10000
+
+    r = plugin_registry()
+
+    for i in range(n):
+        r.add(f'cmd{i}', f'command number {i}', f'group{i % 10}', f'author{i % 100}', 'here', f'help{i % 50}')
+
+    start = time.time()
+
+    for i in range(n):
+        r.add(f'cmd{i}', f'command number {i}', f'group{i % 10}', f'author{i % 100}', 'here', f'help{i % 50}')
+
+    print(f'heartbeat: {(time.time() - start) * 1000000 / n:.2f} us')
+
+    start = time.time()
+
+    for i in range(1000):
+        r.by_help_group(f'help{i % 50}')
+
+    print(f'help group query ({len(r.by_help_group("help0"))} commands): {(time.time() - start) * 1000:.2f} us')
+
+    start = time.time()
+
+    expired = r.expire(time.time() + 61.)
+
+    print(f'expired {len(expired)} in {(time.time() - start) * 1000:.2f} ms, {len(r)} left')
@@ -0,0 +1,213 @@
+#! /usr/bin/python3
+
+import re
+import threading
+
+
+# Trigram inverted index for case-insensitive substring search (what
+# "LIKE '%x%'" does) over one or more text fields per document.
+class substring_index:
+    def __init__(self):
+        self.lock     = threading.Lock()
+
+        self.docs     = dict()  # key -> { field: lowercase text }
+        self.postings = dict()  # (field, trigram) -> set of keys
+
+    @staticmethod
+    def _trigrams(text):
+        return { text[i:i + 3] for i in range(len(text) - 2) }
+
+    def add(self, key, **fields):
+        fields = { field: text.lower() for field, text in fields.items() }
+
+        with self.lock:
+            self._remove(key)
+
+            self.docs[key] = fields
+
+            for field, text in fields.items():
+                for trigram in self._trigrams(text):
+                    self.postings.setdefault((field, trigram), set()).add(key)
+
+    def _remove(self, key):
+        fields = self.docs.pop(key, None)
+
+        if fields == None:
+            return
+
+        for field, text in fields.items():
+            for trigram in self._trigrams(text):
+                keys = self.postings[(field, trigram)]
+
+                keys.discard(key)
+
+                if len(keys) == 0:
+                    del self.postings[(field, trigram)]
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    # returns { key: number of occurrences } for documents of which 'field' contains 'what'
+    def find(self, field, what):
+        what = what.lower()
+
+        with self.lock:
+            if len(what) < 3:
+                candidates = self.docs.keys()
+
+            else:
+                candidates = None
+
+                for trigram in sorted(self._trigrams(what), key=lambda t: len(self.postings.get((field, t), ()))):
+                    keys = self.postings.get((field, trigram), set())
+
+                    candidates = set(keys) if candidates == None else candidates & keys
+
+                    if len(candidates) == 0:
+                        break
+
+            out = dict()
+
+            for key in candidates:
+                n = self.docs[key].get(field, '').count(what)
+
+                if n > 0:
+                    out[key] = n
+
+            return out
+
+    def get(self, key, field):
+        with self.lock:
+            return self.docs.get(key, dict()).get(field)
+
+# In-process search over the aliasses table. Registers itself as a
+# define_store listener so that it is updated incrementally; those calls
+# come from other threads than the searches, hence the lock around 'rows'.
+class memory_define_search:
+    def __init__(self):
+        self.lock  = threading.Lock()
+
+        self.index = substring_index()
+        self.rows  = dict()  # nr -> (command, is_command, replacement_text)
+
+    def define_added(self, nr, command, is_command, text):
+        with self.lock:
+            self.rows[nr] = (command.lower(), is_command, text)
+
+        self.index.add(nr, name=command, body=text)
+
+    def define_deleted(self, nr, command, is_command):
+        with self.lock:
+            self.rows.pop(nr, None)
+
+        self.index.remove(nr)
+
+    # returns (command, nr, replacement_text) rows, best match first
+    def search(self, what, verbose):
+        what_l = what.lower()
+
+        by_name = self.index.find('name', what)
+        by_body = self.index.find('body', what) if verbose else dict()
+
+        try:
+            wanted_nr = int(what)
+
+        except ValueError as ve:
+            wanted_nr = None
+
+        scores = dict()
+
+        with self.lock:
+            if wanted_nr in self.rows:
+                scores[wanted_nr] = 1000
+
+            for nr, n in by_name.items():
+                row = self.rows.get(nr)
+
+                if row == None:
+                    continue
+
+                command = row[0]
+
+                scores[nr] = scores.get(nr, 0) + (100 if command == what_l else 50 if command.startswith(what_l) else 20)
+
+            for nr, n in by_body.items():
+                scores[nr] = scores.get(nr, 0) + 5 * min(n, 10)
+
+            ranked = sorted(scores, key=lambda nr: (-scores[nr], -nr))
+
+            return [(self.rows[nr][0], nr, self.rows[nr][2]) for nr in ranked if nr in self.rows]
+
+    # returns (command, is_command, nr) rows for names containing 'which'
+    def by_name(self, which):
+        nrs = sorted(self.index.find('name', which), reverse=True)
+
+        with self.lock:
+            return [(self.rows[nr][0], self.rows[nr][1], nr) for nr in nrs if nr in self.rows]
+
+# Same interface, using the FULLTEXT indexes from ghbot.sql. Note that
+# FULLTEXT matches words and word-prefixes, not arbitrary substrings.
+class mysql_define_search:
+    def __init__(self, db):
+        self.db = db
+
+    def define_added(self, nr, command, is_command, text):
+        pass  # maintained by MySQL
+
+    def define_deleted(self, nr, command, is_command):
+        pass
+
+    @staticmethod
+    def _boolean_query(what):
+        words = [w for w in re.split(r'[\s+\-<>()~*"@]+', what) if len(w) >= 3]
+
+        if len(words) == 0:
+            return None
+
+        return ' '.join(f'+{w}*' for w in words)
+
+    def search(self, what, verbose):
+        query = self._boolean_query(what)
+
+        if query == None:
+            if verbose:
+                return list(self.db.query('SELECT command, nr, replacement_text FROM aliasses WHERE nr=%s OR command like %s OR replacement_text like %s ORDER BY nr DESC', (what, f'%%{what.lower()}%%', f'%%{what}%%')))
+
+            return list(self.db.query('SELECT command, nr, replacement_text FROM aliasses WHERE nr=%s OR command like %s ORDER BY nr DESC', (what, f'%%{what.lower()}%%',)))
+
+        if verbose:
+            return list(self.db.query('SELECT command, nr, replacement_text FROM aliasses WHERE nr=%s OR MATCH(command, replacement_text) AGAINST (%s IN BOOLEAN MODE) ORDER BY nr=%s DESC, MATCH(command, replacement_text) AGAINST (%s IN BOOLEAN MODE) DESC, nr DESC', (what, query, what, query)))
+
+        return list(self.db.query('SELECT command, nr, replacement_text FROM aliasses WHERE nr=%s OR MATCH(command) AGAINST (%s IN BOOLEAN MODE) ORDER BY nr=%s DESC, MATCH(command) AGAINST (%s IN BOOLEAN MODE) DESC, nr DESC', (what, query, what, query)))
+
+    def by_name(self, which):
+        query = self._boolean_query(which)
+
+        if query == None:
+            rows = self.db.query('SELECT command, is_command, nr FROM aliasses WHERE command like %s', (f'%%{which}%%',))
+
+        else:
+            rows = self.db.query('SELECT command, is_command, nr FROM aliasses WHERE MATCH(command) AGAINST (%s IN BOOLEAN MODE)', (query,))
+
+        return [(row[0], bool(row[1]), row[2]) for row in rows]
+
+# Plugin commands and their descriptions, for apro and help.
+class plugin_search:
+    def __init__(self):
+        self.index = substring_index()
+
+    def set(self, command, descr):
+        if self.index.get(command, 'descr') != (descr or '').lower():
+            self.index.add(command, name=command, descr=descr or '')
+
+    def remove(self, command):
+        self.index.remove(command)
+
+    def by_name(self, which):
+        return sorted(self.index.find('name', which))
+
+    def by_description(self, word, limit):
+        found = self.index.find('descr', word)
+
+        return sorted(found, key=lambda command: (-found[command], command))[0:limit]
@@ -0,0 +1,206 @@
+#! /usr/bin/python3
+
+import collections
+import threading
+import time
+
+
+# Single writer for everything that goes to the IRC server. Lines are
+# queued per lane and the lowest lane that has something goes first.
+# Pacing follows the RFC1459 client message timer: each line adds
+# 'penalty' seconds (plus one second per 120 bytes) and nothing but
+# protocol lines is sent while the timer is more than 'burst' seconds
+# ahead of now.
+#
+# The reply and broadcast lanes hold at most 'queue_size' lines; when one
+# is full the oldest line in it is dropped. Those lanes are emptied when
+# the connection is lost (see clear()): what was meant for the previous
+# session is stale by the time the bot is back.
+class send_queue(threading.Thread):
+    PROTOCOL  = 0  # PONG and the like
+    REPLY     = 1  # replies to commands
+    BROADCAST = 2  # plugin output, messages posted via HTTP
+
+    lane_names = ('protocol', 'reply', 'broadcast')
+
+    coalesce_limit = 400  # bytes (UTF-8) of the merged text
+
+    def __init__(self, transmit, can_send, penalty, burst, coalesce, queue_size=1000):
+        super().__init__(daemon=True)
+
+        self.transmit  = transmit  # function that writes one line to the server
+        self.can_send  = can_send  # function that tells if a lane may be sent on now
+
+        self.penalty   = penalty
+        self.burst     = burst
+        self.coalesce  = coalesce
+        self.max_depth = queue_size
+
+        self.lanes     = [collections.deque() for lane in send_queue.lane_names]
+        self.cond      = threading.Condition()
+
+        self.timer     = time.time()
+
+        self.sent      = [0] * len(self.lanes)
+        self.coalesced = [0] * len(self.lanes)
+        self.dropped   = [0] * len(self.lanes)
+        self.lat_sum   = [0.] * len(self.lanes)
+        self.lat_max   = [0.] * len(self.lanes)
+
+        self.name = 'GHBot IRC writer'
+        self.start()
+
+    # returns False when a line had to be dropped to make room
+    def put(self, line, lane=REPLY):
+        with self.cond:
+            q    = self.lanes[lane]
+
+            full = lane != send_queue.PROTOCOL and len(q) >= self.max_depth
+
+            if full:
+                q.popleft()
+
+                self.dropped[lane] += 1
+
+            q.append((time.time(), line))
+
+            self.cond.notify()
+
+        return not full
+
+    # forgets all but the protocol lines
+    def clear(self):
+        with self.cond:
+            for lane, q in enumerate(self.lanes):
+                if lane != send_queue.PROTOCOL:
+                    self.dropped[lane] += len(q)
+
+                    q.clear()
+
+    # queues all of 'lines' or, when the lane has no room for all of them, none
+    def put_all(self, lines, lane=BROADCAST):
+        with self.cond:
+            q = self.lanes[lane]
+
+            if lane != send_queue.PROTOCOL and len(q) + len(lines) > self.max_depth:
+                return False
+
+            now = time.time()
+
+            for line in lines:
+                q.append((now, line))
+
+            self.cond.notify()
+
+        return True
+
+    def room(self, lane):
+        with self.cond:
+            return self.max_depth - len(self.lanes[lane])
+
+    def depth(self):
+        return sum(len(q) for q in self.lanes)
+
+    # lines in 'lane' and the seconds it takes to send them (the timer
+    # that is still ahead plus the penalty of each line)
+    def backlog(self, lane):
+        with self.cond:
+            lines = [ line for ts, line in self.lanes[lane] ]
+
+            ahead = max(0., self.timer - time.time())
+
+        return len(lines), ahead + sum(self.penalty + len(line) / 120 for line in lines)
+
+    # merges the following short PRIVMSGs/NOTICEs for the same target into 'line'
+    def _coalesce(self, lane, line):
+        head, sep, text = line.partition(' :')
+
+        if sep == '' or not (head.startswith('PRIVMSG ') or head.startswith('NOTICE ')) or '\001' in text:
+            return line
+
+        q = self.lanes[lane]
+
+        n = len(text.encode('utf-8'))
+
+        while len(q) > 0:
+            ts, next_line = q[0]
+
+            next_head, next_sep, next_text = next_line.partition(' :')
+
+            next_n = len(next_text.encode('utf-8'))
+
+            if next_head != head or '\001' in next_text or n + 3 + next_n > send_queue.coalesce_limit:
+                break
+
+            text += ' / ' + next_text
+
+            n    += 3 + next_n
+
+            q.popleft()
+
+            self._account(lane, ts)
+
+            self.coalesced[lane] += 1
+
+        return f'{head} :{text}'
+
+    def _account(self, lane, ts):
+        latency = time.time() - ts
+
+        self.lat_sum[lane] += latency
+        self.lat_max[lane]  = max(self.lat_max[lane], latency)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    lanes = [i for i, q in enumerate(self.lanes) if len(q) > 0]
+
+                    if len(lanes) == 0:
+                        self.cond.wait()
+
+                        continue
+
+                    lanes = [i for i in lanes if self.can_send(i)]
+
+                    if len(lanes) == 0:
+                        self.cond.wait(0.5)  # not connected (yet)
+
+                        continue
+
+                    lane  = lanes[0]
+
+                    ahead = self.timer - time.time()
+
+                    if lane != send_queue.PROTOCOL and ahead > self.burst:
+                        self.cond.wait(ahead - self.burst)
+
+                        continue
+
+                    ts, line = self.lanes[lane].popleft()
+
+                    self._account(lane, ts)
+
+                    if self.coalesce and lane != send_queue.PROTOCOL:
+                        line = self._coalesce(lane, line)
+
+                    break
+
+            self.timer = max(self.timer, time.time()) + self.penalty + len(line) / 120
+
+            self.sent[lane] += 1
+
+            self.transmit(line)
+
+    def get_stats(self):
+        out = dict()
+
+        for i, name in enumerate(send_queue.lane_names):
+            handled = self.sent[i] + self.coalesced[i]
+
+            out[name] = { 'depth': len(self.lanes[i]), 'sent': self.sent[i], 'coalesced': self.coalesced[i], 'dropped': self.dropped[i],
+                          'latency_avg': self.lat_sum[i] / handled if handled > 0 else 0., 'latency_max': self.lat_max[i] }
+
+        out['timer_ahead'] = max(0., self.timer - time.time())
+
+        return out
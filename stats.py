@@ -0,0 +1,51 @@
+#! /usr/bin/python3
+
+import bisect
+import threading
+
+
+# Latency histogram with fixed, roughly logarithmic buckets (in seconds).
+class histogram:
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+    def __init__(self):
+        self.lock   = threading.Lock()
+
+        self.counts = [0] * (len(histogram.bounds) + 1)  # the last one is for > 60 s
+        self.n      = 0
+        self.sum    = 0.
+        self.max    = 0.
+
+    def add(self, value):
+        i = bisect.bisect_left(histogram.bounds, value)
+
+        with self.lock:
+            self.counts[i] += 1
+            self.n         += 1
+            self.sum       += value
+            self.max        = max(self.max, value)
+
+    # upper bound of the bucket that holds the p-th percentile (0..100)
+    def percentile(self, p):
+        with self.lock:
+            if self.n == 0:
+                return 0.
+
+            need = self.n * p / 100.
+            seen = 0
+
+            for i, count in enumerate(self.counts):
+                seen += count
+
+                if seen >= need:
+                    return histogram.bounds[i] if i < len(histogram.bounds) else self.max
+
+        return self.max
+
+    def get_stats(self):
+        labels  = [ f'{bound:g}' for bound in histogram.bounds ] + [ 'inf' ]
+
+        buckets = { label: count for label, count in zip(labels, self.counts) }
+
+        return { 'count': self.n, 'avg': self.sum / self.n if self.n > 0 else 0., 'max': self.max,
+                 'p50': self.percentile(50), 'p95': self.percentile(95), 'buckets': buckets }
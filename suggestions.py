@@ -0,0 +1,203 @@
+#! /usr/bin/python3
+
+import threading
+import time
+
+
+# Levenshtein distance, gives up (returns limit + 1) as soon as the
+# distance is known to exceed 'limit'
+def edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous = list(range(len(b) + 1))
+
+    for i, ca in enumerate(a, 1):
+        current = [i]
+
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+
+        if min(current) > limit:
+            return limit + 1
+
+        previous = current
+
+    return previous[-1]
+
+soundex_codes = { c: d for d, letters in (('1', 'bfpv'), ('2', 'cgjkqsxz'), ('3', 'dt'), ('4', 'l'), ('5', 'mn'), ('6', 'r')) for c in letters }
+
+# roughly what MySQL's SOUNDS LIKE compares
+def soundex(word):
+    codes = soundex_codes
+
+    word = ''.join(c for c in word.lower() if c.isalpha())
+
+    if word == '':
+        return ''
+
+    out  = word[0].upper()
+    last = codes.get(word[0])
+
+    for c in word[1:]:
+        code = codes.get(c)
+
+        if code != None and code != last:
+            out += code
+
+        if c not in 'hw':
+            last = code
+
+    return (out + '000')[0:max(4, len(out))]
+
+# all strings that can be made from 'word' by deleting up to 'n' characters
+def deletes(word, n):
+    out  = { word }
+    todo = [ word ]
+
+    for i in range(n):
+        next_todo = []
+
+        for current in todo:
+            for j in range(len(current)):
+                variant = current[0:j] + current[j + 1:]
+
+                if not variant in out:
+                    out.add(variant)
+                    next_todo.append(variant)
+
+        todo = next_todo
+
+    return out
+
+# Symmetric-delete index over command, define and alias names: two words
+# are within edit distance n when they share a deletion variant of at most
+# n deletions each. A name can be added by several sources (e.g. a plugin
+# command and a define): it is reference counted and only disappears when
+# the last one removed it.
+class suggestion_index:
+    max_distance = 2
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+
+        self.refs       = dict()  # name -> reference count
+        self.variants   = dict()  # deletion variant -> set of names
+        self.by_soundex = dict()  # soundex -> set of names
+        self.lengths    = dict()  # length -> number of names that long
+
+    def add(self, name):
+        name = name.lower()
+
+        with self.lock:
+            self.refs[name] = self.refs.get(name, 0) + 1
+
+            if self.refs[name] > 1:
+                return
+
+            for variant in deletes(name, suggestion_index.max_distance):
+                self.variants.setdefault(variant, set()).add(name)
+
+            self.by_soundex.setdefault(soundex(name), set()).add(name)
+
+            self.lengths[len(name)] = self.lengths.get(len(name), 0) + 1
+
+    def remove(self, name):
+        name = name.lower()
+
+        with self.lock:
+            if not name in self.refs:
+                return
+
+            self.refs[name] -= 1
+
+            if self.refs[name] > 0:
+                return
+
+            del self.refs[name]
+
+            for variant in deletes(name, suggestion_index.max_distance):
+                names = self.variants[variant]
+
+                names.discard(name)
+
+                if len(names) == 0:
+                    del self.variants[variant]
+
+            self.by_soundex[soundex(name)].discard(name)
+
+            self.lengths[len(name)] -= 1
+
+            if self.lengths[len(name)] == 0:
+                del self.lengths[len(name)]
+
+    # define_store listener: every define or alias row holds a reference to its name
+    def define_added(self, nr, command, is_command, text):
+        self.add(command)
+
+    def define_deleted(self, nr, command, is_command):
+        self.remove(command)
+
+    # up to 'k' names: the closest first, then names that sound alike
+    def suggest(self, wrong, k=3):
+        wrong = wrong.lower()
+        limit = 1 if len(wrong) <= 3 else suggestion_index.max_distance
+
+        found = []
+
+        with self.lock:
+            candidates = set()
+
+            # no name is that close to a longer word; and the number of
+            # deletion variants grows quadratically with the length
+            if len(wrong) <= max(self.lengths, default=0) + limit:
+                for variant in deletes(wrong, limit):
+                    candidates |= self.variants.get(variant, set())
+
+            alike = sorted(self.by_soundex.get(soundex(wrong), set()))
+
+        for name in candidates:
+            d = edit_distance(wrong, name, limit)
+
+            if d <= limit:
+                found.append((d, name))
+
+        out = [name for d, name in sorted(found)[0:k]]
+
+        for name in alike:
+            if len(out) >= k:
+                break
+
+            if not name in out:
+                out.append(name)
+
+        return out
+
+if __name__ == "__main__":
+    import random
+    import string
+
+    random.seed(1)
+
+    index = suggestion_index()
+
+    names = set()
+
+    while len(names) < 5000:
+        names.add(''.join(random.choice(string.ascii_lowercase) for i in range(random.randint(3, 12))))
+
+    start = time.time()
+
+    for name in names:
+        index.add(name)
+
+    print(f'{len(names)} names indexed in {(time.time() - start) * 1000:.1f} ms')
+
+    queries = [name[0:-1] + 'x' for name in random.sample(sorted(names), 1000)]
+
+    start = time.time()
+
+    for query in queries:
+        index.suggest(query)
+
+    print(f'{(time.time() - start) / len(queries) * 1000:.3f} ms per suggestion')
@@ -0,0 +1,19 @@
+import os
+import sys
+import time
+
+# the modules are at the top of the repository, not in a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+# polls 'condition' for at most 'timeout' seconds (for the threaded classes)
+def wait_for(condition, timeout=5.):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if condition():
+            return True
+
+        time.sleep(0.01)
+
+    return condition()
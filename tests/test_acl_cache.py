@@ -0,0 +1,124 @@
+from acl_cache import acl_cache
+
+
+class fake_db:
+    def __init__(self, acls=(), groups=(), aliasses=(), fail=False):
+        self.tables = { 'acls': list(acls), 'acl_groups': list(groups), 'account_aliasses': list(aliasses) }
+        self.fail   = fail
+
+    def query(self, sql):
+        if self.fail:
+            raise Exception('no database')
+
+        return self.tables[sql.split()[-1]]
+
+def make_cache(**kwargs):
+    return acl_cache(fake_db(**kwargs), 60, autostart=False)
+
+def test_not_loaded_returns_none():
+    c = make_cache(fail=True)
+
+    assert c.check('Flok', 'define', None) == None
+
+    assert c.get_stats()['fallbacks'] == 1
+
+def test_user_group_and_plugin_group():
+    c = make_cache(acls=[ ('Flok', 'DEFINE'), ('sysops', 'kick') ], groups=[ ('Bas', 'SysOps'), ('Bas', 'weather') ])
+
+    assert c.check('flok', 'define', None) == True
+    assert c.check('FLOK', 'kick', None) == False
+
+    assert c.check('bas', 'kick', None) == True
+    assert c.check('bas', 'forecast', 'Weather') == True
+    assert c.check('bas', 'forecast', 'news') == False
+
+def test_alias_is_resolved():
+    c = make_cache(acls=[ ('main', 'define') ], aliasses=[ ('Other', 'Main') ])
+
+    assert c.resolve_alias('OTHER') == 'main'
+
+    assert c.check('other', 'define', None) == True
+
+def test_changes_invalidate_decisions():
+    c = make_cache(groups=[ ('bas', 'sysops') ])
+
+    assert c.check('bas', 'kick', None) == False
+
+    # a command granted to the group applies to its members
+    c.add_acl('SysOps', 'kick')
+
+    assert c.check('bas', 'kick', None) == True
+
+    c.group_del('bas', 'sysops')
+
+    assert c.check('bas', 'kick', None) == False
+
+    c.group_add('bas', 'sysops')
+
+    assert c.check('bas', 'kick', None) == True
+
+    c.del_acl('sysops', 'kick')
+
+    assert c.check('bas', 'kick', None) == False
+
+def test_like_wildcards():
+    c = make_cache(acls=[ ('flok!user@host', 'define'), ('flok!user@hostx', 'define'), ('flokx', 'define'), ('a.b', 'define'), ('axb', 'define') ])
+
+    assert sorted(c._matching('flok!%')) == [ 'flok!user@host', 'flok!user@hostx' ]
+    assert sorted(c._matching('flok_')) == [ 'flokx' ]
+    assert sorted(c._matching('FLOK!USER@HOST')) == [ 'flok!user@host' ]
+
+    # only % and _ are wildcards, everything else is literal
+    assert c._matching('a.b') == [ 'a.b' ]
+    assert c._matching('a%b') != [ 'a.b' ]
+
+def test_forget_like():
+    c = make_cache(acls=[ ('flok!a@b', 'define'), ('flok!c@d', 'define'), ('bas', 'define') ], groups=[ ('flok!a@b', 'sysops') ])
+
+    assert c.check('flok!a@b', 'define', None) == True
+
+    c.forget_like('flok!%')
+
+    assert c.check('flok!a@b', 'define', None) == False
+    assert c.check('flok!c@d', 'define', None) == False
+    assert c.check('bas', 'define', None) == True
+
+    assert c.members['sysops'] == set()
+
+def test_rename_like_merges():
+    c = make_cache(acls=[ ('flok!a@b', 'define'), ('flok', 'kick') ], groups=[ ('flok!a@b', 'sysops') ])
+
+    assert c.check('flok', 'define', None) == False
+
+    c.rename_like('flok!%', 'Flok')
+
+    assert c.check('flok', 'define', None) == True
+    assert c.check('flok', 'kick', None) == True
+    assert c.check('flok!a@b', 'define', None) == False
+
+    assert c.members['sysops'] == { 'flok' }
+
+def test_changes_during_a_reload_are_kept():
+    db = fake_db(acls=[ ('bas', 'kick') ], groups=[ ('bas', 'sysops') ])
+    c  = acl_cache(db, 60, autostart=False)
+
+    query = db.query
+
+    # the acls table was read already when these are made
+    def query_and_change(sql):
+        if 'acl_groups' in sql:
+            c.add_acl('flok', 'define')
+            c.del_acl('bas', 'kick')
+            c.group_del('bas', 'sysops')
+
+        return query(sql)
+
+    db.query = query_and_change
+
+    assert c.reload() == True
+
+    assert c.check('flok', 'define', None) == True
+    assert c.check('bas', 'kick', None) == False
+    assert c.check('bas', 'x', 'sysops') == False
+
+    assert c.replay == []
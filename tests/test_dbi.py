@@ -0,0 +1,161 @@
+import pytest
+import threading
+
+MySQLdb = pytest.importorskip('MySQLdb')
+
+import dbi as dbi_module
+from dbi import dbi
+
+
+# stands in for a MySQL server: every connection runs the statements it
+# gets and raises the exceptions queued in 'failures' first
+class fake_server:
+    def __init__(self):
+        self.connections = []
+        self.failures    = []
+        self.executed    = []
+
+    def connect(self, *args, **kwargs):
+        connection = fake_connection(self)
+
+        self.connections.append(connection)
+
+        return connection
+
+class fake_cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount   = 0
+        self.lastrowid  = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None):
+        server = self.connection.server
+
+        if not sql.startswith('SET') and len(server.failures) > 0:
+            raise server.failures.pop(0)
+
+        server.executed.append(sql)
+
+        self.rowcount = 1
+
+    def executemany(self, sql, args):
+        self.execute(sql)
+
+    def fetchall(self):
+        return ((1,),)
+
+    def close(self):
+        pass
+
+class fake_connection:
+    def __init__(self, server):
+        self.server    = server
+        self.closed    = False
+        self.ping_fail = False
+        self.rollbacks = 0
+
+    def cursor(self):
+        return fake_cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def ping(self):
+        if self.ping_fail:
+            raise MySQLdb.OperationalError(2006, 'MySQL server has gone away')
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def server(monkeypatch):
+    s = fake_server()
+
+    monkeypatch.setattr(dbi_module.MySQLdb, 'connect', s.connect)
+    monkeypatch.setattr(dbi, 'checkout_timeout', 0.1)
+
+    return s
+
+def test_pool_size_and_checkout_timeout(server):
+    db = dbi('host', 'user', 'password', 'db', pool_size=2, autostart=False)
+
+    a = db.checkout()
+    b = db.checkout()
+
+    assert len(server.connections) == 2
+
+    with pytest.raises(TimeoutError):
+        db.checkout()
+
+    # a connection that comes back is handed to the one waiting for it
+    threading.Timer(0.02, db.checkin, (a,)).start()
+
+    assert db.checkout() is a
+
+def test_discarded_connection_frees_a_slot(server):
+    db = dbi('host', 'user', 'password', 'db', pool_size=1, autostart=False)
+
+    server.failures.append(MySQLdb.OperationalError(2013, 'Lost connection'))
+    server.failures.append(MySQLdb.OperationalError(2013, 'Lost connection'))
+
+    with pytest.raises(MySQLdb.OperationalError):
+        db.query('SELECT 1')
+
+    assert server.connections[0].closed
+    assert db.get_stats()['connections'] == 0
+
+    assert db.query('SELECT 1') == ((1,),)
+
+def test_query_is_retried_when_the_connection_was_lost(server):
+    db = dbi('host', 'user', 'password', 'db', autostart=False)
+
+    server.failures.append(MySQLdb.OperationalError(2006, 'MySQL server has gone away'))
+
+    assert db.query('SELECT 1') == ((1,),)
+
+    assert server.executed.count('SELECT 1') == 1
+    assert server.connections[0].closed
+    assert db.get_stats()['reconnects'] == 1
+
+def test_write_is_not_retried_once_sent(server):
+    db = dbi('host', 'user', 'password', 'db', autostart=False)
+
+    server.failures.append(MySQLdb.OperationalError(2013, 'Lost connection'))
+
+    with pytest.raises(MySQLdb.OperationalError):
+        db.execute('INSERT INTO x VALUES(1)')
+
+    assert db.get_stats()['reconnects'] == 0
+
+def test_other_errors_are_not_retried(server):
+    db = dbi('host', 'user', 'password', 'db', autostart=False)
+
+    server.failures.append(MySQLdb.OperationalError(1213, 'Deadlock found'))
+
+    with pytest.raises(MySQLdb.OperationalError):
+        db.query('SELECT 1')
+
+    # the connection itself is fine: rolled back and kept
+    assert server.connections[0].rollbacks == 1
+    assert not server.connections[0].closed
+    assert db.get_stats()['idle'] == 1
+
+def test_idle_connection_is_pinged(server, monkeypatch):
+    monkeypatch.setattr(dbi, 'check_after', 0.)
+
+    db = dbi('host', 'user', 'password', 'db', autostart=False)
+
+    server.connections[0].ping_fail = True
+
+    assert db.checkout() is server.connections[1]
+    assert server.connections[0].closed
+    assert db.get_stats()['reconnects'] == 1
@@ -0,0 +1,108 @@
+from define_store import define_store
+
+
+# the aliasses table as rows of (nr, command, is_command, replacement_text)
+class fake_db:
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.fail = False
+
+    def query(self, sql):
+        if self.fail:
+            raise Exception('connection lost')
+
+        if sql.startswith('SELECT COUNT(*), MAX(nr)'):
+            return [ (len(self.rows), max((row[0] for row in self.rows), default=None)) ]
+
+        return list(self.rows)
+
+class listener:
+    def __init__(self):
+        self.names = dict()
+
+    def define_added(self, nr, command, is_command, text):
+        self.names[nr] = command
+
+    def define_deleted(self, nr, command, is_command):
+        del self.names[nr]
+
+def make_store(rows):
+    db = fake_db(rows)
+
+    return db, define_store(db, 60, autostart=False)
+
+def test_lookup():
+    db, s = make_store([ (1, 'Hello', 0, 'hello %u'), (2, 'hello', 0, 'hi %u'), (3, 'hello', 1, 'greet') ])
+
+    defines = s.lookup('HELLO', False)
+
+    assert sorted(text for is_command, text, template in defines) == [ 'hello %u', 'hi %u' ]
+    assert all(template != None for is_command, text, template in defines)
+
+    assert s.lookup('hello', True) == [ (True, 'greet', None) ]
+    assert s.lookup('nothing', False) == []
+
+    assert len(s.lookup('hello', False, limit=1)) == 1
+
+def test_add_and_delete_keep_the_version():
+    db, s = make_store([ (1, 'a', 0, 'x') ])
+
+    db.rows.append((2, 'b', 0, 'y'))
+    s.add(2, 'b', False, 'y')
+
+    # our own change does not lead to a reload
+    s.check()
+
+    assert s.reloads == 1
+    assert s.lookup('b', False)[0][1] == 'y'
+
+    db.rows.pop()
+    s.delete(2)
+    s.delete(2)
+
+    s.check()
+
+    assert s.reloads == 1
+    assert s.lookup('b', False) == []
+    assert s.get_stats() == { 'defines': 1, 'commands': 1, 'reloads': 1 }
+
+def test_reload_when_someone_else_changed_the_table():
+    db, s = make_store([ (1, 'a', 0, 'x') ])
+
+    db.rows.append((2, 'b', 0, 'y'))
+
+    s.check()
+
+    assert s.reloads == 2
+    assert s.lookup('b', False)[0][1] == 'y'
+
+def test_failing_check_keeps_the_defines():
+    db, s = make_store([ (1, 'a', 0, 'x') ])
+
+    db.fail = True
+
+    s.check()
+
+    assert s.reload() == False
+    assert s.lookup('a', False)[0][1] == 'x'
+
+def test_listeners():
+    db, s = make_store([ (1, 'a', 0, 'x'), (2, 'b', 1, 'a') ])
+
+    l = listener()
+
+    s.add_listener(l)
+
+    assert l.names == { 1: 'a', 2: 'b' }
+
+    s.add(3, 'C', False, 'z')
+    s.delete(1)
+
+    assert l.names == { 2: 'b', 3: 'c' }
+
+    # a reload reports the differences only
+    db.rows = [ (2, 'b', 1, 'a'), (4, 'd', 0, 'w') ]
+
+    s.check()
+
+    assert l.names == { 2: 'b', 4: 'd' }
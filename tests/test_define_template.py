@@ -0,0 +1,61 @@
+from define_template import define_template, expand_legacy, template_values
+import pytest
+import random
+
+
+words = [ 'hello', '%u', '%U', '%q', '%Q', '%d', '%D', '%e', '%E', '%c', '%C', '%r', '%R', '%n', '%m', '%h:red', '%h:light-green', '%h:none', '%h:', 'world', '{x}', '{', '}', '100%', '%', '%%u', 'to', '' ]
+
+invocations = [ ('', 'nick', '#channel'), ('some query text', 'Folkert', '#test'), ('one', 'x', '#y'), ('100%', 'n', '#c'), ('q', '%u', '#c') ]
+
+def expand(text, query_text, nick, channel):
+    compiled = define_template.compile(text)
+    values   = template_values(query_text, nick, channel)
+
+    if compiled == None or values == None:
+        return expand_legacy(False, text, query_text, nick, channel)
+
+    return compiled.expand(values)
+
+def random_table(n):
+    r = random.Random(1)
+
+    table = []
+
+    for i in range(n):
+        glue = r.choice([ ' ', '' ])
+
+        table.append(glue.join(r.choice(words) for j in range(r.randint(1, 10))))
+
+    return table
+
+@pytest.mark.parametrize('query_text, nick, channel', invocations)
+def test_same_output_as_legacy(query_text, nick, channel):
+    for text in random_table(3000):
+        random.seed(2)
+
+        legacy = expand_legacy(False, text, query_text, nick, channel)
+
+        random.seed(2)
+
+        assert expand(text, query_text, nick, channel) == legacy, text
+
+def test_escapes():
+    values = template_values('cold beer', 'Flok', '#test')
+
+    assert define_template.compile('%u wants %e in %c').expand(values) == ('Flok wants beer in #test', False)
+    assert define_template.compile('%n%U: %Q').expand(values) == ('FLOK: COLD BEER', True)
+    assert define_template.compile('%m hands %d to %u').expand(values) == ('\001ACTION hands cold to Flok\001', False)
+    assert define_template.compile('%h:redred').expand(values) == ('\0034red', False)
+
+def test_braces_are_literal():
+    values = template_values('', 'n', '#c')
+
+    assert define_template.compile('{u} {} %u').expand(values) == ('{u} {} n', False)
+
+def test_percent_before_a_value_is_not_compiled():
+    # "%%u" with nick "h:red" would turn into a colour in the legacy path
+    assert define_template.compile('%%u') == None
+
+def test_values_that_contain_escapes_use_the_legacy_path():
+    assert template_values('%u', 'n', '#c') == None
+    assert template_values('', None, '#c') == None
@@ -0,0 +1,73 @@
+from conftest import wait_for
+from dispatcher import dispatcher
+import threading
+
+
+def test_order_is_kept_per_key():
+    seen = []
+    lock = threading.Lock()
+
+    def handler(key, n):
+        with lock:
+            seen.append((key, n))
+
+    d = dispatcher(handler, 4, 1000)
+
+    for n in range(200):
+        for key in ('#a', '#b', 'nick'):
+            d.put(key, False, key, n)
+
+    assert wait_for(lambda: len(seen) == 600)
+
+    for key in ('#a', '#b', 'nick'):
+        assert [ n for k, n in seen if k == key ] == list(range(200))
+
+def test_key_none_goes_to_the_protocol_worker():
+    names = []
+
+    d = dispatcher(lambda: names.append(threading.current_thread().name), 2, 10)
+
+    d.put(None, False)
+
+    assert wait_for(lambda: len(names) == 1)
+
+    assert names == [ 'GHBot dispatch protocol' ]
+
+def test_droppable_items_are_dropped_when_the_queue_is_full():
+    release = threading.Event()
+
+    d = dispatcher(lambda n: release.wait(), 1, 2)
+
+    w = d.workers[0]
+
+    assert d.put('#a', True, 0)
+
+    # the worker took the first item and is blocked in the handler
+    assert wait_for(lambda: w.q.qsize() == 0)
+
+    assert d.put('#a', True, 1)
+    assert d.put('#a', True, 2)
+
+    assert d.put('#a', True, 3) == False
+
+    assert d.get_stats()['worker-0']['dropped'] == 1
+
+    release.set()
+
+    assert wait_for(lambda: w.processed == 3)
+
+def test_exceptions_do_not_stop_the_worker():
+    done = []
+
+    def handler(n):
+        if n == 0:
+            raise Exception('boom')
+
+        done.append(n)
+
+    d = dispatcher(handler, 1, 10)
+
+    d.put('#a', False, 0)
+    d.put('#a', False, 1)
+
+    assert wait_for(lambda: done == [ 1 ])
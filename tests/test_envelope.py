@@ -0,0 +1,47 @@
+import envelope
+import pytest
+
+
+def test_json_round_trip():
+    e = envelope.make('#test', 'nick!user@host', 'PRIVMSG', 'hello', id='abc')
+
+    assert envelope.decode(envelope.encode(e, 'json')) == e
+
+def test_decode_accepts_str():
+    e = envelope.make('#test', 'nick!user@host', 'PRIVMSG', 'hello')
+
+    assert envelope.decode(envelope.encode(e, 'json').decode('utf-8')) == e
+
+@pytest.mark.parametrize('codec', [ 'msgpack', 'cbor' ])
+def test_binary_round_trip(codec):
+    if not envelope.available(codec):
+        pytest.skip(f'{codec} is not installed')
+
+    e = envelope.make('#test', 'nick!user@host', 'PRIVMSG', 'hello')
+
+    assert envelope.decode(envelope.encode(e, codec)) == e
+
+def test_json_is_always_available():
+    assert envelope.available('json')
+    assert not envelope.available('xml')
+
+@pytest.mark.parametrize('payload', [ b'', b'hello', b'{broken', b'[1, 2]', b'{"v": 2, "text": "x"}', b'{"text": "x"}' ])
+def test_decode_rejects(payload):
+    assert envelope.decode(payload) == None
+
+def test_ids_are_unique():
+    ids = set(envelope.next_id() for i in range(1000))
+
+    assert len(ids) == 1000
+
+    assert envelope.make('#a', None, 'PRIVMSG', 'x')['id'] != envelope.make('#a', None, 'PRIVMSG', 'x')['id']
+
+def test_channel_level():
+    assert envelope.channel_level('#test') == 'test'
+    assert envelope.channel_level('nick')  == '\\nick'
+
+    assert envelope.level_channel('test')   == '#test'
+    assert envelope.level_channel('\\nick') == 'nick'
+
+    for channel in ('#test', 'nick'):
+        assert envelope.level_channel(envelope.channel_level(channel)) == channel
@@ -0,0 +1,161 @@
+import gzip
+import http_server
+from http_server import chunk_size, content_length, etag_matches, gzip_etag, http_error, make_etag, respond
+import io
+import pytest
+
+
+class fake_plugins:
+    def __init__(self):
+        self.generation = 1
+
+    def get_stats(self):
+        return { f'plugin-{i}': { 'commands': i } for i in range(100) }
+
+class fake_ghbot:
+    def __init__(self):
+        self.plugins = fake_plugins()
+
+def test_etag_matches():
+    etag = make_etag(b'hello')
+
+    assert etag_matches(etag, etag)
+    assert etag_matches(etag, f'"other", {etag}')
+    assert etag_matches(etag, 'W/' + etag)
+    assert etag_matches(etag, '*')
+
+    assert not etag_matches(etag, '')
+    assert not etag_matches(etag, '"other"')
+    assert not etag_matches(etag, gzip_etag(etag))
+
+def test_gzip_etag_differs():
+    etag = make_etag(b'hello')
+
+    assert gzip_etag(etag) != etag
+    assert gzip_etag(etag).startswith('"') and gzip_etag(etag).endswith('"')
+
+def test_content_length():
+    assert content_length({ }, 100) == 0
+    assert content_length({ 'content-length': ' 100 ' }, 100) == 100
+
+    for value in ('-1', 'abc', '1e3', '', '١٢'):
+        with pytest.raises(http_error) as he:
+            content_length({ 'content-length': value }, 100)
+
+        assert he.value.code == 400
+
+    with pytest.raises(http_error) as he:
+        content_length({ 'content-length': '101' }, 100)
+
+    assert he.value.code == 413
+
+def test_chunk_size():
+    assert chunk_size(b'1a\r\n') == 26
+    assert chunk_size(b'0\r\n')  == 0
+    assert chunk_size(b'10;name=value\r\n') == 16
+
+    for line in (b'\r\n', b'', b'-1\r\n', b'0x10\r\n', b'zz\r\n'):
+        with pytest.raises(http_error) as he:
+            chunk_size(line)
+
+        assert he.value.code == 400
+
+def get(ghbot, path, headers=dict()):
+    code, out, body = respond(ghbot, 'GET', path, headers, b'')
+
+    return code, dict(out), body
+
+def test_etag_and_304():
+    ghbot = fake_ghbot()
+
+    code, out, body = get(ghbot, '/plugins-registry.cgi')
+
+    assert code == 200
+    assert out['ETag'] == make_etag(body)
+    assert not 'Content-Encoding' in out
+
+    code, out, body = get(ghbot, '/plugins-registry.cgi', { 'if-none-match': out['ETag'] })
+
+    assert code == 304
+    assert body == b''
+
+def test_gzip():
+    ghbot = fake_ghbot()
+
+    code, plain_out, plain = get(ghbot, '/plugins-registry.cgi')
+
+    code, out, body = get(ghbot, '/plugins-registry.cgi', { 'accept-encoding': 'deflate, gzip' })
+
+    assert code == 200
+    assert out['Content-Encoding'] == 'gzip'
+    assert out['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(body) == plain
+
+    # the ETag of the other representation does not match
+    assert out['ETag'] == gzip_etag(plain_out['ETag'])
+
+    code, out, body = get(ghbot, '/plugins-registry.cgi', { 'accept-encoding': 'gzip', 'if-none-match': plain_out['ETag'] })
+
+    assert code == 200
+
+    code, out, body = get(ghbot, '/plugins-registry.cgi', { 'accept-encoding': 'gzip', 'if-none-match': out['ETag'] })
+
+    assert code == 304
+    assert out['Vary'] == 'Accept-Encoding'
+
+def test_small_replies_are_not_gzipped():
+    code, out, body = get(fake_ghbot(), '/nothing-here', { 'accept-encoding': 'gzip' })
+
+    assert code == 404
+    assert not 'Content-Encoding' in out
+    assert not 'ETag' in out
+
+def test_snapshot_is_reused_until_the_generation_changes(monkeypatch):
+    renders = []
+
+    def render(ghbot):
+        renders.append(ghbot.plugins.generation)
+
+        return (200, 'text/html', bytes(f'<html>{ghbot.plugins.generation}</html>' + ' ' * 600, 'utf8'))
+
+    monkeypatch.setattr(http_server, 'snapshots', { '/': http_server.snapshot(render, max_age=3600.) })
+
+    ghbot = fake_ghbot()
+
+    code, out1, body1 = get(ghbot, '/')
+    code, out2, body2 = get(ghbot, '/?x=1', { 'accept-encoding': 'gzip' })
+
+    assert renders == [ 1 ]
+    assert gzip.decompress(body2) == body1
+    assert out2['ETag'] == gzip_etag(out1['ETag'])
+
+    ghbot.plugins.generation = 2
+
+    code, out3, body3 = get(ghbot, '/')
+
+    assert renders == [ 1, 2 ]
+    assert out3['ETag'] != out1['ETag']
+
+def read_body(raw, headers, limit=1000):
+    handler = http_server.http_requesthandler.__new__(http_server.http_requesthandler)
+
+    handler.rfile = io.BytesIO(raw)
+
+    return handler._read_body(headers, limit)
+
+def test_read_body():
+    assert read_body(b'hello world', { 'content-length': '5' }) == b'hello'
+
+    chunked = { 'transfer-encoding': 'chunked' }
+
+    assert read_body(b'5\r\nhello\r\n6;x=y\r\n world\r\n0\r\nTrailer: a\r\n\r\n', chunked) == b'hello world'
+
+    with pytest.raises(http_error) as he:
+        read_body(b'5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n', chunked, limit=10)
+
+    assert he.value.code == 413
+
+    with pytest.raises(http_error) as he:
+        read_body(b'x\r\n', chunked)
+
+    assert he.value.code == 400
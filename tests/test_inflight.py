@@ -0,0 +1,59 @@
+from inflight import inflight_tracker
+import time
+
+
+def make_tracker(timeout=30.):
+    timed_out = []
+
+    t = inflight_tracker(timeout, lambda command, channel: timed_out.append((command, channel)), autostart=False)
+
+    return t, timed_out
+
+def test_reply_by_id():
+    t, timed_out = make_tracker()
+
+    t.add('a', 'define', '#test')
+    t.add('b', 'weather', '#test')
+
+    assert t.reply('b') == True
+    assert t.reply('b') == False
+
+    stats = t.get_stats()
+
+    assert stats['inflight'] == 1
+    assert stats['commands']['weather']['answered'] == 1
+    assert stats['commands']['weather']['latency']['count'] == 1
+    assert 'define' not in stats['commands']
+
+def test_unknown_or_missing_id_does_not_match():
+    t, timed_out = make_tracker()
+
+    t.add('a', 'define', '#test')
+
+    # e.g. an unsolicited message or a legacy reply
+    assert t.reply(None) == False
+    assert t.reply('other') == False
+
+    assert t.get_stats()['inflight'] == 1
+
+def test_timeout():
+    t, timed_out = make_tracker(timeout=0.)
+
+    t.add('a', 'define', '#Test')
+    t.add('b', 'weather', '#test')
+
+    assert t.reply('b') == True
+
+    time.sleep(0.01)
+
+    t.expire()
+
+    assert timed_out == [ ('define', '#Test') ]
+
+    # too late
+    assert t.reply('a') == False
+
+    stats = t.get_stats()
+
+    assert stats['inflight'] == 0
+    assert stats['commands']['define'] == { 'answered': 0, 'timeouts': 1 }
@@ -0,0 +1,75 @@
+from line_reader import line_reader
+
+
+def test_partial_line_across_feeds():
+    r = line_reader()
+
+    assert r.feed(b':server PING') == []
+    assert r.feed(b' :abc\r') == []
+    assert r.feed(b'\n:server NOTICE') == [ ':server PING :abc' ]
+    assert r.feed(b' * :hello\r\n') == [ ':server NOTICE * :hello' ]
+
+    assert r.get_stats()['buffered'] == 0
+
+def test_several_lines_in_one_feed():
+    r = line_reader()
+
+    assert r.feed(b'one\r\ntwo\n\r\n  \nthree\r\nfour') == [ 'one', 'two', 'three' ]
+    assert r.feed(b'\n') == [ 'four' ]
+
+    assert r.get_stats()['lines'] == 4
+
+def test_utf8_sequence_split_across_feeds():
+    r = line_reader()
+
+    data = 'PRIVMSG #a :héllo €\r\n'.encode('utf-8')
+
+    out = []
+
+    for i in range(len(data)):
+        out += r.feed(data[i:i + 1])
+
+    assert out == [ 'PRIVMSG #a :héllo €' ]
+
+    assert r.get_stats()['latin-1'] == 0
+
+def test_latin1_fallback():
+    r = line_reader()
+
+    assert r.feed('PRIVMSG #a :héllo\r\n'.encode('latin-1')) == [ 'PRIVMSG #a :héllo' ]
+
+    assert r.get_stats()['latin-1'] == 1
+
+def test_overflow_is_dropped():
+    r = line_reader()
+
+    assert r.feed(b'x' * (line_reader.max_line_length + 1)) == []
+
+    assert r.get_stats()['overflows'] == 1
+
+    assert r.feed(b'rest\r\nnext\r\n') == [ 'next' ]
+
+def test_reset():
+    r = line_reader()
+
+    r.feed(b'half a line')
+
+    r.reset()
+
+    assert r.feed(b'whole\r\n') == [ 'whole' ]
+
+def test_rest_of_a_line_that_is_too_long_is_skipped():
+    r = line_reader()
+
+    assert r.feed(b'PRIVMSG #a :' + b'x' * line_reader.max_line_length) == []
+
+    # what comes after the cut is not a line of its own
+    assert r.feed(b'x' * 100) == []
+    assert r.feed(b'QUIT :injected\r\nPING :ok\r\n') == [ 'PING :ok' ]
+
+def test_long_line_in_one_feed_is_dropped():
+    r = line_reader()
+
+    assert r.feed(b'x' * (line_reader.max_line_length + 1) + b'\r\nPING :ok\r\n') == [ 'PING :ok' ]
+
+    assert r.get_stats()['overflows'] == 1
@@ -0,0 +1,126 @@
+import json
+from message_ingest import ingest_error, message_ingest
+import pytest
+from send_queue import send_queue
+
+
+class fake_bot:
+    def __init__(self, queue_size=1000):
+        # never connected: everything stays in the queue
+        self.sender = send_queue(lambda line: None, lambda lane: False, 1., 10., False, queue_size)
+
+def ndjson(messages):
+    return '\n'.join(json.dumps({ 'channel': channel, 'text': text }) for channel, text in messages).encode('utf8')
+
+def test_parse_forms():
+    i = message_ingest(fake_bot())
+
+    assert i.parse(b'{"channel": "#a", "text": " hi "}') == ([ ('#a', 'hi') ], True)
+    assert i.parse(b'[{"channel": "#a", "text": "1"}, {"channel": "#b", "text": "2"}]') == ([ ('#a', '1'), ('#b', '2') ], False)
+    assert i.parse(b'{"channel": "#a", "text": "1"}\n\n{"channel": "#a", "text": "2"}\n') == ([ ('#a', '1'), ('#a', '2') ], False)
+
+@pytest.mark.parametrize('body, code', [
+    (b'', 400),
+    (b'[]', 400),
+    (b'\xff', 400),
+    (b'{"channel": "#a"}', 400),
+    (b'{"channel": "#a b", "text": "x"}', 400),
+    (b'{"channel": "#a", "text": "x\\r\\nQUIT"}', 400),
+    (b'{"channel": "#a", "text": "x"}\nnot json', 400),
+    (b'[' + b','.join([ b'{"channel": "#a", "text": "x"}' ] * 11) + b']', 413),
+    (b' ' * 1001, 413),
+    ])
+def test_parse_errors(body, code):
+    i = message_ingest(fake_bot(), max_bytes=1000, max_messages=10)
+
+    with pytest.raises(ingest_error) as e:
+        i.parse(body)
+
+    assert e.value.code == code
+
+def test_split_by_bytes():
+    pieces = message_ingest.split('ü€ ' * 300, 100)
+
+    assert all(len(p.encode('utf8')) <= 100 for p in pieces)
+
+    assert ' '.join(pieces) == ('ü€ ' * 300).strip()
+
+    # no space: cut at a character boundary
+    pieces = message_ingest.split('€' * 100, 10)
+
+    assert pieces == [ '€' * 3 ] * 33 + [ '€' ]
+
+def test_coalesce():
+    lines = message_ingest.coalesce([ ('#a', 'one'), ('#b', 'two'), ('#a', 'three'), ('#a', 'x' * 1000) ])
+
+    assert lines[0] == ('#a', 'one / three')
+    assert lines[-1] == ('#b', 'two')
+
+    limit = message_ingest.text_limit('#a')
+
+    assert all(len(text.encode('utf8')) <= limit for channel, text in lines)
+    assert ''.join(text for channel, text in lines[1:-1]) == 'x' * 1000
+
+def test_rate_limit_counts_lines():
+    bot = fake_bot()
+    i   = message_ingest(bot, max_messages=1000, capacity=10, refill_rate=0.001)
+
+    # 150 short messages fit in a few lines
+    code, reply, single = i.submit({}, ndjson([ ('#a', f'build {n} failed') for n in range(150) ]))
+
+    assert code == 202
+    assert reply['accepted'] == 150
+    assert reply['lines'] < 10
+    assert reply['position'] == reply['lines'] == bot.sender.depth()
+
+    code, reply, single = i.submit({}, ndjson([ (f'#c{n}', 'x') for n in range(9) ]))
+
+    assert code == 429
+
+def test_batch_larger_than_capacity_is_413():
+    i = message_ingest(fake_bot(), capacity=10, refill_rate=0.001)
+
+    code, reply, single = i.submit({}, ndjson([ (f'#c{n}', 'x') for n in range(11) ]))
+
+    # retrying would not help
+    assert code == 413
+
+    code, reply, single = i.submit({}, ndjson([ (f'#c{n}', 'x') for n in range(10) ]))
+
+    assert code == 202
+
+def test_full_queue_is_503_and_nothing_is_queued():
+    bot = fake_bot(queue_size=5)
+    i   = message_ingest(bot)
+
+    assert i.submit({}, ndjson([ (f'#c{n}', 'x') for n in range(4) ]))[0] == 202
+
+    code, reply, single = i.submit({}, ndjson([ (f'#c{n}', 'x') for n in range(2) ]))
+
+    assert code == 503
+    assert bot.sender.depth() == 4
+
+    # a failed attempt costs no tokens
+    assert i.buckets['anonymous'].tokens >= 95
+
+def test_eta_is_for_the_broadcast_lane():
+    bot = fake_bot()
+    i   = message_ingest(bot)
+
+    bot.sender.put('PRIVMSG #a :' + 'r' * 200, send_queue.REPLY)
+
+    code, reply, single = i.submit({}, ndjson([ ('#a', 'x' * 108) ]))
+
+    assert reply['position'] == 1
+    assert reply['eta'] == pytest.approx(1. + 120 / 120, abs=0.01)
+
+def test_tokens():
+    i = message_ingest(fake_bot(), tokens={ 'ci': 'secret' })
+
+    assert i.submit({}, b'{"channel": "#a", "text": "x"}')[0] == 401
+    assert i.submit({ 'authorization': 'Bearer wrong' }, b'{"channel": "#a", "text": "x"}')[0] == 401
+
+    code, reply, single = i.submit({ 'authorization': 'Bearer secret' }, b'{"channel": "#a", "text": "x"}')
+
+    assert code == 202
+    assert single == True
@@ -0,0 +1,64 @@
+import metrics
+import threading
+
+
+def in_thread(function):
+    t = threading.Thread(target=function)
+    t.start()
+    t.join()
+
+def test_counters_of_all_threads_are_added_up():
+    m = metrics.metrics()
+
+    m.describe('test_total', 'counter', 'A test')
+
+    m.inc('test_total', (('command', 'PRIVMSG'),))
+
+    for i in range(3):
+        in_thread(lambda: m.inc('test_total', (('command', 'PRIVMSG'),), 2))
+
+    text = m.render()
+
+    assert '# HELP test_total A test' in text
+    assert 'test_total{command="PRIVMSG"} 7' in text
+
+def test_histogram():
+    m = metrics.metrics()
+
+    m.observe('test_seconds', (), 0.0002)
+    m.observe('test_seconds', (), 0.003)
+
+    lines = m.render().split('\n')
+
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{le="0.00025"} 1' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'test_seconds_count 2' in lines
+
+def test_labels_are_escaped():
+    m = metrics.metrics()
+
+    m.inc('test_total', (('nick', 'a"b\\c'),))
+
+    assert 'test_total{nick="a\\"b\\\\c"} 1' in m.render()
+
+def test_shards_of_stopped_threads_are_folded_without_scrape():
+    m = metrics.metrics()
+
+    for i in range(1000):
+        in_thread(lambda: m.inc('test_total'))
+
+    assert len(m.shards) < 100
+
+    assert 'test_total 1000' in m.render()
+
+def test_gauges():
+    m = metrics.metrics()
+
+    m.gauge('test_depth', lambda: { (('lane', 'reply'),): 3 }, 'Depth')
+    m.gauge('test_broken', lambda: 1 / 0)
+
+    text = m.render()
+
+    assert 'test_depth{lane="reply"} 3' in text
+    assert 'test_broken' not in text
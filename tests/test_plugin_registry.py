@@ -0,0 +1,112 @@
+import plugin_registry as pr
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [ 1000. ]
+
+    monkeypatch.setattr(pr.time, 'time', lambda: now[0])
+
+    return now
+
+def add(r, command, descr='descr', **kwargs):
+    return r.add(command, descr, 'group', 'author', 'here', 'help', **kwargs)
+
+def test_add_results(clock):
+    r = pr.plugin_registry(timeout=60.)
+
+    assert add(r, 'define') == pr.plugin_registry.add_rc.ADDED
+    assert add(r, 'define') == pr.plugin_registry.add_rc.HEARTBEAT
+    assert add(r, 'define', descr='other') == pr.plugin_registry.add_rc.UPDATED
+
+    assert add(r, 'help', hardcoded=True) == pr.plugin_registry.add_rc.ADDED
+    assert add(r, 'help') == pr.plugin_registry.add_rc.REFUSED
+
+def test_expiry(clock):
+    r = pr.plugin_registry(timeout=60.)
+
+    add(r, 'define')
+    add(r, 'help', hardcoded=True)
+    add(r, 'last-will', expires=False)
+
+    assert r.expire(clock[0] + 59.) == []
+    assert r.expire(clock[0] + 60.) == [ 'define' ]
+
+    assert 'define' not in r
+    assert 'help' in r
+    assert 'last-will' in r
+
+    assert r.gone_since('define') == clock[0] + 60.
+    assert r.next_deadline() == None
+
+    # registering again clears 'gone'
+    add(r, 'define')
+
+    assert r.gone_since('define') == None
+
+def test_heartbeat_pushes_the_deadline_back(clock):
+    r = pr.plugin_registry(timeout=60.)
+
+    add(r, 'define')
+
+    clock[0] += 30.
+
+    assert add(r, 'define') == pr.plugin_registry.add_rc.HEARTBEAT
+
+    # one heap entry per command, still at the first deadline
+    assert len(r.deadlines) == 1
+    assert r.next_deadline() == 1060.
+
+    # due, but seen since: pushed back instead of forgotten
+    assert r.expire(1060.) == []
+
+    assert 'define' in r
+    assert len(r.deadlines) == 1
+    assert r.next_deadline() == 1090.
+
+    assert r.expire(1090.) == [ 'define' ]
+
+    assert len(r.deadlines) == 0
+
+def test_bulk_heartbeat(clock):
+    r = pr.plugin_registry(timeout=60.)
+
+    add(r, 'one', plugin='weather')
+    add(r, 'two', plugin='weather')
+    add(r, 'three')
+
+    assert r.by_plugin('weather') == [ 'one', 'two' ]
+
+    clock[0] += 50.
+
+    assert r.heartbeat('weather') == True
+    assert r.heartbeat('unknown') == False
+
+    assert r.expire(1060.) == [ 'three' ]
+    assert sorted(r.expire(1110.)) == [ 'one', 'two' ]
+
+    # all of its commands expired: it has to register again
+    assert r.heartbeat('weather') == False
+
+def test_remove_and_replace(clock):
+    r = pr.plugin_registry(timeout=60.)
+
+    add(r, 'define')
+    add(r, 'help', hardcoded=True)
+
+    assert r.remove('help') == False
+    assert r.remove('define') == True
+    assert r.remove('define') == False
+
+    assert r.by_acl_group('group') == [ 'help' ]
+
+    # removed commands leave a stale heap entry that expire() drops
+    assert r.expire(1060.) == []
+    assert len(r.deadlines) == 0
+
+    r.replace([ 'help' ], [ ('local', 'descr', 'other', 'author', 'here', 'help') ])
+
+    assert r.commands() == [ 'local' ]
+    assert r.get_acl_groups() == [ 'other' ]
+    assert r.get('local').hardcoded == True
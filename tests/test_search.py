@@ -0,0 +1,98 @@
+from search import memory_define_search, mysql_define_search, plugin_search, substring_index
+import threading
+
+
+def test_substring_index():
+    i = substring_index()
+
+    i.add(1, name='Weather', body='sunny and warm, warm')
+    i.add(2, name='feather', body='light')
+
+    assert i.find('name', 'eath') == { 1: 1, 2: 1 }
+    assert i.find('body', 'WARM') == { 1: 2 }
+    assert i.find('name', 'we') == { 1: 1 }
+
+    i.add(1, name='rain', body='wet')
+
+    assert i.find('name', 'eath') == { 2: 1 }
+
+    i.remove(2)
+
+    assert i.find('name', 'eath') == {}
+    assert i.postings.get(('name', 'eat')) == None
+
+def make_search():
+    s = memory_define_search()
+
+    s.define_added(1, 'Beer', False, 'cold beer')
+    s.define_added(2, 'beers', False, 'more beer')
+    s.define_added(3, 'rootbeer', True, 'no alcohol')
+    s.define_added(4, 'water', False, 'beer is better')
+
+    return s
+
+def test_ranking():
+    s = make_search()
+
+    assert [ nr for command, nr, text in s.search('beer', False) ] == [ 1, 2, 3 ]
+    assert [ nr for command, nr, text in s.search('beer', True) ] == [ 1, 2, 3, 4 ]
+
+    # a number is a row number as well
+    assert s.search('4', False)[0] == ('water', 4, 'beer is better')
+
+def test_by_name_and_delete():
+    s = make_search()
+
+    assert s.by_name('beer') == [ ('rootbeer', True, 3), ('beers', False, 2), ('beer', False, 1) ]
+
+    s.define_deleted(2, 'beers', False)
+
+    assert [ nr for command, nr, text in s.search('beer', False) ] == [ 1, 3 ]
+
+def test_concurrent_changes():
+    s = make_search()
+
+    stop   = threading.Event()
+    errors = []
+
+    def churn():
+        n = 100
+
+        while not stop.is_set():
+            s.define_added(n, f'beer{n}', False, 'beer')
+            s.define_deleted(n, f'beer{n}', False)
+
+            n += 1
+
+    t = threading.Thread(target=churn)
+    t.start()
+
+    try:
+        for i in range(2000):
+            s.search('beer', True)
+            s.by_name('beer')
+
+    except Exception as e:
+        errors.append(e)
+
+    stop.set()
+    t.join()
+
+    assert errors == []
+
+def test_boolean_query():
+    assert mysql_define_search._boolean_query('cold beer') == '+cold* +beer*'
+    assert mysql_define_search._boolean_query('a b') == None
+
+def test_plugin_search():
+    p = plugin_search()
+
+    p.set('weather', 'Shows the weather forecast')
+    p.set('forecast', 'Alias of weather')
+
+    assert p.by_name('cast') == [ 'forecast' ]
+    assert p.by_description('weather', 10) == [ 'forecast', 'weather' ]
+
+    p.remove('forecast')
+
+    assert p.by_description('weather', 10) == [ 'weather' ]
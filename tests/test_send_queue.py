@@ -0,0 +1,126 @@
+from conftest import wait_for
+from send_queue import send_queue
+import time
+
+
+class sink:
+    def __init__(self, connected=True):
+        self.lines     = []
+        self.times     = []
+        self.connected = connected
+
+    def transmit(self, line):
+        self.lines.append(line)
+        self.times.append(time.time())
+
+    def can_send(self, lane):
+        return self.connected
+
+def make_queue(s, penalty=0., burst=10., coalesce=False, queue_size=1000):
+    return send_queue(s.transmit, s.can_send, penalty, burst, coalesce, queue_size)
+
+def test_lowest_lane_goes_first():
+    s = sink(connected=False)
+    q = make_queue(s)
+
+    q.put('PRIVMSG #a :broadcast', send_queue.BROADCAST)
+    q.put('PRIVMSG #a :reply', send_queue.REPLY)
+    q.put('PONG :server', send_queue.PROTOCOL)
+
+    s.connected = True
+
+    assert wait_for(lambda: len(s.lines) == 3)
+
+    assert s.lines == [ 'PONG :server', 'PRIVMSG #a :reply', 'PRIVMSG #a :broadcast' ]
+
+def test_penalty_and_burst():
+    s = sink()
+    q = make_queue(s, penalty=0.2, burst=0.3)
+
+    for i in range(6):
+        q.put(f'PRIVMSG #a :{i}')
+
+    assert wait_for(lambda: len(s.lines) >= 2)
+
+    # the burst goes out at once, the rest is paced
+    assert s.times[1] - s.times[0] < 0.1
+
+    q.put('PONG :server', send_queue.PROTOCOL)
+
+    assert wait_for(lambda: len(s.lines) == 7)
+
+    assert s.lines.index('PONG :server') < 6
+
+    assert s.times[-1] - s.times[0] >= 0.9
+
+def test_coalescing():
+    s = sink(connected=False)
+    q = make_queue(s, coalesce=True)
+
+    q.put('PRIVMSG #a :one')
+    q.put('PRIVMSG #a :two')
+    q.put('PRIVMSG #a :\001ACTION three\001')
+    q.put('PRIVMSG #a :four')
+    q.put('PRIVMSG #b :five')
+
+    s.connected = True
+
+    assert wait_for(lambda: q.depth() == 0 and len(s.lines) == 4)
+
+    assert s.lines == [ 'PRIVMSG #a :one / two', 'PRIVMSG #a :\001ACTION three\001', 'PRIVMSG #a :four', 'PRIVMSG #b :five' ]
+
+    assert q.get_stats()['reply']['coalesced'] == 1
+
+def test_coalesce_limit_is_in_bytes():
+    s = sink(connected=False)
+    q = make_queue(s, coalesce=True)
+
+    # 150 characters, 300 bytes
+    text = 'é' * 150
+
+    q.put(f'PRIVMSG #a :{text}')
+    q.put(f'PRIVMSG #a :{text}')
+
+    s.connected = True
+
+    assert wait_for(lambda: len(s.lines) == 2)
+
+    assert s.lines == [ f'PRIVMSG #a :{text}' ] * 2
+
+def test_full_lane_drops_the_oldest():
+    s = sink(connected=False)
+    q = make_queue(s, queue_size=2)
+
+    assert q.put('PRIVMSG #a :1')
+    assert q.put('PRIVMSG #a :2')
+    assert q.put('PRIVMSG #a :3') == False
+
+    # the protocol lane is not bounded
+    for i in range(3):
+        assert q.put('PING :x', send_queue.PROTOCOL)
+
+    assert q.get_stats()['reply']['dropped'] == 1
+
+    s.connected = True
+
+    assert wait_for(lambda: len(s.lines) == 5)
+
+    assert s.lines[3:] == [ 'PRIVMSG #a :2', 'PRIVMSG #a :3' ]
+
+def test_clear_keeps_protocol_lines():
+    s = sink(connected=False)
+    q = make_queue(s)
+
+    q.put('PRIVMSG #a :reply', send_queue.REPLY)
+    q.put('PRIVMSG #a :broadcast', send_queue.BROADCAST)
+    q.put('PONG :server', send_queue.PROTOCOL)
+
+    q.clear()
+
+    assert q.depth() == 1
+
+    s.connected = True
+
+    assert wait_for(lambda: len(s.lines) == 1)
+
+    assert s.lines == [ 'PONG :server' ]
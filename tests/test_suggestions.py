@@ -0,0 +1,56 @@
+from suggestions import deletes, edit_distance, soundex, suggestion_index
+import time
+
+
+def make_index(*names):
+    index = suggestion_index()
+
+    for name in names:
+        index.add(name)
+
+    return index
+
+def test_edit_distance():
+    assert edit_distance('define', 'define', 2) == 0
+    assert edit_distance('define', 'defnie', 2) == 2
+    assert edit_distance('define', 'dfine', 2) == 1
+    assert edit_distance('define', 'xxxxxx', 2) == 3
+
+def test_deletes():
+    assert deletes('abc', 1) == { 'abc', 'bc', 'ac', 'ab' }
+
+def test_soundex():
+    assert soundex('Robert') == soundex('Rupert') == 'R163'
+
+def test_closest_first_and_at_most_k():
+    index = make_index('define', 'defines', 'refine', 'decline', 'weather')
+
+    assert index.suggest('defin') == [ 'define', 'defines', 'refine' ]
+    assert len(index.suggest('defin', k=2)) == 2
+
+    assert index.suggest('DEFINE', k=1) == [ 'define' ]
+
+def test_short_words_allow_one_edit():
+    index = make_index('ping', 'pi')
+
+    assert index.suggest('pa') == [ 'pi' ]
+
+def test_reference_counting():
+    index = make_index('define', 'define')
+
+    index.remove('define')
+
+    assert index.suggest('defin') == [ 'define' ]
+
+    index.remove('define')
+
+    assert index.suggest('defin') == []
+
+def test_long_queries_are_cheap():
+    index = make_index('define', 'weather')
+
+    start = time.time()
+
+    assert index.suggest('x' * 400) == []
+
+    assert time.time() - start < 0.05
@@ -0,0 +1,103 @@
+from topic_router import topic_router
+
+
+def h_exact(*args):
+    pass
+
+def h_plus(*args):
+    pass
+
+def h_hash(*args):
+    pass
+
+def test_exact_route():
+    r = topic_router()
+
+    r.add('to/bot/register', h_exact, ('a', 'b'), 'control')
+
+    assert r.resolve('to/bot/register')  == (h_exact, ('a', 'b'))
+    assert r.classify('to/bot/register') == 'control'
+
+    assert r.resolve('to/bot/other') == None
+    assert r.classify('to/bot/other') == None
+
+def test_plus_matches_one_level():
+    r = topic_router()
+
+    r.add('to/irc-v1/+/privmsg', h_plus)
+
+    assert r.resolve('to/irc-v1/test/privmsg') == (h_plus, ('test',))
+
+    assert r.resolve('to/irc-v1/privmsg')        == None
+    assert r.resolve('to/irc-v1/a/b/privmsg')    == None
+    assert r.resolve('to/irc-v1/test/privmsg/x') == None
+
+def test_hash_matches_the_remaining_levels():
+    r = topic_router()
+
+    r.add('to/irc-v1/+/#', h_hash, topic_class='event')
+
+    assert r.resolve('to/irc-v1/test/privmsg')  == (h_hash, ('test', 'privmsg'))
+    assert r.resolve('to/irc-v1/test/a/b/c')    == (h_hash, ('test', 'a/b/c'))
+    assert r.classify('to/irc-v1/test/privmsg') == 'event'
+
+    assert r.resolve('to/irc-v1/test') == None
+
+def test_precedence():
+    r = topic_router()
+
+    r.add('to/irc-v1/+/#',          h_hash)
+    r.add('to/irc-v1/+/privmsg',    h_plus)
+    r.add('to/irc-v1/test/privmsg', h_exact, ('#test',))
+
+    # literal beats '+' beats '#'
+    assert r.resolve('to/irc-v1/test/privmsg')  == (h_exact, ('#test',))
+    assert r.resolve('to/irc-v1/other/privmsg') == (h_plus, ('other',))
+    assert r.resolve('to/irc-v1/other/notice')  == (h_hash, ('other', 'notice'))
+
+def test_literal_prefix_falls_back_to_wildcard():
+    r = topic_router()
+
+    r.add('a/b/c', h_exact)
+    r.add('a/+/d', h_plus)
+
+    # 'a/b' exists as a literal path but leads nowhere for 'd'
+    assert r.resolve('a/b/d') == (h_plus, ('b',))
+
+def test_remove():
+    r = topic_router()
+
+    r.add('to/bot/register', h_exact)
+    r.add('to/irc-v1/+/privmsg', h_plus)
+    r.add('to/irc-v1/+/#', h_hash)
+
+    r.remove('to/bot/register')
+    r.remove('to/irc-v1/+/privmsg')
+
+    assert r.resolve('to/bot/register') == None
+    assert r.resolve('to/irc-v1/test/privmsg') == (h_hash, ('test', 'privmsg'))
+
+    r.remove('to/irc-v1/+/#')
+
+    assert r.resolve('to/irc-v1/test/privmsg') == None
+    assert len(r.root) == 0
+
+    # unknown routes are ignored
+    r.remove('no/such/+/route')
+
+def test_channel_routes():
+    r = topic_router()
+
+    r.add_channel('#test', h_plus, h_hash, h_exact)
+
+    assert r.resolve('to/irc/test/privmsg') == (h_plus, ('#test',))
+    assert r.resolve('to/irc/test/notice')  == (h_hash, ('#test',))
+    assert r.resolve('to/irc/test/topic')   == (h_exact, ('#test',))
+
+    assert r.classify('to/irc/test/privmsg') == 'message'
+    assert r.classify('to/irc/test/topic')   == 'state'
+
+    r.remove_channel('#test')
+
+    assert r.resolve('to/irc/test/privmsg') == None
+    assert len(r.exact) == 0
@@ -0,0 +1,73 @@
+from topic_trie import topic_trie
+
+
+def cb(name):
+    return lambda topic, payload: name
+
+def names(trie, topic):
+    return sorted(c(topic, None) for c in trie.match(topic))
+
+def test_exact():
+    t = topic_trie()
+
+    t.add('ghbot/to/irc/#a/privmsg', cb('a'))
+
+    assert names(t, 'ghbot/to/irc/#a/privmsg') == [ 'a' ]
+    assert names(t, 'ghbot/to/irc/#a') == []
+    assert names(t, 'ghbot/to/irc/#a/privmsg/x') == []
+
+def test_plus_matches_exactly_one_level():
+    t = topic_trie()
+
+    t.add('ghbot/+/irc', cb('plus'))
+
+    assert names(t, 'ghbot/to/irc') == [ 'plus' ]
+    assert names(t, 'ghbot/from/irc') == [ 'plus' ]
+    assert names(t, 'ghbot/irc') == []
+    assert names(t, 'ghbot/to/x/irc') == []
+    assert names(t, 'ghbot/to/irc/x') == []
+
+def test_hash_matches_the_remaining_levels():
+    t = topic_trie()
+
+    t.add('ghbot/to/#', cb('hash'))
+
+    assert names(t, 'ghbot/to/irc') == [ 'hash' ]
+    assert names(t, 'ghbot/to/irc/#a/privmsg') == [ 'hash' ]
+    assert names(t, 'ghbot/from/irc') == []
+
+    # the parent level as well
+    assert names(t, 'ghbot/to') == [ 'hash' ]
+    assert names(t, 'ghbot') == []
+
+def test_plus_and_hash_combined():
+    t = topic_trie()
+
+    t.add('+/to/#', cb('a'))
+    t.add('ghbot/+/+/#', cb('b'))
+    t.add('#', cb('all'))
+
+    assert names(t, 'ghbot/to') == [ 'a', 'all' ]
+    assert names(t, 'ghbot/to/irc') == [ 'a', 'all', 'b' ]
+    assert names(t, 'x/from/irc/y') == [ 'all' ]
+
+def test_dollar_topics():
+    t = topic_trie()
+
+    t.add('#', cb('all'))
+    t.add('+/broker/uptime', cb('plus'))
+    t.add('$SYS/#', cb('sys'))
+
+    assert names(t, '$SYS/broker/uptime') == [ 'sys' ]
+    assert names(t, 'x/broker/uptime') == [ 'all', 'plus' ]
+
+def test_callbacks_are_returned_once():
+    t = topic_trie()
+
+    c = cb('c')
+
+    t.add('ghbot/to/irc', c)
+    t.add('ghbot/+/irc', c)
+    t.add('ghbot/#', c)
+
+    assert t.match('ghbot/to/irc') == [ c ]
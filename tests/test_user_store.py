@@ -0,0 +1,105 @@
+from user_store import user_store
+
+
+def test_rfc1459_casemapping():
+    s = user_store()
+
+    s.join('#Test', 'Nurd[X]\\~!user@host')
+
+    for nick in ('nurd{x}|^', 'NURD[X]\\~', 'Nurd{x}\\^'):
+        assert nick in s
+
+    assert s.members('#TEST') == [ 'Nurd[X]\\~' ]
+    assert s.nick_of('NURD{X}|^!USER@HOST') == 'Nurd[X]\\~'
+
+def test_strict_rfc1459_and_ascii():
+    s = user_store(casemapping='strict-rfc1459')
+
+    s.join('#test', 'a[~!u@h')
+
+    assert 'A{~' in s
+    assert 'a[^' not in s
+
+    s.set_casemapping('ascii')
+
+    assert 'A[~' in s
+    assert 'a{~' not in s
+    assert s.members('#TEST') == [ 'a[~' ]
+
+def test_nick_change():
+    s = user_store()
+
+    s.joined('#a')
+    s.joined('#b')
+    s.join('#a', 'Folkert!fvh@host')
+    s.join('#b', 'Folkert!fvh@host')
+
+    s.nick_change('FOLKERT', 'Flok[1]')
+
+    assert 'folkert' not in s
+    assert 'flok{1}' in s
+
+    assert s['FLOK[1]'] == 'Flok[1]!fvh@host'
+    assert s.nick_of('flok{1}!fvh@host') == 'Flok[1]'
+    assert s.known('folkert!fvh@host') == False
+
+    assert s.members('#a') == [ 'Flok[1]' ]
+    assert s.members('#b') == [ 'Flok[1]' ]
+
+def test_names_prefixes_and_who():
+    s = user_store()
+
+    s.joined('#test')
+    s.names('#test', [ '@op', '+voiced', '~@owner', 'plain', '@' ])
+
+    assert sorted(s.members('#test')) == [ 'op', 'owner', 'plain', 'voiced' ]
+
+    assert s['op'] == '?'
+    assert s.known('op') == False
+
+    s.who([ ('Op', 'user', 'host', '#test') ])
+
+    assert s.known('op') == True
+    assert s.known('OP!user@host') == True
+
+def test_part_quit_and_detached():
+    s = user_store(max_detached=2)
+
+    s.joined('#test')
+
+    for nick in ('a', 'b', 'c'):
+        s.join('#test', f'{nick}!u@h')
+
+    s.part('#test', 'a')
+
+    # no longer in a channel, but still known
+    assert 'a' in s
+    assert s.channels_of('a') == []
+
+    s.part('#test', 'b')
+    s.part('#test', 'c')
+
+    # the least recently detached one is forgotten
+    assert 'a' not in s
+    assert 'b' in s
+    assert 'c' in s
+
+    s.quit('b')
+
+    assert 'b' not in s
+    assert s.get('b') == None
+
+def test_bot_parted():
+    s = user_store()
+
+    s.joined('#a')
+    s.joined('#b')
+    s.join('#a', 'x!u@h')
+    s.join('#b', 'x!u@h')
+    s.join('#a', 'y!u@h')
+
+    s.parted('#A')
+
+    assert s.members('#a') == []
+    assert s.channels_of('x') == [ '#b' ]
+    assert s.get_stats()['detached'] == 1
@@ -0,0 +1,124 @@
+from conftest import wait_for
+import threading
+from user_store import user_store
+from who_resolver import who_resolver
+
+
+class fake_bot:
+    def __init__(self, whox=False):
+        self.users    = user_store()
+        self.isupport = { 'WHOX': '' } if whox else dict()
+        self.sent     = []
+
+    def send(self, line, lane):
+        self.sent.append(line)
+
+def test_lookups_share_the_outstanding_who():
+    bot = fake_bot()
+    w   = who_resolver(bot)
+
+    f1 = w.lookup('Flok')
+    f2 = w.lookup('flok')
+
+    assert f1 is f2
+    assert bot.sent == [ 'WHO Flok' ]
+
+    w.on_reply('Flok', 'fvh', 'host')
+    w.on_end('Flok')
+
+    assert f1.result(0) == 'Flok!fvh@host'
+
+    # answered from the cache, no WHO
+    assert w.wait('FLOK') == 'Flok!fvh@host'
+
+    assert len(bot.sent) == 1
+    assert w.get_stats()['shared'] == 1
+    assert w.get_stats()['cached'] == 1
+
+def test_waiting_threads_get_the_reply():
+    bot = fake_bot()
+    w   = who_resolver(bot)
+
+    results = []
+
+    threads = [ threading.Thread(target=lambda: results.append(w.wait('nick'))) for i in range(3) ]
+
+    for t in threads:
+        t.start()
+
+    assert wait_for(lambda: w.get_stats()['lookups'] == 3)
+
+    w.on_reply('nick', 'u', 'h')
+    w.on_end('nick')
+
+    for t in threads:
+        t.join()
+
+    assert results == [ 'nick!u@h' ] * 3
+    assert bot.sent == [ 'WHO nick' ]
+
+def test_unknown_nick_is_not_cached():
+    bot = fake_bot()
+    w   = who_resolver(bot)
+
+    f = w.lookup('gone')
+
+    w.on_end('gone')
+
+    assert f.result(0) == None
+
+    w.lookup('gone')
+
+    assert len(bot.sent) == 2
+
+def test_timeout_and_pruning():
+    bot = fake_bot()
+    w   = who_resolver(bot, timeout=0.05)
+
+    assert w.wait('slow') == None
+
+    f = w.lookup('slow')
+
+    # the old WHO was dropped, a new one is sent
+    assert len(bot.sent) == 2
+
+    f_other = w.lookup('other')
+
+    assert w.get_stats()['pending'] == 2
+
+    threading.Event().wait(0.06)
+
+    w.lookup('third')
+
+    # the stale ones ended with None
+    assert f.result(0) == None
+    assert f_other.result(0) == None
+    assert w.get_stats()['pending'] == 1
+
+def test_whox():
+    bot = fake_bot(whox=True)
+    w   = who_resolver(bot)
+
+    f = w.lookup('flok')
+
+    assert bot.sent == [ 'WHO flok %nuhat,77' ]
+
+    w.on_reply('flok', 'fvh', 'host', 'FlokAccount')
+    w.on_end('flok')
+
+    assert f.result(0) == 'flok!fvh@host'
+    assert w.account('FLOK') == 'FlokAccount'
+
+    w.forget('flok')
+
+    assert w.account('flok') == None
+
+def test_clear_ends_pending_lookups():
+    bot = fake_bot()
+    w   = who_resolver(bot)
+
+    f = w.lookup('nick')
+
+    w.clear()
+
+    assert f.result(0) == None
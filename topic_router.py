@@ -0,0 +1,147 @@
+#! /usr/bin/python3
+
+import threading
+
+
+# Maps the topics the bot acts on to handlers. Routes are topic paths in
+# which '+' stands for one level and a trailing '#' for the remaining
+# levels; the levels matched by those are passed to the handler as
+# parameters. Routes without wildcards are in a dict, so the per-channel
+# and control topics cost a single lookup, as do most unknown topics.
+# When several routes match, literal levels win over '+' and '+' over '#'.
+# Every route has a topic class (see mqtt_publisher) for the metrics of
+# incoming messages.
+class topic_router:
+    def __init__(self):
+        self.lock  = threading.Lock()
+
+        self.exact = dict()  # topic -> (handler, parameters, topic class)
+        self.root  = dict()  # level -> [ children, handler, topic class ]
+
+    # 'parameters' are passed to the handler (after the message) for routes without wildcards
+    def add(self, route, handler, parameters=(), topic_class='message'):
+        with self.lock:
+            if not '+' in route and not '#' in route:
+                self.exact[route] = (handler, tuple(parameters), topic_class)
+
+                return
+
+            children = self.root
+            node     = None
+
+            for level in route.split('/'):
+                node     = children.setdefault(level, [ dict(), None, None ])
+                children = node[0]
+
+            node[1] = handler
+            node[2] = topic_class
+
+    def remove(self, route):
+        with self.lock:
+            if self.exact.pop(route, None) != None:
+                return
+
+            levels = route.split('/')
+            path   = []
+
+            children = self.root
+
+            for level in levels:
+                if not level in children:
+                    return
+
+                path.append((children, level))
+
+                children = children[level][0]
+
+            path[-1][0][path[-1][1]][1] = None
+
+            # remove nodes that lead nowhere anymore
+            for children, level in reversed(path):
+                node = children[level]
+
+                if len(node[0]) > 0 or node[1] != None:
+                    break
+
+                del children[level]
+
+    def _walk(self, children, levels, i, parameters):
+        if i == len(levels):
+            return None
+
+        level = levels[i]
+
+        node = children.get(level)
+
+        if node != None:
+            if i + 1 == len(levels) and node[1] != None:
+                return (node, parameters)
+
+            found = self._walk(node[0], levels, i + 1, parameters)
+
+            if found != None:
+                return found
+
+        node = children.get('+')
+
+        if node != None:
+            if i + 1 == len(levels) and node[1] != None:
+                return (node, parameters + (level,))
+
+            found = self._walk(node[0], levels, i + 1, parameters + (level,))
+
+            if found != None:
+                return found
+
+        node = children.get('#')
+
+        if node != None and node[1] != None:
+            return (node, parameters + ('/'.join(levels[i:]),))
+
+        return None
+
+    # returns (handler, parameters, topic class) or None
+    def _resolve(self, topic):
+        with self.lock:
+            found = self.exact.get(topic)
+
+            if found != None:
+                return found
+
+            if len(self.root) == 0:
+                return None
+
+            found = self._walk(self.root, topic.split('/'), 0, ())
+
+            if found == None:
+                return None
+
+            node, parameters = found
+
+            return (node[1], parameters, node[2])
+
+    # returns (handler, parameters) or None
+    def resolve(self, topic):
+        found = self._resolve(topic)
+
+        return found[0:2] if found != None else None
+
+    # returns the topic class of the route for 'topic' or None
+    def classify(self, topic):
+        found = self._resolve(topic)
+
+        return found[2] if found != None else None
+
+    # routes to and from a channel, for when the bot enters or leaves one
+    def add_channel(self, channel, privmsg, notice, topic):
+        name = channel[1:]
+
+        self.add(f'to/irc/{name}/privmsg', privmsg, (channel,))  # Send reply in channel via PRIVMSG
+        self.add(f'to/irc/{name}/notice',  notice,  (channel,))  # Send reply in channel via NOTICE
+        self.add(f'to/irc/{name}/topic',   topic,   (channel,), 'state')  # Sets TOPIC for channel
+
+    def remove_channel(self, channel):
+        name = channel[1:]
+
+        for kind in ('privmsg', 'notice', 'topic'):
+            self.remove(f'to/irc/{name}/{kind}')
@@ -0,0 +1,158 @@
+#! /usr/bin/python3
+
+import threading
+import time
+
+
+# MQTT topic filters ('+' matches one level, '#' the remaining levels
+# including none) mapped to callbacks. Filters without wildcards are kept
+# in a dict so that exact subscriptions cost one lookup.
+class topic_trie:
+    class node:
+        __slots__ = ('children', 'callbacks')
+
+        def __init__(self):
+            self.children  = dict()  # level -> node
+            self.callbacks = []
+
+    def __init__(self):
+        self.lock  = threading.Lock()
+
+        self.exact = dict()  # topic -> list of callbacks
+        self.root  = topic_trie.node()
+
+        self.n_wildcards = 0
+
+    def add(self, topic_filter, callback):
+        with self.lock:
+            if not '+' in topic_filter and not '#' in topic_filter:
+                self.exact.setdefault(topic_filter, []).append(callback)
+
+                return
+
+            n = self.root
+
+            for level in topic_filter.split('/'):
+                if not level in n.children:
+                    n.children[level] = topic_trie.node()
+
+                n = n.children[level]
+
+            n.callbacks.append(callback)
+
+            self.n_wildcards += 1
+
+    # all callbacks of which the filter matches 'topic', each one once
+    def match(self, topic):
+        with self.lock:
+            found = list(self.exact.get(topic, ()))
+
+            if self.n_wildcards > 0:
+                nodes = [ self.root ]
+
+                # wildcards at the first level do not match $SYS-like topics
+                skip_wildcards = topic[0:1] == '$'
+
+                for level in topic.split('/'):
+                    next_nodes = []
+
+                    for n in nodes:
+                        if not skip_wildcards:
+                            hash_node = n.children.get('#')
+
+                            if hash_node != None:
+                                found += hash_node.callbacks
+
+                            plus_node = n.children.get('+')
+
+                            if plus_node != None:
+                                next_nodes.append(plus_node)
+
+                        child = n.children.get(level)
+
+                        if child != None:
+                            next_nodes.append(child)
+
+                    nodes = next_nodes
+
+                    skip_wildcards = False
+
+                    if len(nodes) == 0:
+                        break
+
+                for n in nodes:
+                    found += n.callbacks
+
+                    # "a/#" matches "a" as well
+                    hash_node = n.children.get('#')
+
+                    if hash_node != None:
+                        found += hash_node.callbacks
+
+        if len(found) <= 1:
+            return found
+
+        out  = []
+        seen = set()
+
+        for callback in found:
+            if not callback in seen:
+                seen.add(callback)
+                out.append(callback)
+
+        return out
+
+if __name__ == "__main__":
+    import random
+
+    random.seed(1)
+
+    words = [ 'irc', 'bot', 'to', 'from', 'nurds', 'test', 'privmsg', 'notice', 'topic', 'register', 'request', 'mode' ]
+
+    def random_topic():
+        return '/'.join(random.choice(words) + str(random.randint(0, 30)) for i in range(random.randint(2, 6)))
+
+    trie    = topic_trie()
+    filters = []
+
+    for i in range(5000):
+        levels = random_topic().split('/')
+
+        r = random.random()
+
+        if r < 0.2:
+            levels[random.randint(0, len(levels) - 1)] = '+'
+
+        elif r < 0.3:
+            levels[-1] = '#'
+
+        topic_filter = '/'.join(levels)
+
+        callback = (lambda i: lambda topic, payload: i)(i)
+
+        trie.add(topic_filter, callback)
+        filters.append((topic_filter, callback))
+
+    topics = [random_topic() for i in range(50000)] + [random.choice(filters)[0].replace('+', 'x').replace('#', 'y') for i in range(50000)]
+
+    start = time.time()
+
+    n = 0
+
+    for topic in topics:
+        n += len(trie.match(topic))
+
+    t_trie = time.time() - start
+
+    # what mqtt_handler.on_message did before
+    start = time.time()
+
+    for topic in topics:
+        for topic_filter, callback in filters:
+            if topic_filter.replace('#', '') in topic:
+                break
+
+    t_linear = time.time() - start
+
+    print(f'{len(filters)} subscriptions, {len(topics)} messages, {n} callbacks matched')
+    print(f'trie: {t_trie / len(topics) * 1000000:.2f} us per message, linear scan: {t_linear / len(topics) * 1000000:.2f} us per message')
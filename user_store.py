@@ -0,0 +1,352 @@
+#! /usr/bin/python3
+
+import collections
+import threading
+import time
+
+
+# Case mappings of the CASEMAPPING ISUPPORT token: in rfc1459 {}|^ are the
+# lower case versions of []\~.
+casemappings = {
+        'ascii'          : str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'),
+        'rfc1459'        : str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~', 'abcdefghijklmnopqrstuvwxyz{}|^'),
+        'strict-rfc1459' : str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\', 'abcdefghijklmnopqrstuvwxyz{}|'),
+        }
+
+class user_record:
+    __slots__ = ('nick', 'user', 'host', 'channels', 'seen')
+
+    def __init__(self, nick):
+        self.nick     = nick      # as the server sent it
+        self.user     = None      # None: not known yet (e.g. only seen in NAMES)
+        self.host     = None
+        self.channels = set()     # channel keys
+        self.seen     = time.time()
+
+    def hostmask(self):
+        return f'{self.nick}!{self.user}@{self.host}' if self.host != None else None
+
+# What the bot knows about the users it shares a channel with: nick ->
+# record, hostmask -> nick and channel -> nicks, all keyed by the case
+# mapping of the server. A user that leaves the last channel the bot is in
+# is kept for a while (up to 'max_detached', least recently seen go first)
+# so that e.g. a WHO for someone elsewhere is not lost right away.
+#
+# For the code that used 'users' as a dict: "nick in users" and users[nick]
+# (the hostmask, or '?' when it is not known yet) still work.
+class user_store:
+    def __init__(self, max_detached=1000, casemapping='rfc1459'):
+        self.max_detached = max_detached
+
+        self.lock         = threading.Lock()
+
+        self.table        = casemappings[casemapping]
+
+        self.records      = dict()                     # nick key -> user_record
+        self.masks        = dict()                     # hostmask key -> nick key
+        self.channels     = dict()                     # channel key -> set of nick keys
+        self.detached     = collections.OrderedDict()  # nick keys of users in no channel, oldest first
+
+        self.prefixes     = '~&@%+'                    # channel modes in front of nicks in NAMES
+
+    def key(self, name):
+        return name.translate(self.table).lower()
+
+    def set_casemapping(self, casemapping):
+        with self.lock:
+            if casemapping in casemappings and casemappings[casemapping] != self.table:
+                self.table = casemappings[casemapping]
+
+                self._rekey()
+
+    def set_prefixes(self, prefixes):
+        self.prefixes = prefixes
+
+    def _rekey(self):
+        records = list(self.records.values())
+
+        self.records.clear()
+        self.masks.clear()
+        self.channels.clear()
+        self.detached.clear()
+
+        for r in records:
+            nick_key = self.key(r.nick)
+
+            r.channels = { self.key(c) for c in r.channels }
+
+            self.records[nick_key] = r
+
+            self._set_mask(nick_key, r)
+
+            for channel in r.channels:
+                self.channels.setdefault(channel, set()).add(nick_key)
+
+            if len(r.channels) == 0:
+                self.detached[nick_key] = True
+
+    def _set_mask(self, nick_key, r):
+        mask = r.hostmask()
+
+        if mask != None:
+            self.masks[self.key(mask)] = nick_key
+
+    def _drop_mask(self, r):
+        mask = r.hostmask()
+
+        if mask != None:
+            self.masks.pop(self.key(mask), None)
+
+    def _get(self, nick):
+        nick_key = self.key(nick)
+
+        r = self.records.get(nick_key)
+
+        if r == None:
+            r = user_record(nick)
+
+            self.records[nick_key] = r
+
+            self.detached[nick_key] = True
+
+            self._trim()
+
+        else:
+            r.seen = time.time()
+
+        return nick_key, r
+
+    def _trim(self):
+        while len(self.detached) > self.max_detached:
+            nick_key, dummy = self.detached.popitem(last=False)
+
+            self._drop_mask(self.records.pop(nick_key))
+
+    def _forget(self, nick_key):
+        r = self.records.pop(nick_key, None)
+
+        if r == None:
+            return
+
+        self._drop_mask(r)
+
+        for channel in r.channels:
+            self.channels[channel].discard(nick_key)
+
+        self.detached.pop(nick_key, None)
+
+    def _join(self, channel_key, nick_key, r):
+        r.channels.add(channel_key)
+
+        self.channels.setdefault(channel_key, set()).add(nick_key)
+
+        self.detached.pop(nick_key, None)
+
+    def _leave(self, channel_key, nick_key):
+        r = self.records.get(nick_key)
+
+        if r == None:
+            return
+
+        r.channels.discard(channel_key)
+
+        if channel_key in self.channels:
+            self.channels[channel_key].discard(nick_key)
+
+        if len(r.channels) == 0:
+            self.detached[nick_key] = True
+
+            self.detached.move_to_end(nick_key)
+
+            self._trim()
+
+    def _set_host(self, nick_key, r, user, host):
+        if (r.user, r.host) != (user, host):
+            self._drop_mask(r)
+
+            r.user = user
+            r.host = host
+
+            self._set_mask(nick_key, r)
+
+    # 'prefix' is nick!user@host
+    def join(self, channel, prefix):
+        nick, sep, rest = prefix.partition('!')
+        user, sep, host = rest.partition('@')
+
+        with self.lock:
+            nick_key, r = self._get(nick)
+
+            self._set_host(nick_key, r, user, host)
+
+            self._join(self.key(channel), nick_key, r)
+
+    # the bot itself joined: a NAMES list follows
+    def joined(self, channel):
+        channel_key = self.key(channel)
+
+        with self.lock:
+            for nick_key in list(self.channels.get(channel_key, ())):
+                self._leave(channel_key, nick_key)
+
+            self.channels[channel_key] = set()
+
+    def part(self, channel, nick):
+        with self.lock:
+            self._leave(self.key(channel), self.key(nick))
+
+    # the bot itself left
+    def parted(self, channel):
+        channel_key = self.key(channel)
+
+        with self.lock:
+            for nick_key in list(self.channels.get(channel_key, ())):
+                self._leave(channel_key, nick_key)
+
+            self.channels.pop(channel_key, None)
+
+    def quit(self, nick):
+        with self.lock:
+            self._forget(self.key(nick))
+
+    def nick_change(self, old_nick, new_nick):
+        with self.lock:
+            old_key = self.key(old_nick)
+
+            r = self.records.pop(old_key, None)
+
+            if r == None:
+                return
+
+            self._drop_mask(r)
+
+            was_detached = self.detached.pop(old_key, None) != None
+
+            new_key = self.key(new_nick)
+
+            self._forget(new_key)  # stale entry
+
+            r.nick = new_nick
+            r.seen = time.time()
+
+            self.records[new_key] = r
+
+            self._set_mask(new_key, r)
+
+            for channel in r.channels:
+                members = self.channels[channel]
+
+                members.discard(old_key)
+                members.add(new_key)
+
+            if was_detached:
+                self.detached[new_key] = True
+
+    # one 353 reply: the nicks may have a mode prefix (e.g. @nick)
+    def names(self, channel, nicks):
+        channel_key = self.key(channel)
+
+        with self.lock:
+            for nick in nicks:
+                nick = nick.lstrip(self.prefixes)
+
+                if nick == '':
+                    continue
+
+                nick_key, r = self._get(nick)
+
+                self._join(channel_key, nick_key, r)
+
+    # [ (nick, user, host, channel or None), ... ] from 352 or 354 replies
+    def who(self, replies):
+        with self.lock:
+            for nick, user, host, channel in replies:
+                nick_key, r = self._get(nick)
+
+                self._set_host(nick_key, r, user, host)
+
+                if channel != None and self.key(channel) in self.channels:
+                    self._join(self.key(channel), nick_key, r)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.masks.clear()
+            self.channels.clear()
+            self.detached.clear()
+
+    def hostmask(self, nick):
+        with self.lock:
+            r = self.records.get(self.key(nick))
+
+            return r.hostmask() if r != None else None
+
+    def nick_of(self, hostmask):
+        with self.lock:
+            nick_key = self.masks.get(self.key(hostmask))
+
+            return self.records[nick_key].nick if nick_key != None else None
+
+    # nick or nick!user@host; True when the hostmask is known
+    def known(self, user):
+        if '!' in user:
+            return self.nick_of(user) != None
+
+        return self.hostmask(user) != None
+
+    def members(self, channel):
+        with self.lock:
+            return [ self.records[nick_key].nick for nick_key in self.channels.get(self.key(channel), ()) ]
+
+    def channels_of(self, nick):
+        with self.lock:
+            r = self.records.get(self.key(nick))
+
+            return list(r.channels) if r != None else []
+
+    def __contains__(self, nick):
+        with self.lock:
+            return self.key(nick) in self.records
+
+    def __getitem__(self, nick):
+        with self.lock:
+            r = self.records[self.key(nick)]
+
+            mask = r.hostmask()
+
+            return mask if mask != None else '?'
+
+    def get(self, nick, default=None):
+        try:
+            return self[nick]
+
+        except KeyError as ke:
+            return default
+
+    def __len__(self):
+        with self.lock:
+            return len(self.records)
+
+    def get_stats(self):
+        with self.lock:
+            return { 'users': len(self.records), 'hostmasks': len(self.masks), 'detached': len(self.detached),
+                     'channels': { channel: len(members) for channel, members in self.channels.items() } }
+
+if __name__ == "__main__":
+    s = user_store()
+
+    s.joined('#test')
+    s.names('#test', [ '@Folkert', '+nurd[x]', 'someone' ])
+    s.who([ ('Folkert', 'fvh', 'vanheusden.com', '#test') ])
+    s.join('#test', 'Other!o@example.com')
+    s.nick_change('NURD{X}', 'nurd')
+
+    print(s.members('#test'), s['folkert'], 'nurd[x]' in s, s.known('folkert!FVH@vanheusden.com'), s.get_stats())
+
+    n     = 100000
+    start = time.time()
+
+    for i in range(n):
+        s.known('folkert!fvh@vanheusden.com')
+
+    print(f'{(time.time() - start) * 1000000 / n:.2f} us per hostmask lookup')
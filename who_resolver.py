@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+
+import collections
+from concurrent.futures import Future, TimeoutError
+from send_queue import send_queue
+import threading
+import time
+
+
+# Finds the hostmask of a nick with WHO. Requests for a nick for which a
+# WHO is outstanding share its future; answers are kept for 'ttl' seconds
+# (at most 'max_cached' of them). When the server announces WHOX (in 005),
+# 'WHO nick %nuhat,<token>' is sent and the 354 replies are used; those
+# carry the account as well. With 'warm_up' the bot sends one
+# 'WHO #channel' after joining a channel so that the hostmasks of everyone
+# in it are known beforehand.
+class who_resolver:
+    whox_token = '77'
+
+    def __init__(self, bot, ttl=300., warm_up=False, timeout=5., max_cached=5000):
+        self.bot        = bot  # ircbot: send(), users and isupport
+        self.ttl        = ttl
+        self.warm_up    = warm_up
+        self.timeout    = timeout
+        self.max_cached = max_cached
+
+        self.lock       = threading.Lock()
+
+        self.pending    = dict()                     # nick key -> (future, sent at)
+        self.cache      = collections.OrderedDict()  # nick key -> (hostmask or None, at); oldest first
+
+        self.accounts   = dict()                     # nick key -> account (WHOX only)
+        self.answered   = []                         # nick keys replied to since the latest 315
+
+        self.n_lookups  = 0
+        self.n_cached   = 0
+        self.n_shared   = 0
+        self.n_sent     = 0
+
+    def _who(self, target, lane):
+        if 'WHOX' in self.bot.isupport:
+            self.bot.send(f'WHO {target} %nuhat,{who_resolver.whox_token}', lane)
+
+        else:
+            self.bot.send(f'WHO {target}', lane)
+
+    # a WHO without a 315 (e.g. lost in a disconnect) ends with None
+    def _prune(self, now):
+        stale = [ key for key, (future, sent_at) in self.pending.items() if now - sent_at >= self.timeout ]
+
+        return [ self.pending.pop(key)[0] for key in stale ]
+
+    # returns a Future with the hostmask (None when the server doesn't know the nick)
+    def lookup(self, nick):
+        key    = self.bot.users.key(nick)
+        now    = time.time()
+
+        future = None
+        send   = False
+
+        with self.lock:
+            self.n_lookups += 1
+
+            stale = self._prune(now)
+
+            if key in self.cache and now - self.cache[key][1] < self.ttl:
+                self.n_cached += 1
+
+                future = Future()
+
+                future.set_result(self.cache[key][0])
+
+            elif key in self.pending:
+                self.n_shared += 1
+
+                future = self.pending[key][0]
+
+            else:
+                future = Future()
+
+                self.pending[key] = (future, now)
+
+                self.n_sent += 1
+
+                send = True
+
+        for stale_future in stale:
+            stale_future.set_result(None)
+
+        if send:
+            self._who(nick, send_queue.REPLY)
+
+        return future
+
+    # blocks at most 'timeout' seconds; returns the hostmask or None
+    def wait(self, nick):
+        try:
+            return self.lookup(nick).result(self.timeout)
+
+        except TimeoutError as te:
+            return None
+
+    # 352 and 354
+    def on_reply(self, nick, user, host, account=None):
+        key = self.bot.users.key(nick)
+
+        with self.lock:
+            if account != None and account != '0':
+                self.accounts[key] = account
+
+            self.cache[key] = (f'{nick}!{user}@{host}', time.time())
+            self.cache.move_to_end(key)
+
+            while len(self.cache) > self.max_cached:
+                old_key, dummy = self.cache.popitem(last=False)
+
+                self.accounts.pop(old_key, None)
+
+            self.answered.append(key)
+
+    # 315, after the replies were added to the user store (so that whoever
+    # waits finds them there); the nick that was asked for and did not come
+    # by is not known; that is not cached: the nick may come online any moment
+    def on_end(self, target):
+        done = []
+
+        with self.lock:
+            for key in self.answered + [ self.bot.users.key(target) ]:
+                future = self.pending.pop(key, (None, None))[0]
+
+                if future != None:
+                    done.append((future, self.cache[key][0] if key in self.cache else None))
+
+            self.answered = []
+
+        for future, hostmask in done:
+            future.set_result(hostmask)
+
+    # QUIT and NICK: the cached hostmask is no longer valid
+    def forget(self, nick):
+        key = self.bot.users.key(nick)
+
+        with self.lock:
+            self.cache.pop(key, None)
+
+            self.accounts.pop(key, None)
+
+    def on_joined(self, channel):
+        if self.warm_up:
+            self._who(channel, send_queue.BROADCAST)
+
+    def account(self, nick):
+        with self.lock:
+            return self.accounts.get(self.bot.users.key(nick))
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.accounts.clear()
+
+            for future, sent_at in self.pending.values():
+                future.set_result(None)
+
+            self.pending.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return { 'lookups': self.n_lookups, 'cached': self.n_cached, 'shared': self.n_shared, 'sent': self.n_sent,
+                     'pending': len(self.pending), 'cache-size': len(self.cache), 'whox': 'WHOX' in self.bot.isupport }